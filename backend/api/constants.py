@@ -1,2 +1,49 @@
+import os
 
-PORT = 8000
\ No newline at end of file
+PORT = 8000
+
+# Directory of a memory-mapped fingerprint index (see database/mapped_index.py).
+# Set by api/serve.py for its workers, when unset lookups go to Postgres.
+INDEX_DIR = os.environ.get('FINDMYSONG_INDEX_DIR')
+
+# Build the match vote histograms in Postgres instead of fetching every matching row.
+# Lookups then always go to Postgres, not through the cache or the mapped index.
+AGGREGATE_MATCHES_IN_DB = os.environ.get('FINDMYSONG_AGGREGATE_IN_DB') == '1'
+
+# How often the hash scheme of the index is read again, maintenance migrate-hash
+# changes it under running servers
+HASH_SCHEME_CHECK_SEC = 5
+
+# Shared hash -> postings cache (see matching/query_cache.py)
+QUERY_CACHE_TTL_SEC = 15
+QUERY_CACHE_MAX_POSTINGS = 1_000_000
+
+# Recently identified songs used as a prior for new sessions
+RECENT_HITS_TTL_SEC = 300
+RECENT_HITS_TOLERANCE_SEC = 3
+
+# Songs indexed while serving (see indexing/ingestion.py), 0 workers turns it off
+INGEST_WORKERS = int(os.environ.get('FINDMYSONG_INGEST_WORKERS', '2'))
+INGEST_MAX_DURATION_SEC = None
+INGEST_DETECT_DUPLICATES = os.environ.get('FINDMYSONG_INGEST_DEDUPE') == '1'
+INGEST_UPLOAD_DIR = os.environ.get('FINDMYSONG_UPLOAD_DIR', os.path.abspath('uploads'))
+INGEST_MAX_UPLOAD_MB = int(os.environ.get('FINDMYSONG_MAX_UPLOAD_MB', '200'))
+# estimated memory the ingestion workers may use at once, and when a worker is replaced
+INGEST_MEMORY_BUDGET_MB = int(os.environ.get('FINDMYSONG_INGEST_MEMORY_MB', '2048'))
+INGEST_MAX_SONGS_PER_WORKER = 200
+INGEST_MAX_WORKER_RSS_MB = 2048
+
+# With a mapped index, how often each worker looks for songs it does not have yet,
+# and when they are merged into a rebuilt index
+DELTA_POLL_SEC = 2
+INDEX_MERGE_MAX_SONGS = 200
+INDEX_MERGE_INTERVAL_SEC = 600
+
+# Admission control of recognition sessions (see api/scheduler.py): matching
+# threads per server process, sessions admitted at once, and how many more may
+# wait how long for a slot before being told to retry later
+MATCH_WORKERS = int(os.environ.get('FINDMYSONG_MATCH_WORKERS', '2'))
+MAX_SESSIONS = int(os.environ.get('FINDMYSONG_MAX_SESSIONS', '32'))
+MAX_WAITING_SESSIONS = 32
+SESSION_ADMISSION_WAIT_SEC = 5
+SESSION_TIMEOUT_SEC = 20
@@ -32,3 +32,14 @@ async def unregister_service():
     print("[Zeroconf] Unregistering service...")
     await async_zeroconf.async_unregister_all_services()
     await async_zeroconf.async_close()
+
+# Blocking variants for the process that supervises the server workers,
+# which has no event loop of its own
+def register_service_blocking():
+    print("[Zeroconf] Registering service...")
+    async_zeroconf.zeroconf.register_service(service_info)
+
+def unregister_service_blocking():
+    print("[Zeroconf] Unregistering service...")
+    async_zeroconf.zeroconf.unregister_all_services()
+    async_zeroconf.zeroconf.close()
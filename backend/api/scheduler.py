@@ -0,0 +1,171 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import math
+from time import monotonic
+from typing import Callable
+
+
+class SessionRejected(Exception):
+    """
+    The server is saturated, the client should try again after `retry_after_sec`.
+    """
+
+    def __init__(self, retry_after_sec: int):
+        super().__init__(f"Server busy, retry after {retry_after_sec}s")
+        self.retry_after_sec = retry_after_sec
+
+
+class MatchScheduler:
+    """
+    Admission control and fair sharing of the matching work of recognition sessions.
+
+    At most `max_sessions` sessions run at a time. Up to `max_waiting` more
+    wait `wait_timeout_sec` for one of them to finish, any further ones are
+    rejected right away with a retry hint.
+
+    Admitted sessions submit their work one window at a time, and windows run
+    on `max_workers` threads in the order they were submitted. A session only
+    submits its next window once the last one is done, so it goes to the back
+    of the line after every window: sessions take turns, and a client sending
+    audio faster than real time cannot hold up the others.
+
+    All methods except the window functions run on the event loop.
+    """
+
+    def __init__(self, max_workers: int, max_sessions: int, max_waiting: int, wait_timeout_sec: float):
+        self.max_workers = max_workers
+        self.max_sessions = max_sessions
+        self.max_waiting = max_waiting
+        self.wait_timeout_sec = wait_timeout_sec
+
+        # threads are only started by the first window, after ingestion forked its worker supervisor
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='matching')
+
+        self._active_sessions = 0
+        self._waiting_sessions = deque()   # futures resolved when a session slot is handed over
+        self._running_windows = 0
+        self._queued_windows = deque()     # futures resolved when a worker is handed over
+
+        self.admitted = 0
+        self.shed = 0               # rejected without waiting
+        self.shed_after_wait = 0    # waited wait_timeout_sec without getting a slot
+        self.windows = 0
+        self._window_wait_sec = 0.0
+        self._mean_session_sec = None
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        """
+        Holds a session slot for the duration of the block, raises SessionRejected when there is none.
+        """
+        if self._active_sessions < self.max_sessions:
+            self._active_sessions += 1
+        else:
+            if len(self._waiting_sessions) >= self.max_waiting:
+                self.shed += 1
+                raise SessionRejected(self.retry_after_sec())
+            await self._wait_for_session_slot()
+
+        self.admitted += 1
+        start = monotonic()
+        try:
+            yield
+        finally:
+            duration = monotonic() - start
+            self._mean_session_sec = duration if self._mean_session_sec is None else 0.9 * self._mean_session_sec + 0.1 * duration
+            self._release_session()
+
+    async def run(self, fn: Callable):
+        """
+        Runs one window of matching work on a worker thread once it is this session's turn.
+        """
+        queued_at = monotonic()
+        if self._running_windows < self.max_workers:
+            self._running_windows += 1
+        else:
+            await self._wait_for_worker()
+
+        self.windows += 1
+        self._window_wait_sec += monotonic() - queued_at
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn)
+        finally:
+            self._release_worker()
+
+    def retry_after_sec(self) -> int:
+        # the time until as many sessions finished as are waiting ahead of this one
+        mean_session_sec = self._mean_session_sec or self.wait_timeout_sec
+        return max(1, math.ceil(mean_session_sec * (len(self._waiting_sessions) + 1) / self.max_sessions))
+
+    def stats(self) -> dict:
+        return {
+            'max_sessions': self.max_sessions,
+            'active_sessions': self._active_sessions,
+            'waiting_sessions': len(self._waiting_sessions),
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'shed_after_wait': self.shed_after_wait,
+            'mean_session_sec': self._mean_session_sec,
+            'workers': self.max_workers,
+            'running_windows': self._running_windows,
+            'queued_windows': len(self._queued_windows),
+            'windows': self.windows,
+            'mean_window_wait_ms': self._window_wait_sec / self.windows * 1000 if self.windows > 0 else 0.0,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _wait_for_session_slot(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting_sessions.append(waiter)
+        try:
+            await asyncio.wait([waiter], timeout=self.wait_timeout_sec)
+        except asyncio.CancelledError:
+            self._give_up(waiter, self._waiting_sessions, self._release_session)
+            raise
+
+        if not waiter.done():
+            self._give_up(waiter, self._waiting_sessions, self._release_session)
+            self.shed_after_wait += 1
+            raise SessionRejected(self.retry_after_sec())
+
+    async def _wait_for_worker(self):
+        waiter = asyncio.get_running_loop().create_future()
+        self._queued_windows.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            self._give_up(waiter, self._queued_windows, self._release_worker)
+            raise
+
+    def _release_session(self):
+        if not _hand_over(self._waiting_sessions):
+            self._active_sessions -= 1
+
+    def _release_worker(self):
+        if not _hand_over(self._queued_windows):
+            self._running_windows -= 1
+
+    def _give_up(self, waiter: asyncio.Future, waiters: deque, release: Callable):
+        if waiter.done() and not waiter.cancelled():
+            # the slot was handed over just before the waiter left, pass it on
+            release()
+            return
+        waiter.cancel()
+        if waiter in waiters:
+            waiters.remove(waiter)
+
+
+def _hand_over(waiters: deque) -> bool:
+    """
+    Gives a freed slot straight to the longest waiter, so the count of used slots stays.
+    """
+    while waiters:
+        waiter = waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            return True
+    return False
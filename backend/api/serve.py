@@ -0,0 +1,27 @@
+import argparse
+import os
+
+import uvicorn
+
+from api.constants import PORT
+from api.discovery import register_service_blocking, unregister_service_blocking
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Find My Song Server')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count(), help='Number of server processes')
+    parser.add_argument('--index', type=str, help='Memory-mapped index directory shared by all workers (python -m database.mapped_index build DIR)')
+    args = parser.parse_args()
+
+    # workers are separate interpreters importing api.server, they get their settings from the environment
+    if args.index:
+        os.environ['FINDMYSONG_INDEX_DIR'] = os.path.abspath(args.index)
+
+    # advertise once from the supervisor rather than once per worker
+    register_service_blocking()
+    try:
+        uvicorn.run('api.server:app', host=args.host, port=args.port, workers=args.workers)
+    finally:
+        unregister_service_blocking()
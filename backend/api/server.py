@@ -1,25 +1,114 @@
+import contextlib
+from dataclasses import asdict
+import os
 import pprint
-from time import time
+from time import monotonic, time
+from typing import List
+import uuid
 import fastapi
 from fastapi import File, HTTPException, Response, UploadFile, WebSocket
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 import numpy as np
+from pydantic import BaseModel
 from tinytag import TinyTag
-from api.constants import PORT
+from api.constants import (
+    AGGREGATE_MATCHES_IN_DB, DELTA_POLL_SEC, HASH_SCHEME_CHECK_SEC, INDEX_DIR, INDEX_MERGE_INTERVAL_SEC, INDEX_MERGE_MAX_SONGS, INGEST_DETECT_DUPLICATES, INGEST_MAX_DURATION_SEC, INGEST_MAX_UPLOAD_MB,
+    INGEST_MAX_SONGS_PER_WORKER, INGEST_MAX_WORKER_RSS_MB, INGEST_MEMORY_BUDGET_MB, INGEST_UPLOAD_DIR, INGEST_WORKERS, MATCH_WORKERS, MAX_SESSIONS, MAX_WAITING_SESSIONS, PORT, QUERY_CACHE_MAX_POSTINGS, QUERY_CACHE_TTL_SEC,
+    RECENT_HITS_TOLERANCE_SEC, RECENT_HITS_TTL_SEC, SESSION_ADMISSION_WAIT_SEC, SESSION_TIMEOUT_SEC
+)
 from config.constants import DEFAULT_SAMPLE_RATE
-from api.song_id_session import SessionConfiguration, SongIdSession
+from api.scheduler import MatchScheduler, SessionRejected
+from api.song_id_session import FINGERPRINTS_DTYPE, SessionConfiguration, SongIdSession
 from database.config import DB_NAME, DB_PASS, DB_USER
 from database.db import AppDatabase
+from database.delta_index import DeltaIndex
+from database.mapped_index import MappedIndex
+from fingerprint.hashing import params_id_for_scheme
 from fingerprint.fingerprinting import generate_fingerprints
+from indexing.index_process import IndexProcessOptions
+from indexing.library import create_db_connection, find_audio_files
+from indexing.ingestion import IngestionService
 from model.song import Song
 from preprocessing.audio_preprocessing import PreprocessedAudio
+from preprocessing.decoders import resample_signal
 from matching.matching import get_audio_matches
+from matching.query_cache import QueryCache, RecentHits
 from starlette.websockets import WebSocketDisconnect
-from scipy.signal import resample
-
-app = fastapi.FastAPI()
 
 db = AppDatabase(DB_NAME, DB_USER, DB_PASS)
+_hash_scheme = (db.get_hash_scheme(), monotonic())
+
+# fingerprint lookups go to the shared memory-mapped index when one is configured,
+# plus the songs added since it was built
+index = MappedIndex(INDEX_DIR) if INDEX_DIR else None
+delta = DeltaIndex(index, create_db_connection, DELTA_POLL_SEC) if index is not None else None
+
+# shared by all sessions so bursts of identical queries hit the database once
+query_cache = QueryCache(delta if delta is not None else db, ttl_sec=QUERY_CACHE_TTL_SEC, max_postings=QUERY_CACHE_MAX_POSTINGS)
+recent_hits = RecentHits(ttl_sec=RECENT_HITS_TTL_SEC, tolerance_sec=RECENT_HITS_TOLERANCE_SEC)
+
+# matching runs off the event loop, with a bounded number of sessions taking turns
+scheduler = MatchScheduler(MATCH_WORKERS, MAX_SESSIONS, MAX_WAITING_SESSIONS, SESSION_ADMISSION_WAIT_SEC)
+
+ingestion = IngestionService(
+    create_db_connection,
+    INGEST_WORKERS,
+    IndexProcessOptions(
+        max_duration_sec=INGEST_MAX_DURATION_SEC,
+        detect_duplicates=INGEST_DETECT_DUPLICATES,
+        split_workers=INGEST_WORKERS,
+        max_songs_per_worker=INGEST_MAX_SONGS_PER_WORKER,
+        max_rss_mb=INGEST_MAX_WORKER_RSS_MB
+    ),
+    delta,
+    INDEX_MERGE_MAX_SONGS,
+    INDEX_MERGE_INTERVAL_SEC,
+    memory_budget_mb=INGEST_MEMORY_BUDGET_MB
+) if INGEST_WORKERS > 0 else None
+
+
+def current_hash_scheme() -> int:
+    """
+    The scheme queries are hashed with, the one of the database. With a mapped
+    index the delta polls it, otherwise it is read every HASH_SCHEME_CHECK_SEC.
+    """
+    global _hash_scheme
+    hash_scheme, read_at = _hash_scheme
+    if delta is not None and delta.hash_scheme is not None:
+        new_scheme = delta.hash_scheme
+    elif monotonic() - read_at > HASH_SCHEME_CHECK_SEC:
+        new_scheme = db.get_hash_scheme()
+    else:
+        return hash_scheme
+
+    if new_scheme != hash_scheme:
+        # cached postings are keyed by hashes of the old scheme
+        print(f"Hash scheme changed from {hash_scheme} to {new_scheme}")
+        query_cache.clear()
+    _hash_scheme = (new_scheme, monotonic())
+    return new_scheme
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    # ingestion forks its worker supervisor, so it starts before any other thread
+    if ingestion is not None:
+        ingestion.start()
+    if delta is not None:
+        delta.start()
+    yield
+    scheduler.shutdown()
+    if delta is not None:
+        delta.stop()
+    if ingestion is not None:
+        ingestion.stop()
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
+
+class IngestRequest(BaseModel):
+    paths: List[str]
 
 @app.websocket('/identify_song')
 async def identify_song(ws: WebSocket):
@@ -31,8 +120,31 @@ async def identify_song(ws: WebSocket):
 
     print(f"User sending data: {in_sample_rate}Hz, {dtype} data type")
 
-    config = SessionConfiguration(in_sample_rate, DEFAULT_SAMPLE_RATE, dtype, 3, 1000, 300)
-    session = SongIdSession(db=db, config=config)
+    # clients computing fingerprints themselves send 'fingerprints:<params id>' as the dtype
+    hash_scheme = current_hash_scheme()
+    if dtype.startswith(FINGERPRINTS_DTYPE):
+        params_id = dtype[len(FINGERPRINTS_DTYPE) + 1:]
+        if params_id != params_id_for_scheme(hash_scheme):
+            print(f"Unsupported fingerprint parameters {params_id}, expected {params_id_for_scheme(hash_scheme)}")
+            await ws.send_json(prepare_failure_result('unsupported_fingerprint_params'))
+            await ws.close()
+            return
+        dtype = FINGERPRINTS_DTYPE
+        in_sample_rate = DEFAULT_SAMPLE_RATE
+
+    try:
+        async with scheduler.admit():
+            await run_session(ws, in_sample_rate, dtype, hash_scheme)
+    except SessionRejected as e:
+        print(f"Server busy, retry after {e.retry_after_sec}s")
+        await ws.send_json(prepare_failure_result('busy', e.retry_after_sec))
+        await ws.close()
+
+
+async def run_session(ws: WebSocket, in_sample_rate: int, dtype: str, hash_scheme: int):
+    config = SessionConfiguration(in_sample_rate, DEFAULT_SAMPLE_RATE, dtype, 3, 1000, 300, AGGREGATE_MATCHES_IN_DB, hash_scheme)
+    session = SongIdSession(db=db, config=config, cache=query_cache, recent_hits=recent_hits)
+    push = session.push_fingerprints if dtype == FINGERPRINTS_DTYPE else session.push_bytes
     
     time_s = 0
 
@@ -41,17 +153,23 @@ async def identify_song(ws: WebSocket):
         c_time = time()
         try:
             data = await ws.receive_bytes()
-            session.push_bytes(data)
         except WebSocketDisconnect:
             print("User disconnected early")
             break
+        push(data)
+        # one window per turn, other sessions' windows run in between
+        while session.has_pending_window() and time_s + time() - c_time <= SESSION_TIMEOUT_SEC:
+            await scheduler.run(session.match_next_window)
         time_s += time() - c_time
 
         if session.is_match_found:
                 
             results = sorted(session.results.items(), key=lambda x: x[1], reverse=True)
-            top_song_id = results[0][0]
-            top_song = db.get_song(top_song_id)
+            top_song = _first_existing_song(song_id for song_id, _ in results)
+            if top_song is None:
+                print("Matched songs were deleted meanwhile")
+                await ws.send_json(prepare_failure_result())
+                break
             print(f"Found song: {top_song.title} by {top_song.artist_name}")
             
             res = prepare_sucess_result(top_song)
@@ -61,7 +179,7 @@ async def identify_song(ws: WebSocket):
             except RuntimeError as e:
                 print(e.__cause__)
 
-        if time_s > 20:
+        if time_s > SESSION_TIMEOUT_SEC:
             print("Recognition timeout")
             res = prepare_failure_result()
             await ws.send_json(res)
@@ -78,26 +196,103 @@ async def recognize_song_one_shot(
     
     signal = np.frombuffer(contents, dtype=dtype)
     duration_sec = len(signal) / sample_rate
+    hash_scheme = current_hash_scheme()
 
-    if sample_rate != DEFAULT_SAMPLE_RATE:
-        num_samples = int(duration_sec * DEFAULT_SAMPLE_RATE)
-        signal = resample(signal, num_samples)
+    def match():
+        # resampled on the matching worker, not on the event loop
+        preprocessed = PreprocessedAudio(resample_signal(signal, sample_rate, DEFAULT_SAMPLE_RATE), DEFAULT_SAMPLE_RATE, duration_sec)
+        return get_audio_matches(lookup, preprocessed, 3, AGGREGATE_MATCHES_IN_DB, hash_scheme)
 
-    preprocessed = PreprocessedAudio(signal, DEFAULT_SAMPLE_RATE, duration_sec)
-    result = get_audio_matches(db, preprocessed, 1)
+    lookup = db if AGGREGATE_MATCHES_IN_DB else query_cache
+    try:
+        async with scheduler.admit():
+            result = await scheduler.run(match)
+    except SessionRejected as e:
+        res = prepare_failure_result('busy', e.retry_after_sec)
+        return JSONResponse(res, status_code=503, headers={'Retry-After': str(e.retry_after_sec)})
 
-    song_id = result[0][0]
-    if song_id is None or result[0][1] < 20:
+    song = _first_existing_song(song_id for song_id, score, *_ in result if song_id is not None and score >= 20)
+    if song is None:
         res = prepare_failure_result()
         return JSONResponse(res)
 
-    song = db.get_song(song_id)
     res = prepare_sucess_result(song)
 
     return JSONResponse(res)
 
 
 
+def _first_existing_song(song_ids) -> Song | None:
+    # a song can be deleted after its fingerprints were looked up, the next candidate is used then
+    for song_id in song_ids:
+        song = db.get_song(song_id)
+        if song is not None:
+            return song
+    return None
+
+
+@app.post('/ingest')
+def ingest(request: IngestRequest):
+    """
+    Queues audio files or directories on the server's file system for indexing.
+    A plain function, so walking the directories runs on the thread pool.
+    """
+    file_paths = []
+    for path in request.paths:
+        if os.path.isdir(path):
+            file_paths.extend(find_audio_files(path))
+        elif os.path.isfile(path):
+            file_paths.append(path)
+        else:
+            raise HTTPException(status_code=404, detail=f"No such file or directory: {path}")
+
+    file_paths = [os.path.abspath(p) for p in file_paths]
+    job_ids = db.create_ingest_jobs(file_paths)
+    return {'jobs': [{'id': job_id, 'file_path': p} for job_id, p in zip(job_ids, file_paths)]}
+
+
+@app.post('/ingest/upload')
+async def ingest_upload(file: UploadFile):
+    os.makedirs(INGEST_UPLOAD_DIR, exist_ok=True)
+    file_path = os.path.join(INGEST_UPLOAD_DIR, f"{uuid.uuid4().hex}_{os.path.basename(file.filename or 'upload')}")
+
+    max_bytes = INGEST_MAX_UPLOAD_MB * 1024 * 1024
+    size = 0
+    with open(file_path, 'wb') as f:
+        while chunk := await file.read(1024 * 1024):
+            size += len(chunk)
+            if size > max_bytes:
+                break
+            await run_in_threadpool(f.write, chunk)
+    if size > max_bytes:
+        os.remove(file_path)
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {INGEST_MAX_UPLOAD_MB} MB")
+
+    job_id = (await run_in_threadpool(db.create_ingest_jobs, [file_path]))[0]
+    return {'jobs': [{'id': job_id, 'file_path': file_path}]}
+
+
+@app.get('/ingest/{job_id}')
+def ingest_status(job_id: int):
+    job = db.get_ingest_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail='Invalid job id')
+    return asdict(job)
+
+
+@app.get('/metrics')
+def metrics():
+    return {
+        'pid': os.getpid(),
+        'index_version': index.version if index is not None else None,
+        'delta': delta.stats() if delta is not None else None,
+        'ingestion': ingestion.stats() if ingestion is not None else None,
+        'scheduler': scheduler.stats(),
+        'query_cache': query_cache.stats(),
+        'recent_hits': recent_hits.stats()
+    }
+
+
 @app.get('/get_albumart')
 def get_albumart(song_id: int):
 
@@ -124,9 +319,12 @@ def prepare_sucess_result(song: Song):
         'album': song.album_name
     }
 
-def prepare_failure_result():
-    return {
+def prepare_failure_result(reason: str = 'timeout', retry_after_sec: int = None):
+    res = {
         'result': 'failure',
-        'reason': 'timeout'
+        'reason': reason
     }
+    if retry_after_sec is not None:
+        res['retry_after_sec'] = retry_after_sec
+    return res
 
@@ -1,78 +1,172 @@
 from collections import defaultdict, Counter
 from dataclasses import dataclass
-import math
-from scipy.signal import resample
 import numpy as np
 import time
 
 from database.db import AppDatabase
-from matching.matching import get_audio_matches
+from fingerprint.hashing import HASH_SCHEME_V1, is_wide_scheme
+from matching.matching import get_audio_matches, get_fingerprint_matches
+from matching.query_cache import QueryCache, RecentHits
 from preprocessing.audio_preprocessing import PreprocessedAudio
+from preprocessing.streaming import SampleRingBuffer, StreamingResampler
 
 @dataclass
 class SessionConfiguration:
     in_sample_rate: int
     target_sample_rate: int
-    dtype: str              # 'float32' or 'int16'
+    dtype: str              # 'float32', 'int16' or 'fingerprints'
     topn: int
     chunk_time_msec: int
     stride_msec: int        # how often to shift the window (e.g., 500ms)
+    aggregate_in_db: bool = False   # let Postgres build the vote histograms (bypasses the cache)
+    hash_scheme: int = HASH_SCHEME_V1   # must match the index (AppDatabase.get_hash_scheme)
 
 
+# Acceptance thresholds when the leading song was just identified by another
+# session at the same playback position (see RecentHits)
+RECENT_HIT_MIN_SCORE = 12
+RECENT_HIT_MIN_GAP = 6
+
+# dtype of sessions where the client computes the fingerprints and sends
+# batches of little-endian (hash, offset_msec) pairs instead of audio,
+# int32 pairs for the 31-bit hash scheme and int64 pairs for the wide ones
+FINGERPRINTS_DTYPE = 'fingerprints'
+
+# fingerprint offsets may run this far ahead of the time the session has been
+# streaming, pairs past it (or before the stream started) are dropped
+MAX_OFFSET_LEAD_MSEC = 5000
+
 class SongIdSession:
     """
     Class for real-time song identification from streaming audio
     """
 
-    def __init__(self, db: AppDatabase, config: SessionConfiguration):
+    def __init__(self, db: AppDatabase, config: SessionConfiguration, cache: QueryCache = None, recent_hits: RecentHits = None):
         self.db = db
+        self.lookup = cache if cache is not None and not config.aggregate_in_db else db
+        self.recent_hits = recent_hits
         self.config = config
         self.is_match_found = False
-        self.bytes_buffer = bytearray()
         self.results = defaultdict(int)
+        self.song_started_at = dict()  # song_id -> estimated wall-clock start of the song
+        self.last_match_time = 0
+
+        if config.dtype == FINGERPRINTS_DTYPE:
+            self.pair_dtype = np.dtype('<i8') if is_wide_scheme(config.hash_scheme) else np.dtype('<i4')
+            self.fingerprints = np.empty((0, 2), dtype=self.pair_dtype)
+            self.latest_offset_msec = -1
+            self.window_end_msec = config.chunk_time_msec
+            self.started_at = time.monotonic()
+            self.dropped_pairs = 0
+            return
+
         self.sample_size = 4 if config.dtype == 'float32' else 2 if config.dtype == 'int16' else None
         if self.sample_size is None:
-            raise NotImplementedError("Only float32 and int16 dtypes supported")
-        self.last_match_time = 0
+            raise NotImplementedError("Only float32, int16 and fingerprints dtypes supported")
+
+        # window and stride are kept in samples at the target rate, so sub-second strides are exact
+        self.window_samples = self._msec_to_samples(config.chunk_time_msec)
+        self.stride_samples = max(1, self._msec_to_samples(config.stride_msec))
+
+        self.resampler = StreamingResampler(config.in_sample_rate, config.target_sample_rate)
+        self.samples = SampleRingBuffer(2 * self.window_samples)
+        self.leftover_bytes = b''  # partial sample split across two pushes
 
     def push_bytes(self, bytes_chunk: bytearray):
+        """
+        Buffers audio, the windows it completes are matched by `match_next_window`.
+        """
 
         if self.is_match_found:
             return
 
-        self.bytes_buffer.extend(bytes_chunk)
+        self.samples.write(self._decode(bytes_chunk))
 
-        while self.buffer_has_enough_bytes():
+    def has_pending_window(self) -> bool:
+        if self.is_match_found:
+            return False
+        if self.config.dtype == FINGERPRINTS_DTYPE:
+            return self.latest_offset_msec >= self.window_end_msec
+        return self.buffer_has_enough_samples()
+
+    def match_next_window(self):
+        """
+        Matches the oldest complete window, the unit of work the server schedules.
+        """
+        if self.config.dtype == FINGERPRINTS_DTYPE:
+            self.perform_fingerprint_window_matching()
+        else:
             self.perform_chunk_matching()
 
-    def buffer_has_enough_bytes(self) -> bool:
-        required_bytes = math.ceil(self.config.chunk_time_msec / 1000) * self.config.in_sample_rate * self.sample_size
-        return len(self.bytes_buffer) >= required_bytes
+    def buffer_has_enough_samples(self) -> bool:
+        return len(self.samples) >= self.window_samples
 
     def perform_chunk_matching(self):
-        chunk_bytes = self.bytes_buffer[:self.required_bytes()]
-        self.bytes_buffer = self.bytes_buffer[self.stride_bytes():]  # slide the window
+        chunk_data = self.samples.view(self.window_samples)  # no copy, valid until consumed
+        duration_sec = self.window_samples / self.config.target_sample_rate
 
-        chunk_data = np.frombuffer(chunk_bytes, dtype=self.config.dtype)
-        
-        # Downmix to mono if needed
-        if chunk_data.ndim == 2:
-            chunk_data = np.mean(chunk_data, axis=1)
+        preprocessed = PreprocessedAudio(chunk_data, self.config.target_sample_rate, duration_sec)
 
-        duration_sec = len(chunk_data) / self.config.in_sample_rate
+        matches = get_audio_matches(self.lookup, preprocessed, self.config.topn, self.config.aggregate_in_db, self.config.hash_scheme)
 
-        # Resample if needed
-        if self.config.in_sample_rate != self.config.target_sample_rate:
-            num_samples = int(duration_sec * self.config.target_sample_rate)
-            chunk_data = resample(chunk_data, num_samples)
+        self.samples.consume(self.stride_samples)  # slide the window
 
-        preprocessed = PreprocessedAudio(chunk_data, self.config.target_sample_rate, duration_sec)
+        self.add_window_matches(matches, duration_sec)
 
-        matches = get_audio_matches(self.db, preprocessed, self.config.topn)
+    def push_fingerprints(self, data: bytes):
+        """
+        Takes a batch of (hash, offset) pairs computed by the client with the same
+        parameters as `fingerprint.fingerprinting`, offsets counted in msec from the
+        start of the stream. They are matched in the same sliding windows as audio,
+        by `match_next_window`. Offsets before the stream or more than
+        MAX_OFFSET_LEAD_MSEC past its elapsed time are dropped.
+        """
 
+        if self.is_match_found:
+            return
+
+        pair_size = 2 * self.pair_dtype.itemsize
+        pairs = np.frombuffer(data, dtype=self.pair_dtype, count=2 * (len(data) // pair_size)).reshape(-1, 2)
+        max_offset = (time.monotonic() - self.started_at) * 1000 + MAX_OFFSET_LEAD_MSEC
+        valid = (pairs[:, 1] >= 0) & (pairs[:, 1] <= max_offset)
+        self.dropped_pairs += len(pairs) - int(valid.sum())
+        pairs = pairs[valid]
+        if len(pairs) == 0:
+            return
+
+        self.fingerprints = np.concatenate((self.fingerprints, pairs))
+        self.latest_offset_msec = max(self.latest_offset_msec, int(pairs[:, 1].max()))
+
+    def perform_fingerprint_window_matching(self):
+        window_start = self.window_end_msec - self.config.chunk_time_msec
+        offsets = self.fingerprints[:, 1]
+        window = self.fingerprints[(offsets >= window_start) & (offsets < self.window_end_msec)]
+
+        if len(window) == 0:
+            # silence or a gap, move on to the first window holding the next pair
+            later = offsets[offsets >= self.window_end_msec]
+            strides = 1
+            if len(later) > 0:
+                strides = max(1, -(-(int(later.min()) + 1 - self.window_end_msec) // self.config.stride_msec))
+            self.window_end_msec += strides * self.config.stride_msec
+            self.fingerprints = self.fingerprints[offsets >= self.window_end_msec - self.config.chunk_time_msec]
+            return
 
-        for song_id, score in matches:
+        # query times relative to the window start, like fingerprints of an audio window
+        fingerprints = [(int(h), int(t) - window_start) for h, t in window]
+        matches = get_fingerprint_matches(self.lookup, fingerprints, self.config.topn, self.config.aggregate_in_db)
+
+        self.window_end_msec += self.config.stride_msec
+        self.fingerprints = self.fingerprints[offsets >= self.window_end_msec - self.config.chunk_time_msec]
+
+        self.add_window_matches(matches, self.config.chunk_time_msec / 1000)
+
+    def add_window_matches(self, matches, duration_sec: float):
+        now = time.time()
+        for song_id, score, offset in matches:
             self.results[song_id] += score
+            # the window ends at the latest audio we received, i.e. roughly now
+            self.song_started_at[song_id] = now - (offset / 1000 + duration_sec)
 
         self.check_if_results_ready()
 
@@ -87,9 +181,21 @@ class SongIdSession:
 
         if top1[1] > 30 or (top1[1] > 20 and score_gap > 10):
             self.is_match_found = True
+        elif self.recent_hits is not None and top1[1] > RECENT_HIT_MIN_SCORE and score_gap > RECENT_HIT_MIN_GAP:
+            self.is_match_found = self.recent_hits.is_recent(top1[0], self.song_started_at[top1[0]])
+
+        if self.is_match_found and self.recent_hits is not None:
+            self.recent_hits.record(top1[0], self.song_started_at[top1[0]])
+
+    def _decode(self, bytes_chunk: bytearray) -> np.ndarray:
+        if self.leftover_bytes:
+            bytes_chunk = self.leftover_bytes + bytes_chunk
+
+        num_samples = len(bytes_chunk) // self.sample_size
+        self.leftover_bytes = bytes(bytes_chunk[num_samples * self.sample_size:])
 
-    def required_bytes(self):
-        return math.ceil(self.config.chunk_time_msec / 1000) * self.config.in_sample_rate * self.sample_size
+        chunk_data = np.frombuffer(bytes_chunk, dtype=self.config.dtype, count=num_samples)
+        return self.resampler.process(chunk_data)
 
-    def stride_bytes(self):
-        return math.ceil(self.config.stride_msec / 1000) * self.config.in_sample_rate * self.sample_size
+    def _msec_to_samples(self, msec: int) -> int:
+        return round(msec * self.config.target_sample_rate / 1000)
@@ -0,0 +1,140 @@
+import argparse
+from collections import Counter
+import os
+import random
+from time import perf_counter
+
+import audiofile
+import numpy as np
+from prettytable import PrettyTable
+from scipy.signal import resample
+from tqdm import tqdm
+
+from config.constants import DEFAULT_SAMPLE_RATE, HOP_SIZE, WINDOW_SIZE
+from fingerprint.fingerprinting import generate_fingerprints
+from preprocessing.audio_preprocessing import PreprocessedAudio
+from preprocessing.decoders import DECODERS, suppress_output
+
+audio_file_extensions = ('mp3', 'm4a', 'flac', 'ogg', 'wav')
+
+# The excerpt matched against the reference fingerprints starts at this share of the song
+EXCERPT_START = 0.3
+
+
+def _decode_reference(path: str) -> np.ndarray:
+    """
+    Decoding before the decoders module: audiofile at the native rate and FFT
+    resampling of the whole signal. Existing indexes were built with it.
+    """
+    with suppress_output():
+        signal, rate = audiofile.read(path)
+    if signal.ndim > 1:
+        signal = signal.mean(axis=0)
+    if rate != DEFAULT_SAMPLE_RATE:
+        signal = resample(signal, int(signal.shape[0] / rate * DEFAULT_SAMPLE_RATE))
+    return signal
+
+
+def _fingerprints(signal: np.ndarray):
+    signal = signal / np.max(np.abs(signal))
+    return generate_fingerprints(PreprocessedAudio(signal, DEFAULT_SAMPLE_RATE, len(signal) / DEFAULT_SAMPLE_RATE), WINDOW_SIZE, HOP_SIZE)
+
+
+def _excerpt_votes(signal: np.ndarray, reference: dict, excerpt_sec: float) -> int:
+    """
+    Hashes of an excerpt that line up at the best offset in the reference
+    fingerprints, what matching counts for the song.
+    """
+    start = int(len(signal) * EXCERPT_START)
+    excerpt = signal[start:start + int(excerpt_sec * DEFAULT_SAMPLE_RATE)]
+    offsets = Counter(t - query_time for h, query_time in _fingerprints(excerpt) for t in reference.get(h, ()))
+    return offsets.most_common(1)[0][1] if offsets else 0
+
+
+def run(paths, repeats: int, excerpt_sec: float):
+    decoders = dict([('reference', _decode_reference)] + [(name, d) for name, d in DECODERS.items() if d.is_available()])
+    unavailable = [name for name, d in DECODERS.items() if not d.is_available()]
+    if unavailable:
+        print(f"Not available here: {', '.join(unavailable)}")
+
+    # format -> decoder -> [files, seconds of audio, decode seconds, shared fingerprints, reference fingerprints, votes, reference votes]
+    totals = dict()
+
+    for path in tqdm(paths, desc="Decoding", unit="song"):
+        extension = os.path.splitext(path)[1].lstrip('.').lower()
+        try:
+            reference_signal = _decode_reference(path)
+        except Exception as e:
+            print(f"Skipping {path}: {e}")
+            continue
+
+        reference_fingerprints = _fingerprints(reference_signal)
+        reference = dict()
+        for h, t in reference_fingerprints:
+            reference.setdefault(h, []).append(t)
+        reference_set = set(reference_fingerprints)
+        reference_votes = _excerpt_votes(reference_signal, reference, excerpt_sec)
+
+        for name, decoder in decoders.items():
+            if name != 'reference' and not decoder.can_decode(extension):
+                continue
+            decode = decoder if name == 'reference' else lambda p: decoder.decode(p, DEFAULT_SAMPLE_RATE)
+
+            best = None
+            try:
+                for _ in range(repeats):
+                    start = perf_counter()
+                    signal = decode(path)
+                    elapsed = perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+            except Exception as e:
+                print(f"{name} could not decode {path}: {e}")
+                continue
+
+            shared = len(reference_set.intersection(_fingerprints(signal)))
+            row = totals.setdefault(extension, dict()).setdefault(name, [0, 0.0, 0.0, 0, 0, 0, 0])
+            for i, v in enumerate([1, len(signal) / DEFAULT_SAMPLE_RATE, best, shared, len(reference_set),
+                                   _excerpt_votes(signal, reference, excerpt_sec), reference_votes]):
+                row[i] += v
+
+    table = PrettyTable(['Format', 'Decoder', 'Files', 'Audio (min)', 'Decode + resample (x realtime)', 'Shared fingerprints', 'Excerpt votes'])
+    fastest = dict()
+    for extension, rows in sorted(totals.items()):
+        for name, (files, audio_sec, decode_sec, shared, reference_total, votes, reference_votes) in rows.items():
+            speed = audio_sec / max(decode_sec, 1e-9)
+            if name != 'reference' and speed > fastest.get(extension, (None, 0))[1]:
+                fastest[extension] = (name, speed)
+            table.add_row([
+                extension, name, files, round(audio_sec / 60, 1), round(speed),
+                f"{shared / max(1, reference_total) * 100:.1f}%", f"{votes / max(1, reference_votes) * 100:.1f}%"
+            ])
+
+    print(table)
+    print("Shared fingerprints and excerpt votes are relative to the reference decoding, which existing indexes were built with")
+    print("Fastest per format: " + ", ".join(f"{extension} {name}" for extension, (name, _) in sorted(fastest.items())))
+
+
+def _get_paths(paths):
+    song_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                song_paths.extend(os.path.join(root, f) for f in file_names if f.lower().endswith(audio_file_extensions))
+        else:
+            song_paths.append(path)
+    return song_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Decoder Comparison')
+    parser.add_argument('songs', type=str, nargs='+', help='Audio files, or directories containing them')
+    parser.add_argument('--sample', type=int, help='Use a random sample of this many songs')
+    parser.add_argument('--repeats', type=int, default=3, help='Decode every file this many times and keep the fastest')
+    parser.add_argument('--excerpt-sec', type=float, default=10)
+    args = parser.parse_args()
+
+    paths = _get_paths(args.songs)
+    if args.sample is not None and args.sample < len(paths):
+        paths = random.sample(paths, args.sample)
+
+    run(paths, args.repeats, args.excerpt_sec)
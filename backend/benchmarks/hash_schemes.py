@@ -0,0 +1,152 @@
+import argparse
+import os
+import random
+from time import perf_counter
+
+import numpy as np
+from prettytable import PrettyTable
+from tqdm import tqdm
+
+from config.constants import DEFAULT_SAMPLE_RATE, HOP_SIZE, WINDOW_SIZE
+from fingerprint.fingerprinting import generate_fingerprints
+from fingerprint.hashing import HASH_SCHEMES
+from matching.matching import get_fingerprint_matches
+from preprocessing.audio_preprocessing import PreprocessedAudio, preprocess_audio_file
+
+audio_file_extensions = ('mp3', 'm4a', 'flac', 'ogg', 'wav')
+
+# Postgres row costs used for the size estimate. A fingerprints heap row is a
+# 24 byte tuple header plus the columns padded to 8 bytes and a 4 byte line
+# pointer, which is 44 bytes for INT and BIGINT hashes alike. The deduplicated
+# B-tree on hash stores every distinct key once (8 byte header, key padded to
+# 8, line pointer) and a 6 byte heap pointer per further row.
+HEAP_ROW_BYTES = 44
+BTREE_KEY_BYTES = 20
+BTREE_DUPLICATE_BYTES = 6
+
+
+class _MemoryIndex:
+    """
+    Hash-sorted arrays with the same lookup as MappedIndex, kept in memory so
+    the schemes can be compared without a database.
+    """
+
+    def __init__(self, fingerprints_by_song):
+        rows = [(h, t, song_id) for song_id, fingerprints in fingerprints_by_song.items() for h, t in fingerprints]
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1, 3)
+        rows = rows[np.argsort(rows[:, 0], kind='stable')]
+        self.keys, self.times, self.song_ids = rows[:, 0], rows[:, 1], rows[:, 2]
+        self.rows_returned = 0
+
+    def find_matches(self, hashes):
+        query = np.unique(np.asarray(hashes, dtype=np.int64))
+        lo = np.searchsorted(self.keys, query, side='left')
+        hi = np.searchsorted(self.keys, query, side='right')
+
+        lengths = hi - lo
+        total = int(lengths.sum())
+        self.rows_returned += total
+        if total == 0:
+            return []
+
+        idx = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        return list(zip(self.keys[idx].tolist(), self.times[idx].tolist(), self.song_ids[idx].tolist()))
+
+
+def _posting_stats(index: _MemoryIndex):
+    _, counts = np.unique(index.keys, return_counts=True)
+    counts = counts.astype(np.float64)
+    num_rows = len(index.keys)
+    return {
+        'distinct': len(counts),
+        'mean': num_rows / max(1, len(counts)),
+        # what a lookup of an indexed hash actually pays: lists weighted by how often they are hit
+        'weighted_mean': float((counts ** 2).sum() / max(1, counts.sum())),
+        'max': int(counts.max()) if len(counts) else 0,
+        'pg_bytes': num_rows * HEAP_ROW_BYTES + len(counts) * BTREE_KEY_BYTES + (num_rows - len(counts)) * BTREE_DUPLICATE_BYTES,
+    }
+
+
+def _make_queries(signals, num_queries: int, excerpt_sec: float, snr_db: float):
+    queries = []
+    excerpt_len = int(excerpt_sec * DEFAULT_SAMPLE_RATE)
+    for _ in range(num_queries):
+        song_id = random.choice(list(signals))
+        signal = signals[song_id]
+        start = random.randrange(max(1, len(signal) - excerpt_len))
+        excerpt = signal[start:start + excerpt_len]
+        if snr_db is not None:
+            noise_power = np.mean(excerpt ** 2) / (10 ** (snr_db / 10))
+            excerpt = excerpt + np.random.normal(0, np.sqrt(noise_power), len(excerpt))
+        queries.append((song_id, PreprocessedAudio(excerpt, DEFAULT_SAMPLE_RATE, len(excerpt) / DEFAULT_SAMPLE_RATE)))
+    return queries
+
+
+def run(paths, num_queries: int, excerpt_sec: float, snr_db: float, top_n: int):
+    signals = dict()
+    for song_id, path in enumerate(tqdm(paths, desc="Decoding", unit="song"), start=1):
+        try:
+            signals[song_id] = preprocess_audio_file(path).signal
+        except Exception as e:
+            print(f"Skipping {path}: {e}")
+
+    # the same excerpts are queried against every scheme
+    queries = _make_queries(signals, num_queries, excerpt_sec, snr_db)
+
+    table = PrettyTable(['Scheme', 'Rows', 'Distinct hashes', 'Mean list', 'Weighted mean list', 'Max list',
+                         'Est. PG size (MB)', 'Rows / query', 'Query p50 (ms)', 'Query p95 (ms)', 'Top-1 accuracy'])
+
+    for hash_scheme in HASH_SCHEMES:
+        fingerprints_by_song = {
+            song_id: generate_fingerprints(PreprocessedAudio(signal, DEFAULT_SAMPLE_RATE, len(signal) / DEFAULT_SAMPLE_RATE), WINDOW_SIZE, HOP_SIZE, hash_scheme)
+            for song_id, signal in tqdm(signals.items(), desc=f"Scheme {hash_scheme}", unit="song")
+        }
+        index = _MemoryIndex(fingerprints_by_song)
+        stats = _posting_stats(index)
+
+        latencies = []
+        correct = 0
+        for song_id, audio in queries:
+            fingerprints = generate_fingerprints(audio, WINDOW_SIZE, HOP_SIZE, hash_scheme)
+            start = perf_counter()
+            matches = get_fingerprint_matches(index, fingerprints, top_n)
+            latencies.append(perf_counter() - start)
+            if matches and matches[0][0] == song_id:
+                correct += 1
+
+        p50, p95 = np.percentile(latencies, [50, 95]) if latencies else (0, 0)
+        table.add_row([
+            hash_scheme, len(index.keys), stats['distinct'], round(stats['mean'], 2), round(stats['weighted_mean'], 2),
+            stats['max'], round(stats['pg_bytes'] / (1024 * 1024), 1), index.rows_returned // max(1, len(queries)),
+            round(p50 * 1000, 2), round(p95 * 1000, 2), f"{correct / max(1, len(queries)) * 100:.1f}%"
+        ])
+
+    print(table)
+
+
+def _get_paths(paths):
+    song_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                song_paths.extend(os.path.join(root, f) for f in file_names if f.lower().endswith(audio_file_extensions))
+        else:
+            song_paths.append(path)
+    return song_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Hash Scheme Comparison')
+    parser.add_argument('songs', type=str, nargs='+', help='Audio files, or directories containing them')
+    parser.add_argument('--sample', type=int, help='Use a random sample of this many songs')
+    parser.add_argument('--queries', type=int, default=200, help='Number of query excerpts')
+    parser.add_argument('--excerpt-sec', type=float, default=5)
+    parser.add_argument('--snr-db', type=float, help='Add white noise to the excerpts at this SNR')
+    parser.add_argument('--top-n', type=int, default=3)
+    args = parser.parse_args()
+
+    paths = _get_paths(args.songs)
+    if args.sample is not None and args.sample < len(paths):
+        paths = random.sample(paths, args.sample)
+
+    run(paths, args.queries, args.excerpt_sec, args.snr_db, args.top_n)
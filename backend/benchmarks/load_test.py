@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import os
+import random
+from time import perf_counter
+
+import audiofile
+import httpx
+import numpy as np
+import psutil
+from prettytable import PrettyTable
+from scipy.signal import resample_poly
+from termcolor import colored
+import websockets
+
+from preprocessing.decoders import suppress_output
+
+audio_file_extensions = ('mp3', 'm4a', 'flac', 'ogg', 'wav')
+
+
+@dataclass
+class Clip:
+    name: str
+    sample_rate: int
+    dtype: str
+    data: bytes
+
+    @property
+    def bytes_per_sec(self) -> int:
+        return self.sample_rate * (4 if self.dtype == 'float32' else 2)
+
+
+@dataclass
+class RequestResult:
+    clip: str
+    outcome: str            # 'success', 'failure' (server gave up), 'shed' (server busy), 'no_result', 'error'
+    latency_sec: float      # time to identification / response
+    detail: str = ''
+
+
+def load_clips(paths, sample_rates, dtypes, clip_sec: float):
+    """
+    Decodes every clip once and prepares a PCM variant per (sample rate, dtype),
+    the way a phone would send it.
+    """
+    clips = []
+    for path in paths:
+        with suppress_output():
+            signal, rate = audiofile.read(path, duration=clip_sec)
+        if signal.ndim > 1:
+            signal = signal.mean(axis=0)
+        signal = signal / max(np.max(np.abs(signal)), 1e-9)
+
+        for sample_rate in sample_rates:
+            resampled = resample_poly(signal, sample_rate, rate) if sample_rate != rate else signal
+            for dtype in dtypes:
+                if dtype == 'int16':
+                    data = (np.clip(resampled, -1, 1) * 32767).astype(np.int16).tobytes()
+                else:
+                    data = resampled.astype(np.float32).tobytes()
+                clips.append(Clip(os.path.basename(path), sample_rate, dtype, data))
+    return clips
+
+
+async def run_stream_client(url: str, clip: Clip, chunk_msec: int, speed: float, grace_sec: float) -> RequestResult:
+    chunk_size = clip.bytes_per_sec * chunk_msec // 1000
+    chunk_size -= chunk_size % (4 if clip.dtype == 'float32' else 2)
+
+    start = None
+    try:
+        async with websockets.connect(f"{url}/identify_song", max_size=None) as ws:
+            await ws.send(str(clip.sample_rate))
+            await ws.send(clip.dtype)
+
+            async def send_audio():
+                for i in range(0, len(clip.data), chunk_size):
+                    await ws.send(clip.data[i:i + chunk_size])
+                    if speed > 0:
+                        await asyncio.sleep(chunk_msec / 1000 / speed)
+
+            start = perf_counter()
+            sender = asyncio.create_task(send_audio())
+            receiver = asyncio.create_task(ws.recv())
+
+            await asyncio.wait([sender, receiver], return_when=asyncio.FIRST_COMPLETED)
+            if not receiver.done():
+                # the whole clip is sent, give the server a moment to finish matching
+                await asyncio.wait([receiver], timeout=grace_sec)
+            sender.cancel()
+            if sender.done() and not sender.cancelled():
+                sender.exception()  # the server closing the socket mid-send is expected
+
+            if not receiver.done():
+                receiver.cancel()
+                return RequestResult(clip.name, 'no_result', perf_counter() - start)
+
+            latency = perf_counter() - start
+            response = json.loads(receiver.result())
+            outcome = _outcome(response)
+            return RequestResult(clip.name, outcome, latency, response.get('title') or response.get('reason', ''))
+
+    except Exception as e:
+        latency = perf_counter() - start if start is not None else 0
+        return RequestResult(clip.name, 'error', latency, f"{type(e).__name__}: {e}")
+
+
+async def run_one_shot_client(http: httpx.AsyncClient, url: str, clip: Clip) -> RequestResult:
+    start = perf_counter()
+    try:
+        response = await http.post(
+            f"{url}/recognize_song_one_shot",
+            params={'sample_rate': clip.sample_rate, 'dtype': clip.dtype},
+            files={'file': ('clip.pcm', clip.data, 'application/octet-stream')}
+        )
+        latency = perf_counter() - start
+        if response.status_code not in (200, 503):
+            return RequestResult(clip.name, 'error', latency, f"HTTP {response.status_code}")
+        body = response.json()
+        outcome = _outcome(body)
+        return RequestResult(clip.name, outcome, latency, body.get('title') or body.get('reason', ''))
+    except Exception as e:
+        return RequestResult(clip.name, 'error', perf_counter() - start, f"{type(e).__name__}: {e}")
+
+
+def _outcome(response: dict) -> str:
+    if response.get('result') == 'success':
+        return 'success'
+    return 'shed' if response.get('reason') == 'busy' else 'failure'
+
+
+async def sample_cpu(pid: int, samples: list, interval_sec: float = 1.0):
+    """
+    Samples CPU usage of the server process and its children (uvicorn workers),
+    in percent of one core.
+    """
+    server = psutil.Process(pid)
+    procs = dict()
+    while True:
+        current = [server] + server.children(recursive=True)
+        total = 0.0
+        for p in current:
+            # the first call for a process only primes the counter
+            proc = procs.setdefault(p.pid, p)
+            try:
+                total += proc.cpu_percent(None)
+            except psutil.NoSuchProcess:
+                procs.pop(p.pid, None)
+        samples.append(total)
+        await asyncio.sleep(interval_sec)
+
+
+async def run_load_test(args, clips):
+    results = []
+    cpu_samples = []
+    cpu_task = asyncio.create_task(sample_cpu(args.server_pid, cpu_samples)) if args.server_pid else None
+
+    http = httpx.AsyncClient(timeout=args.grace + 60)
+    http_url = args.url.replace('ws://', 'http://').replace('wss://', 'https://')
+
+    async def one_request():
+        clip = random.choice(clips)
+        if args.mode == 'stream':
+            result = await run_stream_client(args.url, clip, args.chunk_msec, args.speed, args.grace)
+        else:
+            result = await run_one_shot_client(http, http_url, clip)
+        results.append(result)
+
+    start = perf_counter()
+    deadline = start + args.duration
+
+    if args.rate:
+        # open loop: new sessions arrive as a Poisson process regardless of how the server copes
+        pending = set()
+        while perf_counter() < deadline:
+            pending.add(asyncio.create_task(one_request()))
+            await asyncio.sleep(random.expovariate(args.rate))
+        await asyncio.gather(*pending)
+    else:
+        # closed loop: a fixed number of clients, each starting a new session when the last one ends
+        async def client_loop():
+            while perf_counter() < deadline:
+                await one_request()
+        await asyncio.gather(*[client_loop() for _ in range(args.clients)])
+
+    elapsed = perf_counter() - start
+
+    if cpu_task is not None:
+        cpu_task.cancel()
+    await http.aclose()
+
+    return results, elapsed, cpu_samples
+
+
+def print_report(results, elapsed: float, cpu_samples):
+    outcomes = ['success', 'failure', 'shed', 'no_result', 'error']
+    counts = {o: sum(1 for r in results if r.outcome == o) for o in outcomes}
+    total = max(1, len(results))
+
+    print(colored("\nLoad test complete", color='blue', attrs=['bold', 'underline']))
+    print(f"Requests:   {len(results)} in {elapsed:.1f}s ({len(results) / elapsed:.2f} req/s)")
+    print(f"Identified: {counts['success'] / elapsed:.2f} songs/s")
+    for o in outcomes:
+        print(f"  {o:10} {counts[o]:6}  ({counts[o] / total * 100:.1f}%)")
+
+    table = PrettyTable(['Outcome', 'p50 (s)', 'p95 (s)', 'p99 (s)', 'max (s)'])
+    for o in ('success', 'failure'):
+        latencies = [r.latency_sec for r in results if r.outcome == o]
+        if len(latencies) == 0:
+            continue
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        table.add_row([o, round(p50, 3), round(p95, 3), round(p99, 3), round(max(latencies), 3)])
+    print(table)
+
+    if cpu_samples:
+        print(f"Server CPU: mean {np.mean(cpu_samples):.0f}%, max {np.max(cpu_samples):.0f}% (100% = one core)")
+
+    errors = {}
+    for r in results:
+        if r.outcome == 'error':
+            errors[r.detail] = errors.get(r.detail, 0) + 1
+    if errors:
+        print(colored("Errors", 'red', attrs=['bold']))
+        for detail, count in sorted(errors.items(), key=lambda x: x[1], reverse=True)[:10]:
+            print(f"  {count:5}x {detail}")
+
+
+def _get_clip_paths(paths):
+    clip_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                clip_paths.extend(os.path.join(root, f) for f in file_names if f.lower().endswith(audio_file_extensions))
+        else:
+            clip_paths.append(path)
+    return clip_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Recognition Load Test')
+    parser.add_argument('clips', type=str, nargs='+', help='Prerecorded clips, or directories containing them')
+    parser.add_argument('--url', type=str, default='ws://localhost:8000', help='Server base url')
+    parser.add_argument('--mode', choices=['stream', 'one-shot'], default='stream', help='identify_song websocket or /recognize_song_one_shot')
+    parser.add_argument('--clients', '-c', type=int, default=10, help='Concurrent clients (closed loop)')
+    parser.add_argument('--rate', '-r', type=float, help='New sessions per second (open loop, overrides --clients)')
+    parser.add_argument('--duration', '-d', type=float, default=60, help='How long to generate load, in seconds')
+    parser.add_argument('--sample-rates', type=str, default='44100,48000', help='Comma separated client sample rates')
+    parser.add_argument('--dtypes', type=str, default='float32,int16', help='Comma separated client sample formats')
+    parser.add_argument('--clip-sec', type=float, default=15, help='Seconds of each clip to send')
+    parser.add_argument('--chunk-msec', type=int, default=100, help='Audio per websocket message')
+    parser.add_argument('--speed', type=float, default=1.0, help='Playback speed relative to real time, 0 sends as fast as possible')
+    parser.add_argument('--grace', type=float, default=10, help='Seconds to wait for a result after the clip is sent')
+    parser.add_argument('--server-pid', type=int, help='Sample CPU of this process and its children')
+    args = parser.parse_args()
+
+    sample_rates = [int(r) for r in args.sample_rates.split(',')]
+    dtypes = args.dtypes.split(',')
+
+    clips = load_clips(_get_clip_paths(args.clips), sample_rates, dtypes, args.clip_sec)
+    print(f"Prepared {len(clips)} clip variants")
+
+    results, elapsed, cpu_samples = asyncio.run(run_load_test(args, clips))
+    print_report(results, elapsed, cpu_samples)
@@ -0,0 +1,102 @@
+import argparse
+import random
+from time import perf_counter
+
+import numpy as np
+from prettytable import PrettyTable
+
+from config.constants import DEFAULT_SAMPLE_RATE, HOP_SIZE, WINDOW_SIZE
+from database.config import DB_NAME, DB_PASS, DB_USER
+from database.db import AppDatabase
+from fingerprint.fingerprinting import generate_fingerprints
+from matching.matching import get_fingerprint_matches
+from preprocessing.audio_preprocessing import PreprocessedAudio, preprocess_audio_file
+
+
+def _wire_bytes(rows) -> int:
+    """
+    Approximate size of result rows in the Postgres text protocol:
+    a 7 byte DataRow header plus a 4 byte length and the text of every field.
+    """
+    return sum(7 + sum(4 + len(str(v)) for v in row) for row in rows)
+
+
+class _RecordingDatabase:
+    """
+    Passes lookups through to the database and keeps the size of what came back.
+    """
+
+    def __init__(self, db: AppDatabase):
+        self.db = db
+        self.rows = 0
+        self.bytes = 0
+
+    def find_matches(self, hashes):
+        rows = self.db.find_matches(hashes)
+        self.rows += len(rows)
+        self.bytes += _wire_bytes(rows)
+        return rows
+
+    def find_top_matches(self, hashes, query_times, top_n, bin_size):
+        rows = self.db.find_top_matches(hashes, query_times, top_n, bin_size)
+        self.rows += len(rows)
+        self.bytes += _wire_bytes(rows)
+        return rows
+
+
+def run(db: AppDatabase, paths, excerpt_sec: float, repeats: int, top_n: int):
+    table = PrettyTable(['Clip', 'Query hashes', 'Path', 'Rows', 'KB received', 'Latency (ms)', 'Top song'])
+    totals = {False: [0, 0, 0.0], True: [0, 0, 0.0]}  # rows, bytes, seconds
+    mismatches = 0
+
+    for path in paths:
+        audio = preprocess_audio_file(path)
+        excerpt_len = int(excerpt_sec * DEFAULT_SAMPLE_RATE)
+        start = random.randrange(max(1, len(audio.signal) - excerpt_len))
+        excerpt = audio.signal[start:start + excerpt_len]
+        fingerprints = generate_fingerprints(PreprocessedAudio(excerpt, DEFAULT_SAMPLE_RATE, len(excerpt) / DEFAULT_SAMPLE_RATE), WINDOW_SIZE, HOP_SIZE, db.get_hash_scheme())
+
+        top_songs = dict()
+        for aggregate_in_db in (False, True):
+            recorder = _RecordingDatabase(db)
+            latencies = []
+            for _ in range(repeats):
+                begin = perf_counter()
+                matches = get_fingerprint_matches(recorder, fingerprints, top_n, aggregate_in_db)
+                latencies.append(perf_counter() - begin)
+
+            rows, num_bytes = recorder.rows // repeats, recorder.bytes // repeats
+            latency = float(np.median(latencies))
+            top_songs[aggregate_in_db] = matches[0][:2] if matches else None
+
+            totals[aggregate_in_db][0] += rows
+            totals[aggregate_in_db][1] += num_bytes
+            totals[aggregate_in_db][2] += latency
+
+            table.add_row([
+                path.split('/')[-1][:30], len(set(f[0] for f in fingerprints)),
+                'postgres' if aggregate_in_db else 'python',
+                rows, round(num_bytes / 1024, 1), round(latency * 1000, 1), top_songs[aggregate_in_db]
+            ])
+
+        if top_songs[False] != top_songs[True]:
+            mismatches += 1
+
+    print(table)
+    for aggregate_in_db, (rows, num_bytes, seconds) in totals.items():
+        name = 'postgres' if aggregate_in_db else 'python'
+        print(f"{name:9} total rows {rows:>10}, received {num_bytes / (1024 * 1024):8.2f} MB, latency sum {seconds * 1000:10.1f} ms")
+    print(f"Clips where the top (song, score) differs between paths: {mismatches}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Match Aggregation Benchmark')
+    parser.add_argument('clips', type=str, nargs='+', help='Audio files of indexed songs')
+    parser.add_argument('--excerpt-sec', type=float, default=5, help='Length of the query excerpt')
+    parser.add_argument('--repeats', type=int, default=5, help='Lookups per clip and path (median latency is reported)')
+    parser.add_argument('--top-n', type=int, default=3)
+    args = parser.parse_args()
+
+    db = AppDatabase(DB_NAME, DB_USER, DB_PASS)
+    run(db, args.clips, args.excerpt_sec, args.repeats, args.top_n)
+    db.close()
@@ -17,3 +17,9 @@ NEIGHBORHOOD_SIZE = (25, 25)
 # Number of target points (anchor pairs) created per peak.
 # More fanout means more robust matching but also increases hash count and database size.
 FANOUT = 10
+
+
+# Identifies the exact fingerprinting parameters above (plus the fixed peak picking,
+# pairing and hash layout in the fingerprint package, versioned by the leading number).
+# Clients that compute fingerprints themselves must send the same id.
+FINGERPRINT_PARAMS_ID = f"1-{DEFAULT_SAMPLE_RATE}-{WINDOW_SIZE}-{HOP_SIZE}-{NEIGHBORHOOD_SIZE[0]}x{NEIGHBORHOOD_SIZE[1]}-{FANOUT}"
@@ -1,10 +1,31 @@
+import contextlib
 import io
 import psycopg2
-from psycopg2.extras import execute_batch
+from psycopg2 import sql
+from psycopg2.extras import execute_batch, execute_values
+import numpy as np
 from typing import List, Tuple
 from itertools import batched
+from fingerprint.hashing import HASH_SCHEME_V1, is_wide_scheme
+from model.ingest_job import IngestJob
 from model.song import Song
 
+# Every write of fingerprints takes this advisory lock shared, a hash scheme
+# migration takes it exclusively until the new table is swapped in. Songs
+# ingested meanwhile wait for it instead of being left out of the new table.
+FINGERPRINT_WRITE_LOCK_KEY = 0x464D5357
+
+
+class HashSchemeChanged(Exception):
+    """
+    The fingerprints to store were hashed with another scheme than the index now uses.
+    """
+
+    def __init__(self, hash_scheme: int):
+        super().__init__(f"The index now uses hash scheme {hash_scheme}")
+        self.hash_scheme = hash_scheme
+
+
 class AppDatabase:
     def __init__(self, dbname, user, password, host='localhost', port=5432):
         self.conn = psycopg2.connect(
@@ -17,10 +38,14 @@ class AppDatabase:
         self.conn.autocommit = True
 
 
-    def create_tables(self):
-        return self._create_tables()
+    def create_tables(self, hash_scheme: int = None):
+        """
+        `hash_scheme` only applies when the index is created, an existing index
+        keeps its scheme (see database.maintenance migrate-hash).
+        """
+        return self._create_tables(hash_scheme or HASH_SCHEME_V1)
 
-    def _create_tables(self):
+    def _create_tables(self, hash_scheme: int):
         with self.conn.cursor() as cur:
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS songs (
@@ -34,32 +59,332 @@ class AppDatabase:
                 );
             """)
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS fingerprints (
-                    hash INT NOT NULL,
-                    time_offset_msec INT NOT NULL,
-                    song_id INTEGER REFERENCES songs(id)
+                ALTER TABLE songs ADD COLUMN IF NOT EXISTS canonical_id INTEGER REFERENCES songs(id) ON DELETE SET NULL;
+            """)
+            # bumped when the fingerprints of an existing song change (replace_song, delete_songs),
+            # a mapped index built before holds the old ones (see DeltaIndex)
+            cur.execute("""
+                CREATE SEQUENCE IF NOT EXISTS fingerprints_version_seq;
+                ALTER TABLE songs ADD COLUMN IF NOT EXISTS fingerprints_version BIGINT NOT NULL DEFAULT 0;
+                CREATE INDEX IF NOT EXISTS idx_songs_fingerprints_version ON songs(fingerprints_version) WHERE fingerprints_version > 0;
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS index_settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
                 );
             """)
+            # indexes created before the settings table existed are all v1
+            cur.execute("""
+                INSERT INTO index_settings (key, value)
+                SELECT 'hash_scheme', CASE WHEN to_regclass('fingerprints') IS NULL THEN %s ELSE %s END
+                ON CONFLICT (key) DO NOTHING;
+            """, (str(hash_scheme), str(HASH_SCHEME_V1)))
+        self._create_fingerprints_table('fingerprints', hash_scheme)
+        with self.conn.cursor() as cur:
             cur.execute("""
                 CREATE INDEX IF NOT EXISTS idx_fingerprint_hash ON fingerprints(hash);
             """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_fingerprint_song_id ON fingerprints(song_id);
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ingest_jobs (
+                    id SERIAL PRIMARY KEY,
+                    file_path TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'queued',
+                    song_id INTEGER,
+                    error TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+            """)
+            # columns for workers on several hosts (see indexing/distributed.py)
+            cur.execute("""
+                ALTER TABLE ingest_jobs
+                    ADD COLUMN IF NOT EXISTS run_id TEXT,
+                    ADD COLUMN IF NOT EXISTS worker TEXT,
+                    ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMPTZ;
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_ingest_jobs_queued ON ingest_jobs(id) WHERE status = 'queued';
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_ingest_jobs_running ON ingest_jobs(heartbeat_at) WHERE status = 'running';
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_ingest_jobs_run ON ingest_jobs(run_id, file_path);
+            """)
+
+    def _create_fingerprints_table(self, table: str, hash_scheme: int):
+        hash_type = 'BIGINT' if is_wide_scheme(hash_scheme) else 'INT'
+        with self.conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    hash {hash_type} NOT NULL,
+                    time_offset_msec INT NOT NULL,
+                    song_id INTEGER REFERENCES songs(id)
+                );
+            """)
+
+    def get_hash_scheme(self) -> int:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT value FROM index_settings WHERE key = 'hash_scheme';")
+            row = cur.fetchone()
+            return int(row[0]) if row is not None else HASH_SCHEME_V1
+
+    def create_migration_table(self, hash_scheme: int) -> str:
+        """
+        Creates an empty fingerprints table for re-fingerprinting the library
+        with another hash scheme while the current one keeps serving.
+        """
+        table = f"fingerprints_h{hash_scheme}"
+        with self.conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {table};")
+        self._create_fingerprints_table(table, hash_scheme)
+        return table
+
+    def create_import_table(self, hash_scheme: int) -> str:
+        """
+        Creates an empty fingerprints table without foreign key or indexes for
+        bulk loading a snapshot, they are added once at the end by `finish_import_table`.
+        """
+        table = 'fingerprints_import'
+        hash_type = 'BIGINT' if is_wide_scheme(hash_scheme) else 'INT'
+        with self.conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {table};")
+            cur.execute(f"""
+                CREATE TABLE {table} (
+                    hash {hash_type} NOT NULL,
+                    time_offset_msec INT NOT NULL,
+                    song_id INTEGER
+                );
+            """)
+        return table
+
+    def copy_fingerprint_arrays(self, table: str, hash_scheme: int, hashes: np.ndarray, times: np.ndarray, song_ids: np.ndarray):
+        """
+        Loads column arrays through binary COPY, which skips formatting and
+        parsing every value as text.
+        """
+        hash_dtype = '>i8' if is_wide_scheme(hash_scheme) else '>i4'
+        rows = np.empty(len(hashes), dtype=[
+            ('num_fields', '>i2'),
+            ('hash_len', '>i4'), ('hash', hash_dtype),
+            ('time_len', '>i4'), ('time', '>i4'),
+            ('song_id_len', '>i4'), ('song_id', '>i4'),
+        ])
+        rows['num_fields'] = 3
+        rows['hash_len'] = np.dtype(hash_dtype).itemsize
+        rows['time_len'] = rows['song_id_len'] = 4
+        rows['hash'] = hashes
+        rows['time'] = times
+        rows['song_id'] = song_ids
+
+        header = b'PGCOPY\n\xff\r\n\x00' + np.zeros(2, dtype='>i4').tobytes()  # flags, header extension length
+        trailer = np.array([-1], dtype='>i2').tobytes()
+        with self.conn.cursor() as cur:
+            cur.copy_expert(
+                f"COPY {table} (hash, time_offset_msec, song_id) FROM STDIN WITH (FORMAT binary);",
+                io.BytesIO(header + rows.tobytes() + trailer)
+            )
+
+    def finish_import_table(self, table: str, hash_scheme: int):
+        """
+        Validates the song ids of a loaded import table in one pass and swaps it in.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(f"ALTER TABLE {table} ADD FOREIGN KEY (song_id) REFERENCES songs(id);")
+            cur.execute(f"ANALYZE {table};")
+        self.swap_fingerprints_table(table, hash_scheme)
+
+    def swap_fingerprints_table(self, table: str, hash_scheme: int):
+        """
+        Indexes a table filled by a migration and atomically replaces the
+        fingerprints table with it.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute(f"CREATE INDEX idx_{table}_hash ON {table}(hash);")
+            cur.execute(f"CREATE INDEX idx_{table}_song_id ON {table}(song_id);")
+
+        with self.transaction():
+            with self.conn.cursor() as cur:
+                cur.execute("DROP TABLE fingerprints;")
+                cur.execute(f"ALTER TABLE {table} RENAME TO fingerprints;")
+                cur.execute(f"ALTER INDEX idx_{table}_hash RENAME TO idx_fingerprint_hash;")
+                cur.execute(f"ALTER INDEX idx_{table}_song_id RENAME TO idx_fingerprint_song_id;")
+                cur.execute("UPDATE index_settings SET value = %s WHERE key = 'hash_scheme';", (str(hash_scheme),))
+
+    @contextlib.contextmanager
+    def transaction(self, isolation_level: str = None):
+        """
+        Groups the statements in the block into one transaction, the connection
+        is otherwise in autocommit mode.
+        """
+        self.conn.autocommit = False
+        try:
+            with self.conn:  # commits on success, rolls back on exception
+                if isolation_level is not None:
+                    with self.conn.cursor() as cur:
+                        cur.execute(f"SET TRANSACTION ISOLATION LEVEL {isolation_level};")
+                yield
+        finally:
+            self.conn.autocommit = True
 
     def insert_song(self, song: Song) -> int:
         with self.conn.cursor() as cur:
             cur.execute("""
-                INSERT INTO songs (title, artist_name, album_name, duration_sec, file_path, sample_rate)
-                VALUES (%s, %s, %s, %s, %s, %s) RETURNING id;
-            """, (song.title, song.artist_name, song.album_name, song.duration_sec, song.file_path, song.sample_rate))
+                INSERT INTO songs (title, artist_name, album_name, duration_sec, file_path, sample_rate, canonical_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id;
+            """, (song.title, song.artist_name, song.album_name, song.duration_sec, song.file_path, song.sample_rate, song.canonical_id))
             return cur.fetchone()[0]
 
-    def insert_fingerprints(self, song_id: int, fingerprints: List[Tuple[int, int]]):
+    def insert_songs_with_ids(self, songs: List[Song]):
+        """
+        Inserts songs keeping their ids, e.g. from a snapshot, and moves the id
+        sequence past them.
+        """
+        with self.transaction():
+            with self.conn.cursor() as cur:
+                # links are set once every song exists, they can point to songs later in the list
+                execute_values(cur, """
+                    INSERT INTO songs (id, title, artist_name, album_name, file_path, duration_sec, sample_rate)
+                    VALUES %s;
+                """, [(s.id, s.title, s.artist_name, s.album_name, s.file_path, s.duration_sec, s.sample_rate) for s in songs], page_size=1000)
+                execute_values(cur, """
+                    UPDATE songs SET canonical_id = v.canonical_id
+                    FROM (VALUES %s) AS v(id, canonical_id)
+                    WHERE songs.id = v.id;
+                """, [(s.id, s.canonical_id) for s in songs if s.canonical_id is not None], page_size=1000)
+                cur.execute("SELECT setval(pg_get_serial_sequence('songs', 'id'), GREATEST(MAX(id), 1)) FROM songs;")
+
+    def insert_fingerprints(self, song_id: int, fingerprints: List[Tuple[int, int]], table: str = 'fingerprints'):
 
         with self.conn.cursor() as cur:
             buffer = io.StringIO()
             for hash_val, time_offset in fingerprints:
                 buffer.write(f"{hash_val}\t{time_offset}\t{song_id}\n")
             buffer.seek(0)
-            cur.copy_from(buffer, 'fingerprints', columns=('hash', 'time_offset_msec', 'song_id'))
+            cur.copy_from(buffer, table, columns=('hash', 'time_offset_msec', 'song_id'))
+
+    def insert_song_with_fingerprints(self, song: Song, fingerprints: List[Tuple[int, int]], hash_scheme: int = None) -> int:
+        """
+        Inserts the song and its fingerprints atomically, so a failure never
+        leaves a song with partial fingerprints behind. With `hash_scheme`,
+        raises HashSchemeChanged if the index uses another one by now.
+        """
+        with self.transaction():
+            self._begin_fingerprint_write(hash_scheme)
+            song_id = self.insert_song(song)
+            self.insert_fingerprints(song_id, fingerprints)
+        return song_id
+
+    def replace_song(self, song_id: int, song: Song, fingerprints: List[Tuple[int, int]], hash_scheme: int = None):
+        with self.transaction():
+            self._begin_fingerprint_write(hash_scheme)
+            with self.conn.cursor() as cur:
+                cur.execute("DELETE FROM fingerprints WHERE song_id = %s;", (song_id,))
+                cur.execute("""
+                    UPDATE songs
+                    SET title=%s, artist_name=%s, album_name=%s, duration_sec=%s, file_path=%s, sample_rate=%s, canonical_id=NULL,
+                        fingerprints_version=nextval('fingerprints_version_seq')
+                    WHERE id=%s;
+                """, (song.title, song.artist_name, song.album_name, song.duration_sec, song.file_path, song.sample_rate, song_id))
+            self.insert_fingerprints(song_id, fingerprints)
+
+    def delete_songs(self, song_ids: List[int], batch_size: int = 100) -> int:
+        """
+        Deletes songs and their fingerprints, one transaction per batch of songs
+        to keep lock time and WAL per transaction bounded.
+        A deleted song with duplicates that are kept hands its fingerprints to
+        the oldest of them, which the others are then linked to.
+        Returns the number of deleted fingerprints.
+        """
+        song_ids = list(song_ids)
+        deleted = 0
+        for batch in batched(song_ids, batch_size):
+            with self.transaction():
+                self._begin_fingerprint_write()
+                with self.conn.cursor() as cur:
+                    self._promote_duplicates(cur, list(batch), song_ids)
+                    cur.execute("DELETE FROM fingerprints WHERE song_id = ANY(%s);", (list(batch),))
+                    deleted += cur.rowcount
+                    cur.execute("DELETE FROM songs WHERE id = ANY(%s);", (list(batch),))
+        return deleted
+
+    def _promote_duplicates(self, cur, song_ids: List[int], deleting: List[int]):
+        # otherwise ON DELETE SET NULL leaves the duplicates without fingerprints and compact removes them
+        cur.execute("""
+            SELECT DISTINCT ON (canonical_id) canonical_id, id
+            FROM songs
+            WHERE canonical_id = ANY(%s) AND NOT id = ANY(%s)
+            ORDER BY canonical_id, id;
+        """, (song_ids, deleting))
+        for canonical_id, heir_id in cur.fetchall():
+            cur.execute("UPDATE fingerprints SET song_id = %s WHERE song_id = %s;", (heir_id, canonical_id))
+            cur.execute("UPDATE songs SET canonical_id = NULLIF(%s, id) WHERE canonical_id = %s;", (heir_id, canonical_id))
+            cur.execute("UPDATE songs SET fingerprints_version = nextval('fingerprints_version_seq') WHERE id = %s;", (heir_id,))
+
+    def _begin_fingerprint_write(self, hash_scheme: int = None):
+        # inside a transaction, waits while a migration runs
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock_shared(%s);", (FINGERPRINT_WRITE_LOCK_KEY,))
+        if hash_scheme is not None:
+            current = self.get_hash_scheme()
+            if current != hash_scheme:
+                raise HashSchemeChanged(current)
+
+    def lock_fingerprint_writes(self):
+        """
+        Waits for fingerprint writes in progress and holds back new ones until
+        unlock_fingerprint_writes or until the connection closes.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s);", (FINGERPRINT_WRITE_LOCK_KEY,))
+
+    def unlock_fingerprint_writes(self):
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s);", (FINGERPRINT_WRITE_LOCK_KEY,))
+
+    def get_songs_without_fingerprints(self) -> List[int]:
+        """
+        Songs that can never be matched, including duplicates whose canonical
+        song was deleted. Duplicates linked to a canonical song are kept.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT s.id FROM songs s
+                WHERE s.canonical_id IS NULL
+                  AND NOT EXISTS (SELECT 1 FROM fingerprints f WHERE f.song_id = s.id);
+            """)
+            return [row[0] for row in cur.fetchall()]
+
+    def compact(self, full: bool = False):
+        """
+        Reclaims space left by deletes and rebuilds the hash index.
+        `full` rewrites the whole table (VACUUM FULL) and locks it meanwhile,
+        otherwise the index is rebuilt concurrently and lookups keep working.
+        """
+        with self.conn.cursor() as cur:
+            if full:
+                cur.execute("VACUUM (FULL, ANALYZE) fingerprints;")
+            else:
+                cur.execute("VACUUM (ANALYZE) fingerprints;")
+                cur.execute("REINDEX INDEX CONCURRENTLY idx_fingerprint_hash;")
+            cur.execute("VACUUM (ANALYZE) songs;")
+
+    def get_table_sizes(self) -> dict:
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT pg_table_size('fingerprints'), pg_indexes_size('fingerprints'), pg_total_relation_size('songs');
+            """)
+            fingerprints_table, fingerprints_indexes, songs = cur.fetchone()
+            return {
+                'fingerprints_table': fingerprints_table,
+                'fingerprints_indexes': fingerprints_indexes,
+                'songs': songs
+            }
 
     def find_matches(self, hashes: List[int]) -> List[Tuple[int, float, int]]:
         with self.conn.cursor() as cur:
@@ -71,6 +396,33 @@ class AppDatabase:
             cur.execute(query, (hashes,))
             return cur.fetchall()
         
+    def find_top_matches(self, hashes: List[int], query_times: List[int], top_n: int, bin_size: int) -> List[Tuple[int, int, int]]:
+        """
+        Votes server-side: joins the query (hash, query_time) pairs with the
+        fingerprints, builds each song's histogram of binned offsets and
+        returns the top songs as (song_id, score, offset) with the peak's
+        vote count and offset.
+        """
+        with self.conn.cursor() as cur:
+            query = """
+                SELECT song_id, votes, delta FROM (
+                    SELECT DISTINCT ON (song_id) song_id, votes, delta
+                    FROM (
+                        SELECT f.song_id,
+                               FLOOR((f.time_offset_msec - q.query_time)::float8 / %(bin_size)s)::int * %(bin_size)s AS delta,
+                               COUNT(*) AS votes
+                        FROM unnest(%(hashes)s::bigint[], %(query_times)s::int[]) AS q(hash, query_time)
+                        JOIN fingerprints f ON f.hash = q.hash
+                        GROUP BY f.song_id, delta
+                    ) histogram
+                    ORDER BY song_id, votes DESC
+                ) peaks
+                ORDER BY votes DESC
+                LIMIT %(top_n)s;
+            """
+            cur.execute(query, {'hashes': hashes, 'query_times': query_times, 'bin_size': bin_size, 'top_n': top_n})
+            return cur.fetchall()
+
     def get_song(self, song_id: int) -> Song | None:
         with self.conn.cursor() as cur:
             query = """
@@ -91,10 +443,19 @@ class AppDatabase:
                 result[3],
                 result[4],
                 result[5],
-                result[6]
+                result[6],
+                result[7]
             )
             return song
         
+    def get_all_songs(self) -> List[Song]:
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, title, artist_name, album_name, file_path, duration_sec, sample_rate, canonical_id
+                FROM songs ORDER BY id;
+            """)
+            return [Song(*row) for row in cur.fetchall()]
+
     def get_number_of_songs(self) -> int:
         with self.conn.cursor() as cur:
             query = """
@@ -104,6 +465,214 @@ class AppDatabase:
             cur.execute(query)
             return cur.fetchone()[0]
         
+    def get_number_of_fingerprints(self) -> int:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM fingerprints;")
+            return cur.fetchone()[0]
+
+    def get_max_song_id(self) -> int:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM songs;")
+            return cur.fetchone()[0]
+
+    def iter_fingerprints_by_hash(self, batch_size: int):
+        """
+        Streams all fingerprints ordered by hash through a server-side cursor.
+        Must be called inside `transaction()`.
+        """
+        with self.conn.cursor(name='fingerprints_by_hash') as cur:
+            cur.itersize = batch_size
+            cur.execute("SELECT hash, time_offset_msec, song_id FROM fingerprints ORDER BY hash;")
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                yield rows
+
+    def get_song_ids(self) -> List[int]:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT id FROM songs;")
+            return [row[0] for row in cur.fetchall()]
+
+    def get_fingerprints_version(self) -> int:
+        """
+        Latest fingerprints_version of any song, 0 if no song was ever replaced.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT COALESCE(MAX(fingerprints_version), 0) FROM songs;")
+            return cur.fetchone()[0]
+
+    def get_songs_updated_since(self, fingerprints_version: int) -> List[Tuple[int, int]]:
+        """
+        (song id, fingerprints version) of the songs whose fingerprints changed after that version.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT id, fingerprints_version FROM songs WHERE fingerprints_version > %s;", (fingerprints_version,))
+            return cur.fetchall()
+
+    def get_fingerprints_of_songs(self, song_ids: List[int]) -> List[Tuple[int, int, int]]:
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT hash, time_offset_msec, song_id
+                FROM fingerprints
+                WHERE song_id = ANY(%s);
+            """, (song_ids,))
+            return cur.fetchall()
+
+    def create_ingest_jobs(self, file_paths: List[str], run_id: str = None) -> List[int]:
+        """
+        Queues the files, for a named run only those not already part of it.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO ingest_jobs (file_path, run_id)
+                SELECT p, %(run_id)s FROM unnest(%(paths)s::text[]) AS p
+                WHERE %(run_id)s::text IS NULL
+                   OR NOT EXISTS (SELECT 1 FROM ingest_jobs j WHERE j.run_id = %(run_id)s AND j.file_path = p)
+                RETURNING id;
+            """, {'paths': file_paths, 'run_id': run_id})
+            return [row[0] for row in cur.fetchall()]
+
+    def get_ingest_job(self, job_id: int) -> IngestJob | None:
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, file_path, status, song_id, error, EXTRACT(EPOCH FROM created_at), EXTRACT(EPOCH FROM updated_at),
+                       run_id, worker, attempts
+                FROM ingest_jobs
+                WHERE id = %s;
+            """, (job_id,))
+            row = cur.fetchone()
+            return IngestJob(*row[:5], float(row[5]), float(row[6]), *row[7:]) if row is not None else None
+
+    def claim_ingest_jobs(self, limit: int, worker: str, run_id: str = None) -> List[Tuple[int, str]]:
+        """
+        Marks up to `limit` queued jobs as running by `worker` and returns their
+        (id, file_path). Rows locked by another worker's claim are skipped, so
+        any number of workers can claim concurrently without waiting.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingest_jobs
+                SET status = 'running', worker = %(worker)s, attempts = attempts + 1, heartbeat_at = now(), updated_at = now()
+                WHERE id IN (
+                    SELECT id FROM ingest_jobs
+                    WHERE status = 'queued' AND (%(run_id)s::text IS NULL OR run_id = %(run_id)s)
+                    ORDER BY id
+                    LIMIT %(limit)s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, file_path;
+            """, {'limit': limit, 'worker': worker, 'run_id': run_id})
+            return sorted(cur.fetchall())
+
+    def heartbeat_ingest_jobs(self, job_ids: List[int], worker: str):
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingest_jobs SET heartbeat_at = now()
+                WHERE id = ANY(%s) AND worker = %s AND status = 'running';
+            """, (job_ids, worker))
+
+    def finish_ingest_job(self, job_id: int, worker: str, status: str, song_id: int = None, error: str = None):
+        # a job reclaimed from a worker presumed dead belongs to its new worker
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingest_jobs SET status = %s, song_id = %s, error = %s, updated_at = now()
+                WHERE id = %s AND worker = %s AND status = 'running';
+            """, (status, song_id, error, job_id, worker))
+
+    def retry_ingest_job(self, job_id: int, worker: str, error: str, max_attempts: int):
+        """
+        Queues a failed job again unless it has used up its attempts.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingest_jobs
+                SET status = CASE WHEN attempts < %s THEN 'queued' ELSE 'failed' END, error = %s, updated_at = now()
+                WHERE id = %s AND worker = %s AND status = 'running';
+            """, (max_attempts, error, job_id, worker))
+
+    def release_ingest_jobs(self, worker: str) -> int:
+        """
+        Queues the running jobs of a worker that is stopping, without counting the attempt.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingest_jobs SET status = 'queued', attempts = GREATEST(attempts - 1, 0), updated_at = now()
+                WHERE worker = %s AND status = 'running';
+            """, (worker,))
+            return cur.rowcount
+
+    def requeue_abandoned_ingest_jobs(self, stale_after_sec: float, max_attempts: int) -> Tuple[int, int]:
+        """
+        Takes back running jobs whose worker stopped sending heartbeats.
+        Returns the number of jobs queued again and failed for good.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingest_jobs
+                SET status = CASE WHEN attempts < %(max_attempts)s THEN 'queued' ELSE 'failed' END,
+                    error = 'worker stopped responding', updated_at = now()
+                WHERE status = 'running' AND heartbeat_at < now() - make_interval(secs => %(stale)s)
+                RETURNING status;
+            """, {'max_attempts': max_attempts, 'stale': stale_after_sec})
+            statuses = [row[0] for row in cur.fetchall()]
+            return statuses.count('queued'), statuses.count('failed')
+
+    def requeue_failed_ingest_jobs(self, run_id: str = None) -> int:
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                UPDATE ingest_jobs SET status = 'queued', attempts = 0, error = NULL, updated_at = now()
+                WHERE status = 'failed' AND (%(run_id)s::text IS NULL OR run_id = %(run_id)s);
+            """, {'run_id': run_id})
+            return cur.rowcount
+
+    def get_ingest_progress(self, run_id: str = None) -> dict:
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT status, COUNT(*) FROM ingest_jobs
+                WHERE %(run_id)s::text IS NULL OR run_id = %(run_id)s
+                GROUP BY status;
+            """, {'run_id': run_id})
+            return dict(cur.fetchall())
+
+    def get_ingest_throughput(self, window_sec: float, run_id: str = None) -> List[Tuple[str, int, int, int, float]]:
+        """
+        Per host: (host, workers, jobs finished in the window, jobs running,
+        seconds since the last heartbeat).
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT split_part(worker, ':', 1) AS host,
+                       COUNT(DISTINCT worker) FILTER (WHERE status = 'running' OR updated_at > now() - make_interval(secs => %(window)s)),
+                       COUNT(*) FILTER (WHERE status <> 'running' AND updated_at > now() - make_interval(secs => %(window)s)),
+                       COUNT(*) FILTER (WHERE status = 'running'),
+                       EXTRACT(EPOCH FROM now() - MAX(heartbeat_at))
+                FROM ingest_jobs
+                WHERE worker IS NOT NULL AND (%(run_id)s::text IS NULL OR run_id = %(run_id)s)
+                GROUP BY host
+                ORDER BY host;
+            """, {'window': window_sec, 'run_id': run_id})
+            return [(host, workers, done, running, float(idle)) for host, workers, done, running, idle in cur.fetchall()]
+
+    def create_database(self, name: str) -> bool:
+        """
+        Creates an empty database on this server, unless it exists. Returns whether it was created.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s;", (name,))
+            if cur.fetchone() is not None:
+                return False
+            cur.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(name)))
+            return True
+
+    def try_advisory_lock(self, key: int) -> bool:
+        """
+        Session-level lock, held until it is released or the connection closes.
+        """
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s);", (key,))
+            return cur.fetchone()[0]
+
     def get_song_id(self, title, artist, album) -> int:
         with self.conn.cursor() as cur:
             query = """
@@ -0,0 +1,164 @@
+import threading
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from database.db import AppDatabase
+from database.mapped_index import MappedIndex
+
+
+class DeltaIndex:
+    """
+    Serves lookups from a MappedIndex plus an in-memory, append-only segment
+    with the songs added to the database since that index was built.
+
+    A background thread polls the songs table and loads the fingerprints of
+    songs the main index does not have yet, or has with fingerprints that
+    changed since it was built (maintenance replace, see fingerprints_version).
+    Once a rebuilt main index that contains them is live they are dropped from
+    the segment again, as are songs deleted from the database. Deleted and
+    replaced songs are filtered out of the main index's matches until a
+    rebuild has their current fingerprints.
+
+    The poll also reads the hash scheme of the database. While the main index
+    was built with another one (after maintenance migrate-hash, until it is
+    rebuilt) lookups go to the database instead.
+    """
+
+    def __init__(self, main: MappedIndex, db_factory: Callable[[], AppDatabase], poll_interval_sec: float = 2):
+        self.main = main
+        self.db_factory = db_factory
+        self.poll_interval_sec = poll_interval_sec
+
+        empty = np.empty(0, dtype=np.int64)
+        self._segment = (empty, empty, empty)  # hash-sorted (hashes, times, song_ids)
+        self._segment_songs = dict()  # song id -> fingerprints version it was loaded at
+        self._deleted_songs = frozenset()  # in the main index, no longer in the database
+        self._replaced_songs = frozenset()  # in the main index with old fingerprints, served from the segment
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.hash_scheme = None     # of the database, known after the first poll
+        self._fallback_db = None    # serves lookups while the main index has another scheme
+
+    def start(self):
+        self._thread = threading.Thread(target=self._poll_loop, name='delta-index', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._fallback_db is not None:
+            self._fallback_db.close()
+
+    @property
+    def is_stale(self) -> bool:
+        """
+        Whether the main index has another hash scheme than the database and needs a rebuild.
+        """
+        return self.hash_scheme is not None and self.main.hash_scheme != self.hash_scheme
+
+    def stats(self) -> dict:
+        return {
+            'songs': len(self._segment_songs),
+            'fingerprints': len(self._segment[0]),
+            'deleted': len(self._deleted_songs),
+            'replaced': len(self._replaced_songs),
+            'stale': self.is_stale,
+        }
+
+    def find_matches(self, hashes: List[int]) -> List[Tuple[int, int, int]]:
+        fallback_db = self._fallback_db
+        if fallback_db is not None and self.is_stale:
+            return fallback_db.find_matches(hashes)
+
+        matches = self.main.find_matches(hashes)
+        deleted, replaced = self._deleted_songs, self._replaced_songs
+        if deleted or replaced:
+            matches = [m for m in matches if m[2] not in deleted and m[2] not in replaced]
+
+        keys, times, song_ids = self._segment
+        if len(keys) == 0:
+            return matches
+
+        query = np.unique(np.asarray(hashes, dtype=np.int64))
+        lo = np.searchsorted(keys, query, side='left')
+        hi = np.searchsorted(keys, query, side='right')
+
+        lengths = hi - lo
+        total = int(lengths.sum())
+        if total == 0:
+            return matches
+
+        idx = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+
+        # the main index may have switched to a version with these songs before the next poll drops them,
+        # the main index's rows of replaced songs are filtered instead
+        keep = ~np.isin(song_ids[idx], self.main.songs)
+        if replaced:
+            keep |= np.isin(song_ids[idx], list(replaced))
+        idx = idx[keep]
+
+        return matches + list(zip(keys[idx].tolist(), times[idx].tolist(), song_ids[idx].tolist()))
+
+    def _poll_loop(self):
+        db = self.db_factory()
+        try:
+            while not self._stop.is_set():
+                try:
+                    self._refresh(db)
+                except Exception as e:
+                    print(f"[Delta] Refresh failed: {e}")
+                self._stop.wait(self.poll_interval_sec)
+        finally:
+            db.close()
+
+    def _refresh(self, db: AppDatabase):
+        self.main.maybe_reload()  # not queried while stale
+        hash_scheme = db.get_hash_scheme()
+        if hash_scheme != self.main.hash_scheme and self._fallback_db is None:
+            print(f"[Delta] The main index has hash scheme {self.main.hash_scheme} and the database {hash_scheme}, "
+                  f"serving lookups from the database until the index is rebuilt (python -m database.mapped_index build)")
+            self._fallback_db = self.db_factory()
+        self.hash_scheme = hash_scheme  # after the fallback exists, lookups check is_stale first
+
+        in_main = self.main.songs
+
+        db_songs = np.asarray(db.get_song_ids(), dtype=np.int32)
+        wanted = dict.fromkeys(db_songs[~np.isin(db_songs, in_main)].tolist(), 0)
+
+        # songs whose fingerprints changed after the main index was built
+        updated = dict(db.get_songs_updated_since(self.main.meta.get('fingerprints_version', 0)))
+        replaced = frozenset(song_id for song_id in updated if song_id not in wanted)
+        wanted.update(updated)
+
+        deleted = frozenset(in_main[~np.isin(in_main, db_songs)].tolist())
+        if deleted != self._deleted_songs:
+            print(f"[Delta] {len(deleted)} deleted songs are still in the main index, filtering them out")
+            self._deleted_songs = deleted
+
+        # a song replaced again since it was loaded is loaded anew
+        reloaded = set(song_id for song_id, version in wanted.items() if self._segment_songs.get(song_id, version) != version)
+        added = (wanted.keys() - self._segment_songs.keys()) | reloaded
+        removed = (self._segment_songs.keys() - wanted.keys()) | reloaded
+        if not added and not removed:
+            self._replaced_songs = replaced
+            return
+
+        keys, times, song_ids = self._segment
+        keep = ~np.isin(song_ids, list(removed)) if removed else np.ones(len(keys), dtype=bool)
+        parts = [np.stack([keys[keep], times[keep], song_ids[keep]], axis=1)]
+
+        if added:
+            # songs are inserted or replaced with their fingerprints in one transaction, so these are complete
+            rows = db.get_fingerprints_of_songs(sorted(added))
+            parts.append(np.asarray(rows, dtype=np.int64).reshape(-1, 3))
+
+        rows = np.concatenate(parts)
+        rows = rows[np.argsort(rows[:, 0], kind='stable')]
+        self._segment = (rows[:, 0].copy(), rows[:, 1].copy(), rows[:, 2].copy())
+        self._segment_songs = wanted
+        self._replaced_songs = replaced
+
+        print(f"[Delta] +{len(added)} -{len(removed)} songs, {len(wanted)} songs ({len(rows)} fingerprints) not yet in the main index, {len(replaced)} of them replaced")
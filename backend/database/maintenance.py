@@ -0,0 +1,246 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import random
+from time import perf_counter
+
+from tinytag import TinyTag
+from tqdm import tqdm
+
+from config.constants import HOP_SIZE, WINDOW_SIZE
+from database.config import DB_NAME, DB_PASS, DB_USER
+from database.db import AppDatabase
+from fingerprint.fingerprinting import generate_fingerprints
+from fingerprint.hashing import HASH_SCHEMES
+from model.song import Song
+from preprocessing.audio_preprocessing import preprocess_audio_file
+
+BENCH_TITLE = '__maintenance_bench__'
+
+# the benchmark drops indexes and deletes songs, so it runs on a scratch database
+BENCH_DB_NAME = f'{DB_NAME}_bench'
+
+
+def delete_songs(db: AppDatabase, song_ids):
+    start = perf_counter()
+    deleted = db.delete_songs(song_ids)
+    print(f"Deleted {len(song_ids)} songs ({deleted} fingerprints) in {perf_counter() - start:.2f}s")
+
+
+def replace_song(db: AppDatabase, song_id: int, file_path: str):
+    if db.get_song(song_id) is None:
+        print(f"No song with id {song_id}")
+        return
+
+    start = perf_counter()
+    audio = preprocess_audio_file(file_path)
+    hash_scheme = db.get_hash_scheme()
+    fingerprints = generate_fingerprints(audio, WINDOW_SIZE, HOP_SIZE, hash_scheme)
+
+    tags = TinyTag.get(file_path, ignore_errors=True)
+    song = Song(
+        id=song_id,
+        title=tags.title or os.path.splitext(os.path.basename(file_path))[0],
+        artist_name=tags.artist,
+        album_name=tags.album,
+        file_path=file_path,
+        duration_sec=audio.duration_seconds,
+        sample_rate=audio.rate
+    )
+    db.replace_song(song_id, song, fingerprints, hash_scheme)
+    print(f"Replaced song {song_id} with {len(fingerprints)} fingerprints in {perf_counter() - start:.2f}s")
+
+
+def compact(db: AppDatabase, full: bool, song_ids=None):
+    """
+    With `song_ids`, only those of the songs without fingerprints are removed.
+    """
+    before = db.get_table_sizes()
+
+    start = perf_counter()
+    orphans = db.get_songs_without_fingerprints()
+    if song_ids is not None:
+        song_ids = set(song_ids)
+        orphans = [i for i in orphans if i in song_ids]
+    db.delete_songs(orphans)
+    print(f"Removed {len(orphans)} songs without fingerprints in {perf_counter() - start:.2f}s")
+
+    start = perf_counter()
+    db.compact(full=full)
+    print(f"{'Full vacuum' if full else 'Vacuum + reindex'} took {perf_counter() - start:.2f}s")
+
+    after = db.get_table_sizes()
+    for name in before:
+        print(f"{name:22} {_mb(before[name]):>10.1f} MB -> {_mb(after[name]):>10.1f} MB")
+
+
+def migrate_hash_scheme(db: AppDatabase, hash_scheme: int, num_workers: int, allow_missing: bool):
+    """
+    Re-fingerprints every song with another hash scheme into a new table and
+    swaps it in at the end, the current index keeps serving until then.
+    Songs are not added, replaced or deleted meanwhile, ingestion waits.
+    """
+    current = db.get_hash_scheme()
+    if current == hash_scheme:
+        print(f"The index already uses hash scheme {hash_scheme}")
+        return
+
+    print("Waiting for songs being stored...")
+    db.lock_fingerprint_writes()
+    try:
+        _migrate_hash_scheme(db, current, hash_scheme, num_workers, allow_missing)
+    finally:
+        db.unlock_fingerprint_writes()
+
+
+def _migrate_hash_scheme(db: AppDatabase, current: int, hash_scheme: int, num_workers: int, allow_missing: bool):
+    # duplicates linked to a canonical song have no fingerprints to migrate
+    songs = [song for song in db.get_all_songs() if song.canonical_id is None]
+    table = db.create_migration_table(hash_scheme)
+    before = db.get_table_sizes()
+
+    print(f"Re-fingerprinting {len(songs)} songs from hash scheme {current} to {hash_scheme}...")
+    start = perf_counter()
+    failed = []
+    with ProcessPoolExecutor(num_workers) as executor:
+        jobs = [(song.file_path, hash_scheme) for song in songs]
+        for song, result in tqdm(zip(songs, executor.map(_fingerprint_file, jobs)), total=len(songs), unit="song"):
+            if isinstance(result, Exception):
+                failed.append((song, result))
+                continue
+            db.insert_fingerprints(song.id, result, table=table)
+
+    print(f"Fingerprinted in {perf_counter() - start:.1f}s")
+
+    if failed:
+        for song, e in failed:
+            print(f"  Failed: [{song.id}] {song.title} ({song.file_path}): {e}")
+        if not allow_missing:
+            print(f"{len(failed)} songs failed, the index is unchanged. Re-run with --allow-missing to drop them from the index.")
+            return
+
+    start = perf_counter()
+    db.swap_fingerprints_table(table, hash_scheme)
+    print(f"Built indexes and swapped tables in {perf_counter() - start:.1f}s")
+
+    after = db.get_table_sizes()
+    for name in ('fingerprints_table', 'fingerprints_indexes'):
+        print(f"{name:22} {_mb(before[name]):>10.1f} MB -> {_mb(after[name]):>10.1f} MB")
+
+
+def _fingerprint_file(job):
+    file_path, hash_scheme = job
+    try:
+        audio = preprocess_audio_file(file_path)
+        return generate_fingerprints(audio, WINDOW_SIZE, HOP_SIZE, hash_scheme)
+    except Exception as e:
+        return e
+
+
+def benchmark(db: AppDatabase, num_songs: int, rows_per_song: int, num_deleted: int, compare_unindexed: bool):
+    """
+    Fills the tables with synthetic songs and times the maintenance operations
+    on them. All synthetic songs are removed at the end.
+
+    Meant for the scratch database (BENCH_DB_NAME): the index drop with
+    `compare_unindexed` and the vacuum still apply to the whole table.
+    """
+    print(f"Inserting {num_songs} synthetic songs x {rows_per_song} fingerprints...")
+    start = perf_counter()
+    song_ids = []
+    for _ in range(num_songs):
+        song = Song(None, BENCH_TITLE, None, None, None, 0, 0)
+        fingerprints = [(random.getrandbits(31), random.randrange(600_000)) for _ in range(rows_per_song)]
+        song_ids.append(db.insert_song_with_fingerprints(song, fingerprints))
+    elapsed = perf_counter() - start
+    print(f"Inserted {num_songs * rows_per_song} rows in {elapsed:.2f}s ({num_songs * rows_per_song / elapsed:,.0f} rows/s)")
+
+    to_delete = random.sample(song_ids, num_deleted)
+    half = len(to_delete) // 2
+
+    if compare_unindexed:
+        with db.conn.cursor() as cur:
+            cur.execute("DROP INDEX IF EXISTS idx_fingerprint_song_id;")
+        _timed_delete(db, to_delete[:half], "without song_id index")
+
+        start = perf_counter()
+        db.create_tables()  # recreates the index
+        print(f"Rebuilt song_id index in {perf_counter() - start:.2f}s")
+    else:
+        half = 0
+
+    _timed_delete(db, to_delete[half:], "with song_id index")
+
+    compact(db, full=False, song_ids=song_ids)
+
+    start = perf_counter()
+    already_deleted = set(to_delete)
+    db.delete_songs([i for i in song_ids if i not in already_deleted])
+    print(f"Cleaned up synthetic songs in {perf_counter() - start:.2f}s")
+
+
+def _timed_delete(db: AppDatabase, song_ids, label: str):
+    start = perf_counter()
+    deleted = db.delete_songs(song_ids)
+    elapsed = perf_counter() - start
+    print(f"Deleted {len(song_ids)} songs ({deleted} rows) {label} in {elapsed:.2f}s ({elapsed / max(1, len(song_ids)) * 1000:.1f} ms/song)")
+
+
+def _mb(num_bytes: int) -> float:
+    return num_bytes / (1024 * 1024)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Songs Database Maintenance')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    delete_parser = commands.add_parser('delete', help='Delete songs and their fingerprints')
+    delete_parser.add_argument('song_ids', type=int, nargs='+')
+
+    replace_parser = commands.add_parser('replace', help='Re-fingerprint a song from a (new) audio file')
+    replace_parser.add_argument('song_id', type=int)
+    replace_parser.add_argument('file', type=str)
+
+    compact_parser = commands.add_parser('compact', help='Remove songs without fingerprints, vacuum and rebuild the hash index')
+    compact_parser.add_argument('--full', action='store_true', help='VACUUM FULL (locks the table, returns space to the OS)')
+
+    migrate_parser = commands.add_parser('migrate-hash', help='Re-fingerprint the library with another hash scheme')
+    migrate_parser.add_argument('hash_scheme', type=int, choices=HASH_SCHEMES)
+    migrate_parser.add_argument('--workers', '-w', type=int, default=4, help='Number of parallel workers')
+    migrate_parser.add_argument('--allow-missing', action='store_true', help='Swap in the new index even if some songs could not be read')
+
+    bench_parser = commands.add_parser('bench', help='Time maintenance operations on synthetic data')
+    bench_parser.add_argument('--songs', type=int, default=1000)
+    bench_parser.add_argument('--rows-per-song', type=int, default=5000)
+    bench_parser.add_argument('--delete', type=int, default=50, help='Number of songs to delete')
+    bench_parser.add_argument('--compare-unindexed', action='store_true', help='Also time deletes without the song_id index')
+    bench_parser.add_argument('--db-name', type=str, default=BENCH_DB_NAME, help=f'Scratch database, created if missing (default {BENCH_DB_NAME})')
+
+    args = parser.parse_args()
+
+    db_name = DB_NAME
+    if args.command == 'bench':
+        if args.db_name == DB_NAME:
+            print(f"The benchmark does not run on the songs database {DB_NAME}, choose a scratch database")
+            exit(1)
+        db = AppDatabase(DB_NAME, DB_USER, DB_PASS)
+        if db.create_database(args.db_name):
+            print(f"Created scratch database {args.db_name}")
+        db.close()
+        db_name = args.db_name
+
+    db = AppDatabase(db_name, DB_USER, DB_PASS)
+    db.create_tables()
+
+    if args.command == 'delete':
+        delete_songs(db, args.song_ids)
+    elif args.command == 'replace':
+        replace_song(db, args.song_id, args.file)
+    elif args.command == 'compact':
+        compact(db, args.full)
+    elif args.command == 'migrate-hash':
+        migrate_hash_scheme(db, args.hash_scheme, args.workers, args.allow_missing)
+    elif args.command == 'bench':
+        benchmark(db, args.songs, args.rows_per_song, args.delete, args.compare_unindexed)
+
+    db.close()
@@ -0,0 +1,214 @@
+import argparse
+import json
+import os
+import shutil
+import threading
+from time import monotonic, perf_counter, time
+from typing import List, Tuple
+
+import numpy as np
+
+from database.config import DB_NAME, DB_PASS, DB_USER
+from database.db import AppDatabase
+from fingerprint.hashing import HASH_SCHEME_V1
+
+INDEX_FORMAT_VERSION = 2  # 2 added songs.npy
+CURRENT_FILE = 'CURRENT'
+VERSIONS_TO_KEEP = 2
+
+
+class MappedIndex:
+    """
+    Read-only fingerprint index stored as hash-sorted numpy arrays and opened
+    memory-mapped, so every server worker shares the same page cache instead
+    of holding its own copy.
+
+    The index directory holds one sub-directory per built version and a
+    CURRENT file naming the live one. Workers check CURRENT every few seconds
+    and switch to a new version without interrupting lookups in flight.
+    """
+
+    def __init__(self, root: str, reload_interval_sec: float = 5):
+        self.root = root
+        self.reload_interval_sec = reload_interval_sec
+        self._lock = threading.Lock()
+        self._last_check = monotonic()
+        self._open(_read_current(root))
+
+    @property
+    def version(self) -> str:
+        return self._version
+
+    @property
+    def meta(self) -> dict:
+        return self._meta
+
+    @property
+    def hash_scheme(self) -> int:
+        return self._meta.get('hash_scheme', HASH_SCHEME_V1)
+
+    @property
+    def songs(self) -> np.ndarray:
+        """
+        Sorted ids of the songs in the live version.
+        """
+        return self._songs
+
+    def find_matches(self, hashes: List[int]) -> List[Tuple[int, int, int]]:
+        self.maybe_reload()
+        keys, times, song_ids = self._arrays  # one consistent version even if a swap happens meanwhile
+
+        query = np.unique(np.asarray(hashes, dtype=np.int64))
+        lo = np.searchsorted(keys, query, side='left')
+        hi = np.searchsorted(keys, query, side='right')
+
+        lengths = hi - lo
+        total = int(lengths.sum())
+        if total == 0:
+            return []
+
+        # positions of all postings of all query hashes, in index order
+        idx = np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+
+        return list(zip(keys[idx].tolist(), times[idx].tolist(), song_ids[idx].tolist()))
+
+    def maybe_reload(self):
+        now = monotonic()
+        if now - self._last_check < self.reload_interval_sec:
+            return
+
+        with self._lock:
+            if now - self._last_check < self.reload_interval_sec:
+                return
+            self._last_check = now
+
+            version = _read_current(self.root)
+            if version != self._version:
+                print(f"[Index] Switching from {self._version} to {version}")
+                self._open(version)
+
+    def _open(self, version: str):
+        path = os.path.join(self.root, version)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+
+        if meta['format'] not in (1, INDEX_FORMAT_VERSION):
+            raise ValueError(f"Unsupported index format {meta['format']} in {path}")
+
+        if meta['format'] >= 2:
+            songs = np.load(os.path.join(path, 'songs.npy'), mmap_mode='r')
+        else:
+            songs = np.arange(1, meta['max_song_id'] + 1, dtype=np.int32)
+
+        self._arrays = (
+            np.load(os.path.join(path, 'hashes.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'times.npy'), mmap_mode='r'),
+            np.load(os.path.join(path, 'song_ids.npy'), mmap_mode='r'),
+        )
+        self._songs = songs
+        self._meta = meta
+        self._version = version
+
+
+def build_index(db: AppDatabase, root: str, batch_size: int = 1_000_000) -> str:
+    """
+    Exports the fingerprints table into a new index version and makes it the
+    live one. Rows are streamed straight into the memory-mapped output files,
+    so the build never holds the whole table in memory.
+    """
+    version, tmp_path = _create_version(root)
+
+    # one snapshot for the count and the export, concurrent inserts are left for the next build
+    with db.transaction(isolation_level='REPEATABLE READ'):
+        num_rows = db.get_number_of_fingerprints()
+        songs = np.sort(np.asarray(db.get_song_ids(), dtype=np.int32))
+        np.save(os.path.join(tmp_path, 'songs.npy'), songs)
+
+        hashes = np.lib.format.open_memmap(os.path.join(tmp_path, 'hashes.npy'), mode='w+', dtype=np.int64, shape=(num_rows,))
+        times = np.lib.format.open_memmap(os.path.join(tmp_path, 'times.npy'), mode='w+', dtype=np.int32, shape=(num_rows,))
+        song_ids = np.lib.format.open_memmap(os.path.join(tmp_path, 'song_ids.npy'), mode='w+', dtype=np.int32, shape=(num_rows,))
+
+        written = 0
+        for rows in db.iter_fingerprints_by_hash(batch_size):
+            batch = np.asarray(rows, dtype=np.int64)
+            hashes[written:written + len(batch)] = batch[:, 0]
+            times[written:written + len(batch)] = batch[:, 1]
+            song_ids[written:written + len(batch)] = batch[:, 2]
+            written += len(batch)
+
+        meta = {
+            'format': INDEX_FORMAT_VERSION,
+            'num_fingerprints': written,
+            'num_songs': len(songs),
+            'max_song_id': db.get_max_song_id(),
+            'hash_scheme': db.get_hash_scheme(),
+            'fingerprints_version': db.get_fingerprints_version(),
+            'created_at': time(),
+        }
+
+    for arr in (hashes, times, song_ids):
+        arr.flush()
+    del hashes, times, song_ids
+
+    _publish_version(root, version, tmp_path, meta)
+    return version
+
+
+def _create_version(root: str) -> Tuple[str, str]:
+    """
+    Names a new version and creates its temporary directory.
+    """
+    os.makedirs(root, exist_ok=True)
+
+    version = f"v{int(time() * 1000)}"
+    tmp_path = os.path.join(root, version + '.tmp')
+    os.makedirs(tmp_path)
+    return version, tmp_path
+
+
+def _publish_version(root: str, version: str, tmp_path: str, meta: dict):
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    os.rename(tmp_path, os.path.join(root, version))
+    _write_current(root, version)
+    _remove_old_versions(root)
+
+
+def _read_current(root: str) -> str:
+    with open(os.path.join(root, CURRENT_FILE)) as f:
+        return f.read().strip()
+
+
+def _write_current(root: str, version: str):
+    # write + rename, readers never see a half written file
+    tmp = os.path.join(root, CURRENT_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(root, CURRENT_FILE))
+
+
+def _remove_old_versions(root: str):
+    # workers still mapping an old version keep their pages until they switch
+    versions = sorted(d for d in os.listdir(root) if d.startswith('v') and not d.endswith('.tmp'))
+    for version in versions[:-VERSIONS_TO_KEEP]:
+        shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Memory-mapped Fingerprint Index')
+    parser.add_argument('command', choices=['build', 'info'])
+    parser.add_argument('dir', type=str, help='Index directory')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        db = AppDatabase(DB_NAME, DB_USER, DB_PASS)
+        start = perf_counter()
+        version = build_index(db, args.dir)
+        db.close()
+        print(f"Built index {version} in {perf_counter() - start:.1f}s")
+
+    index = MappedIndex(args.dir)
+    size = sum(os.path.getsize(os.path.join(args.dir, index.version, f)) for f in os.listdir(os.path.join(args.dir, index.version)))
+    print(f"Live version: {index.version}")
+    print(f"Fingerprints: {index.meta['num_fingerprints']}, songs: {index.meta['num_songs']}, size: {size / (1024 * 1024):.1f} MB")
@@ -0,0 +1,355 @@
+import argparse
+from dataclasses import asdict
+import json
+import os
+import struct
+import sys
+from time import perf_counter, time
+import zlib
+
+import numpy as np
+from tqdm import tqdm
+
+from database.config import DB_NAME, DB_PASS, DB_USER
+from database.db import AppDatabase
+from database.mapped_index import INDEX_FORMAT_VERSION, _create_version, _publish_version
+from fingerprint.hashing import HASH_SCHEMES, params_id_for_scheme
+from model.song import Song
+
+# A snapshot is one file with the songs and all fingerprints of an index:
+#
+#   MAGIC
+#   blocks of up to BLOCK_ROWS fingerprints in hash order, each stored as
+#     three compressed columns: hash deltas (int64), offsets and song ids (int32)
+#   the songs, as compressed JSON
+#   footer JSON: parameters, counts and the offset, length and CRC-32 of every column
+#   footer length (uint64), footer CRC-32 (uint32), MAGIC
+#
+# Columns are byte-shuffled before compression, so the mostly zero high bytes
+# of the small hash deltas and offsets end up next to each other.
+MAGIC = b'FMSSNAP\x00'
+SNAPSHOT_FORMAT_VERSION = 1
+BLOCK_ROWS = 1 << 20
+COMPRESSION_LEVEL = 1   # level 6 saves about 2% at three times the time
+
+COLUMN_DTYPES = ('<i8', '<i4', '<i4')  # hash deltas, time_offset_msec, song_id
+TRAILER = struct.Struct('<QI8s')
+
+
+class SnapshotWriter:
+
+    def __init__(self, path: str, hash_scheme: int):
+        self.path = path
+        self.hash_scheme = hash_scheme
+        self._file = open(path + '.tmp', 'wb')
+        self._file.write(MAGIC)
+        self._blocks = []
+        self.num_fingerprints = 0
+        self.raw_bytes = 0
+
+    def write_block(self, hashes: np.ndarray, times: np.ndarray, song_ids: np.ndarray):
+        """
+        Appends fingerprints sorted by hash, starting at or after the last hash written.
+        """
+        hashes = np.asarray(hashes, dtype=np.int64)
+        columns = (np.diff(hashes, prepend=0), times, song_ids)
+
+        locations = []
+        for column, dtype in zip(columns, COLUMN_DTYPES):
+            raw = _shuffle(np.ascontiguousarray(column, dtype=dtype))
+            data = zlib.compress(raw, COMPRESSION_LEVEL)
+            locations.append([self._file.tell(), len(data), zlib.crc32(data)])
+            self._file.write(data)
+            self.raw_bytes += len(raw)
+
+        self._blocks.append({
+            'rows': len(hashes),
+            'first_hash': int(hashes[0]),
+            'last_hash': int(hashes[-1]),
+            'columns': locations,
+        })
+        self.num_fingerprints += len(hashes)
+
+    def close(self, songs) -> dict:
+        songs_data = zlib.compress(json.dumps([asdict(song) for song in songs]).encode(), COMPRESSION_LEVEL)
+        songs_location = [self._file.tell(), len(songs_data), zlib.crc32(songs_data)]
+        self._file.write(songs_data)
+
+        footer = {
+            'format': SNAPSHOT_FORMAT_VERSION,
+            'params_id': params_id_for_scheme(self.hash_scheme),
+            'hash_scheme': self.hash_scheme,
+            'created_at': time(),
+            'num_songs': len(songs),
+            'num_fingerprints': self.num_fingerprints,
+            'uncompressed_bytes': self.raw_bytes,
+            'max_song_id': max((song.id for song in songs), default=0),
+            'compression': 'zlib',
+            'columns': ['hash_delta', 'time_offset_msec', 'song_id'],
+            'column_dtypes': list(COLUMN_DTYPES),
+            'songs': songs_location,
+            'blocks': self._blocks,
+        }
+        footer_data = json.dumps(footer).encode()
+        self._file.write(footer_data)
+        self._file.write(TRAILER.pack(len(footer_data), zlib.crc32(footer_data), MAGIC))
+        self._file.close()
+
+        os.replace(self.path + '.tmp', self.path)
+        return footer
+
+
+class Snapshot:
+    """
+    Reads a snapshot file, checking every part against its CRC as it is read.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a snapshot")
+
+        self._file.seek(-TRAILER.size, os.SEEK_END)
+        footer_len, footer_crc, magic = TRAILER.unpack(self._file.read(TRAILER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is truncated")
+
+        self._file.seek(-TRAILER.size - footer_len, os.SEEK_END)
+        footer_data = self._file.read(footer_len)
+        if zlib.crc32(footer_data) != footer_crc:
+            raise ValueError(f"{path}: footer checksum mismatch")
+
+        self.footer = json.loads(footer_data)
+        if self.footer['format'] != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format {self.footer['format']} in {path}")
+
+    @property
+    def hash_scheme(self) -> int:
+        return self.footer['hash_scheme']
+
+    @property
+    def num_fingerprints(self) -> int:
+        return self.footer['num_fingerprints']
+
+    def songs(self) -> list:
+        data = json.loads(zlib.decompress(self._read(*self.footer['songs'])))
+        return [Song(**song) for song in data]
+
+    def iter_blocks(self):
+        """
+        Yields (hashes, times, song_ids) arrays block by block, in hash order.
+        """
+        for block in self.footer['blocks']:
+            deltas, times, song_ids = (
+                _unshuffle(zlib.decompress(self._read(*location)), dtype)
+                for location, dtype in zip(block['columns'], COLUMN_DTYPES)
+            )
+            hashes = np.cumsum(deltas)
+            if len(hashes) != block['rows'] or hashes[-1] != block['last_hash']:
+                raise ValueError(f"{self.path}: corrupt block at offset {block['columns'][0][0]}")
+            yield hashes, times, song_ids
+
+    def close(self):
+        self._file.close()
+
+    def _read(self, offset: int, length: int, crc: int) -> bytes:
+        self._file.seek(offset)
+        data = self._file.read(length)
+        if len(data) != length or zlib.crc32(data) != crc:
+            raise ValueError(f"{self.path}: checksum mismatch at offset {offset}")
+        return data
+
+
+def export_snapshot(db: AppDatabase, path: str, block_rows: int = BLOCK_ROWS) -> dict:
+    """
+    Writes the songs and fingerprints of the database into a snapshot, from
+    one consistent view of both.
+    """
+    with db.transaction(isolation_level='REPEATABLE READ'):
+        hash_scheme = db.get_hash_scheme()
+        songs = db.get_all_songs()
+        num_rows = db.get_number_of_fingerprints()
+
+        writer = SnapshotWriter(path, hash_scheme)
+        with tqdm(total=num_rows, desc="Exporting", unit="row", unit_scale=True) as progress:
+            for rows in db.iter_fingerprints_by_hash(block_rows):
+                batch = np.asarray(rows, dtype=np.int64)
+                writer.write_block(batch[:, 0], batch[:, 1], batch[:, 2])
+                progress.update(len(batch))
+
+    return writer.close(songs)
+
+
+def import_to_database(snapshot: Snapshot, db: AppDatabase):
+    """
+    Loads a snapshot into an empty database. Fingerprints are copied into a
+    table without indexes and the indexes are built once at the end, from
+    rows that are already in hash order.
+    """
+    _check_params(snapshot)
+    db.create_tables(snapshot.hash_scheme)
+    if db.get_number_of_songs() > 0:
+        raise ValueError("The database already has songs, import into an empty one")
+
+    start = perf_counter()
+    db.insert_songs_with_ids(snapshot.songs())
+    print(f"Loaded {snapshot.footer['num_songs']} songs in {perf_counter() - start:.1f}s")
+
+    table = db.create_import_table(snapshot.hash_scheme)
+    start = perf_counter()
+    with tqdm(total=snapshot.num_fingerprints, desc="Loading", unit="row", unit_scale=True) as progress:
+        for hashes, times, song_ids in snapshot.iter_blocks():
+            db.copy_fingerprint_arrays(table, snapshot.hash_scheme, hashes, times, song_ids)
+            progress.update(len(hashes))
+    _print_rate("Copied", snapshot.num_fingerprints, perf_counter() - start)
+
+    start = perf_counter()
+    db.finish_import_table(table, snapshot.hash_scheme)
+    print(f"Built the indexes in {perf_counter() - start:.1f}s")
+
+
+def import_to_index(snapshot: Snapshot, root: str) -> str:
+    """
+    Writes the fingerprints of a snapshot as a new version of a memory-mapped
+    index and makes it the live one, without going through Postgres.
+    """
+    _check_params(snapshot)
+    version, tmp_path = _create_version(root)
+    num_rows = snapshot.num_fingerprints
+
+    hashes = np.lib.format.open_memmap(os.path.join(tmp_path, 'hashes.npy'), mode='w+', dtype=np.int64, shape=(num_rows,))
+    times = np.lib.format.open_memmap(os.path.join(tmp_path, 'times.npy'), mode='w+', dtype=np.int32, shape=(num_rows,))
+    song_ids = np.lib.format.open_memmap(os.path.join(tmp_path, 'song_ids.npy'), mode='w+', dtype=np.int32, shape=(num_rows,))
+
+    written = 0
+    for block in snapshot.iter_blocks():
+        n = len(block[0])
+        for arr, column in zip((hashes, times, song_ids), block):
+            arr[written:written + n] = column
+        written += n
+
+    for arr in (hashes, times, song_ids):
+        arr.flush()
+    del hashes, times, song_ids
+
+    songs = np.sort(np.asarray([song.id for song in snapshot.songs()], dtype=np.int32))
+    np.save(os.path.join(tmp_path, 'songs.npy'), songs)
+
+    _publish_version(root, version, tmp_path, {
+        'format': INDEX_FORMAT_VERSION,
+        'num_fingerprints': written,
+        'num_songs': len(songs),
+        'max_song_id': snapshot.footer['max_song_id'],
+        'hash_scheme': snapshot.hash_scheme,
+        'created_at': time(),
+        'snapshot': os.path.basename(snapshot.path),
+    })
+    return version
+
+
+def verify_snapshot(snapshot: Snapshot) -> bool:
+    last_hash = None
+    rows = 0
+    try:
+        for hashes, _, _ in tqdm(snapshot.iter_blocks(), total=len(snapshot.footer['blocks']), desc="Verifying", unit="block"):
+            if np.any(np.diff(hashes) < 0) or (last_hash is not None and hashes[0] < last_hash):
+                raise ValueError("fingerprints are not in hash order")
+            last_hash = hashes[-1]
+            rows += len(hashes)
+        snapshot.songs()
+    except ValueError as e:
+        print(f"FAIL {e}")
+        return False
+
+    if rows != snapshot.num_fingerprints:
+        print(f"FAIL {rows} fingerprints, the footer says {snapshot.num_fingerprints}")
+        return False
+    print("PASS")
+    return True
+
+
+def _check_params(snapshot: Snapshot):
+    if snapshot.hash_scheme not in HASH_SCHEMES:
+        raise ValueError(f"Snapshot hash scheme {snapshot.hash_scheme} is not supported by this build")
+    # hashes are only comparable between indexes built with the same spectrogram and peak parameters
+    expected = params_id_for_scheme(snapshot.hash_scheme)
+    if snapshot.footer['params_id'] != expected:
+        raise ValueError(f"Snapshot fingerprint parameters {snapshot.footer['params_id']} do not match this build ({expected})")
+
+
+def _shuffle(arr: np.ndarray) -> bytes:
+    # byte i of every value, then byte i + 1 of every value, ...
+    return arr.view(np.uint8).reshape(-1, arr.itemsize).T.tobytes()
+
+
+def _unshuffle(data: bytes, dtype: str) -> np.ndarray:
+    itemsize = np.dtype(dtype).itemsize
+    return np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T.copy().view(dtype).ravel()
+
+
+def _print_rate(label: str, num_rows: int, seconds: float, num_bytes: int = None):
+    seconds = max(seconds, 1e-9)
+    rate = f"{label} {num_rows} fingerprints in {seconds:.1f}s ({num_rows / seconds / 1e6:.2f}M rows/s"
+    if num_bytes is not None:
+        rate += f", {num_bytes / seconds / (1024 * 1024):.1f} MB/s"
+    print(rate + ")")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Index Snapshots')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='Write the songs and fingerprints of the database into a snapshot file')
+    export_parser.add_argument('file', type=str)
+    export_parser.add_argument('--block-rows', type=int, default=BLOCK_ROWS)
+
+    import_parser = commands.add_parser('import', help='Load a snapshot into an empty database')
+    import_parser.add_argument('file', type=str)
+    import_parser.add_argument('--index', type=str, help='Also write it as the live version of this memory-mapped index directory')
+
+    info_parser = commands.add_parser('info', help='Print the parameters and size of a snapshot')
+    info_parser.add_argument('file', type=str)
+    info_parser.add_argument('--verify', action='store_true', help='Read every block and check checksums and order')
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        db = AppDatabase(DB_NAME, DB_USER, DB_PASS)
+        start = perf_counter()
+        footer = export_snapshot(db, args.file, args.block_rows)
+        db.close()
+        _print_rate("Exported", footer['num_fingerprints'], perf_counter() - start, os.path.getsize(args.file))
+
+    elif args.command == 'info':
+        snapshot = Snapshot(args.file)
+        footer = snapshot.footer
+        size = os.path.getsize(args.file)
+        print(f"Parameters:   {footer['params_id']} (hash scheme {footer['hash_scheme']})")
+        print(f"Songs:        {footer['num_songs']}")
+        print(f"Fingerprints: {footer['num_fingerprints']} in {len(footer['blocks'])} blocks")
+        print(f"Size:         {size / (1024 * 1024):.1f} MB, {size / max(1, footer['num_fingerprints']):.2f} bytes per fingerprint "
+              f"({footer['uncompressed_bytes'] / max(1, size):.1f}x compressed)")
+        if args.verify:
+            start = perf_counter()
+            ok = verify_snapshot(snapshot)
+            _print_rate("Read", footer['num_fingerprints'], perf_counter() - start, size)
+            if not ok:
+                sys.exit(1)
+
+    elif args.command == 'import':
+        snapshot = Snapshot(args.file)
+        size = os.path.getsize(args.file)
+
+        # the database first, it refuses to import into a non-empty one
+        db = AppDatabase(DB_NAME, DB_USER, DB_PASS)
+        start = perf_counter()
+        import_to_database(snapshot, db)
+        db.close()
+        _print_rate("Imported", snapshot.num_fingerprints, perf_counter() - start, size)
+
+        if args.index:
+            start = perf_counter()
+            version = import_to_index(snapshot, args.index)
+            _print_rate(f"Wrote index {version} with", snapshot.num_fingerprints, perf_counter() - start, size)
@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+from scipy.signal import chirp
+
+from config.constants import DEFAULT_SAMPLE_RATE, HOP_SIZE, WINDOW_SIZE
+from fingerprint.fingerprinting import _generate_peaks, _split_into_windows, generate_fingerprints
+from fingerprint.hashing import HASH_SCHEME_V1, HASH_SCHEMES, params_id_for_scheme
+from fingerprint.spectrogram import _generate_spectrogram
+from preprocessing.audio_preprocessing import PreprocessedAudio
+
+# Test vectors for clients that compute fingerprints themselves (see the
+# 'fingerprints' mode of the identify_song websocket). Each vector is a raw
+# little-endian float32 mono signal at DEFAULT_SAMPLE_RATE plus the peaks and
+# (hash, offset_msec) pairs this implementation produces for it, one JSON file
+# per hash scheme named after its fingerprint parameter id.
+VECTORS_DIR = os.path.join(os.path.dirname(__file__), 'conformance_vectors')
+
+# FFT implementations differ in the last bits, which can flip a peak that sits
+# exactly on the threshold, so clients are held to near, not exact, equality
+MIN_PRECISION = 0.97
+MIN_RECALL = 0.97
+
+VECTOR_DURATION_SEC = 4
+
+
+def _test_signals():
+    rate = DEFAULT_SAMPLE_RATE
+    t = np.arange(VECTOR_DURATION_SEC * rate) / rate
+    rng = np.random.default_rng(1234)
+
+    # a melody of stepped tones with harmonics
+    notes = 220 * 2 ** (rng.integers(0, 24, size=16) / 12)
+    freqs = np.repeat(notes, len(t) // len(notes) + 1)[:len(t)]
+    phase = 2 * np.pi * np.cumsum(freqs) / rate
+    tones = 0.5 * np.sin(phase) + 0.25 * np.sin(2 * phase) + 0.1 * np.sin(3 * phase)
+    yield 'tones', tones + 0.01 * rng.standard_normal(len(t))
+
+    # a fast sweep through most of the spectrum
+    sweep = 0.6 * chirp(t, f0=100, t1=t[-1], f1=5000, method='logarithmic')
+    yield 'sweep', sweep + 0.01 * rng.standard_normal(len(t))
+
+    # percussive noise bursts over a bass line
+    bursts = rng.standard_normal(len(t)) * (np.sin(2 * np.pi * 4 * t) > 0.9)
+    bass = 0.4 * np.sin(2 * np.pi * 55 * t)
+    yield 'bursts', 0.3 * bursts + bass
+
+
+def _fingerprint(signal: np.ndarray, hash_scheme: int):
+    audio = PreprocessedAudio(signal, DEFAULT_SAMPLE_RATE, len(signal) / DEFAULT_SAMPLE_RATE)
+
+    windows = _split_into_windows(audio, WINDOW_SIZE, HOP_SIZE, apply_hanning=True)
+    spectrogram = 10 * np.log10(_generate_spectrogram(windows) + 1e-10)
+    peaks = _generate_peaks(spectrogram)
+
+    fingerprints = generate_fingerprints(audio, WINDOW_SIZE, HOP_SIZE, hash_scheme)
+    return [[int(t), int(f)] for t, f, _ in peaks], [[int(h), int(t)] for h, t in fingerprints]
+
+
+def generate():
+    os.makedirs(VECTORS_DIR, exist_ok=True)
+    signals = []
+
+    for name, signal in _test_signals():
+        signal = signal.astype('<f4')
+        signal.tofile(os.path.join(VECTORS_DIR, f"{name}.f32"))
+        signals.append((name, signal))
+
+    for hash_scheme in HASH_SCHEMES:
+        params_id = params_id_for_scheme(hash_scheme)
+        vectors = []
+
+        for name, signal in signals:
+            # fingerprints are computed from the stored float32 samples, exactly what a client reads
+            peaks, fingerprints = _fingerprint(signal.astype(np.float64), hash_scheme)
+            vectors.append({
+                'name': name,
+                'signal_file': f"{name}.f32",
+                'sample_rate': DEFAULT_SAMPLE_RATE,
+                'peaks': peaks,                 # [time_frame, freq_bin]
+                'fingerprints': fingerprints,   # [hash, offset_msec]
+            })
+            print(f"{params_id} {name}: {len(peaks)} peaks, {len(fingerprints)} fingerprints")
+
+        with open(os.path.join(VECTORS_DIR, f"{params_id}.json"), 'w') as f:
+            json.dump({'params_id': params_id, 'hash_scheme': hash_scheme, 'vectors': vectors}, f)
+
+
+def verify(client_results_path: str = None, hash_scheme: int = HASH_SCHEME_V1) -> bool:
+    """
+    Compares fingerprints against the stored vectors, either those of a client
+    (a JSON object of vector name -> [[hash, offset_msec], ...]) or, without
+    one, this implementation's own to catch accidental parameter changes.
+    """
+    params_id = params_id_for_scheme(hash_scheme)
+    path = os.path.join(VECTORS_DIR, f"{params_id}.json")
+    if not os.path.exists(path):
+        print(f"No vectors for fingerprint parameters {params_id}, run generate first")
+        return False
+
+    with open(path) as f:
+        expected = json.load(f)
+
+    client_results = None
+    if client_results_path is not None:
+        with open(client_results_path) as f:
+            client_results = json.load(f)
+
+    passed = True
+    for vector in expected['vectors']:
+        if client_results is not None:
+            actual = client_results.get(vector['name'], [])
+        else:
+            signal = np.fromfile(os.path.join(VECTORS_DIR, vector['signal_file']), dtype='<f4')
+            _, actual = _fingerprint(signal.astype(np.float64), hash_scheme)
+
+        expected_set = set(map(tuple, vector['fingerprints']))
+        actual_set = set(map(tuple, actual))
+        common = len(expected_set & actual_set)
+        precision = common / len(actual_set) if actual_set else 0.0
+        recall = common / len(expected_set) if expected_set else 0.0
+
+        ok = precision >= MIN_PRECISION and recall >= MIN_RECALL
+        passed = passed and ok
+        print(f"{'PASS' if ok else 'FAIL'} {vector['name']}: precision {precision:.3f}, recall {recall:.3f}")
+
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Fingerprint Conformance Vectors')
+    parser.add_argument('command', choices=['generate', 'verify'])
+    parser.add_argument('--client-results', type=str, help='JSON of vector name -> [[hash, offset_msec], ...] computed by a client')
+    parser.add_argument('--hash-scheme', type=int, choices=HASH_SCHEMES, default=HASH_SCHEME_V1)
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate()
+    elif not verify(args.client_results, args.hash_scheme):
+        sys.exit(1)
@@ -1,3 +1,5 @@
+from concurrent.futures import Executor
+import math
 import numpy as np
 import scipy.ndimage
 from config.constants import FANOUT, HOP_SIZE, NEIGHBORHOOD_SIZE, WINDOW_SIZE
@@ -5,13 +7,27 @@ from preprocessing.audio_preprocessing import PreprocessedAudio, preprocess_audi
 import matplotlib.pyplot as plt
 from .spectrogram import _generate_spectrogram, _plot_and_save_spectrogram 
 import scipy
-from fingerprint.hashing import hash_fingerprints
+from fingerprint.hashing import HASH_SCHEME_V1, hash_fingerprints
 
 
+# Peaks are paired with peaks at most this far after them
+MAX_PAIR_DELTA_MS = 1500
 
+# Long recordings are fingerprinted in segments of this many frames (~4.6 minutes)
+# when an executor is given, see _generate_fingerprints_segmented
+SEGMENT_FRAMES = 6000
+
+
+def generate_fingerprints(audio: PreprocessedAudio, window_size: int = WINDOW_SIZE, hop_size: int = HOP_SIZE, hash_scheme: int = HASH_SCHEME_V1,
+                          executor: Executor = None, segment_frames: int = SEGMENT_FRAMES):
+    """
+    With an executor, signals longer than `segment_frames` frames are split
+    into segments fingerprinted in parallel. The result is the same as without.
+    """
+    num_frames = 1 + (len(audio.signal) - window_size) // hop_size
+    if executor is not None and num_frames > segment_frames:
+        return _generate_fingerprints_segmented(audio, window_size, hop_size, hash_scheme, executor.map, segment_frames)
 
-def generate_fingerprints(audio: PreprocessedAudio, window_size: int = WINDOW_SIZE, hop_size: int = HOP_SIZE):
-    
     windows = _split_into_windows(audio, window_size, hop_size, apply_hanning=True)
     
     spectrogram = _generate_spectrogram(windows)
@@ -20,7 +36,7 @@ def generate_fingerprints(audio: PreprocessedAudio, window_size: int = WINDOW_SI
     peaks = _generate_peaks(spectrogram)
     fingerprints = _generate_peaks_pairs(peaks, window_size, hop_size, audio.rate, fanout=FANOUT)
     
-    return hash_fingerprints(fingerprints)
+    return hash_fingerprints(fingerprints, hash_scheme)
 
 
 _hanning_cache = dict()
@@ -49,7 +65,7 @@ def _generate_peaks(spectrogram: np.ndarray, neighborhood_size: int = NEIGHBORHO
     filter_size = neighborhood_size
     sensitivity = 2
 
-    local_mean = scipy.ndimage.uniform_filter(spectrogram, size=filter_size)
+    local_mean = _local_mean(spectrogram, filter_size)
     threshold_mask = spectrogram > (local_mean * sensitivity)
     local_max = scipy.ndimage.grey_dilation(spectrogram, filter_size) == spectrogram
     peaks_mask = threshold_mask & local_max
@@ -66,7 +82,7 @@ def _generate_peaks(spectrogram: np.ndarray, neighborhood_size: int = NEIGHBORHO
         frame_peaks = list(zip([t]*len(idxs), freq_indices[idxs], amplitudes[idxs]))
         frame_peaks.sort(key=lambda x: x[2], reverse=True)
         for tp in frame_peaks[:max_peaks_per_frame]:
-            peaks_by_frame.setdefault(t, []).append((tp[0], tp[1]))
+            peaks_by_frame.setdefault(t, []).append((tp[0], tp[1], tp[2]))
 
     result = [p for plist in peaks_by_frame.values() for p in plist]
     result.sort()
@@ -76,40 +92,119 @@ def _generate_peaks(spectrogram: np.ndarray, neighborhood_size: int = NEIGHBORHO
 
 
 
-def _generate_peaks_pairs(peaks, window_size, hop_size, rate, fanout = FANOUT):
+def _local_mean(spectrogram: np.ndarray, size):
     """
-    The peaks must be sorted
+    scipy.ndimage.uniform_filter(spectrogram, size) up to rounding. Along time,
+    uniform_filter keeps a running sum from the start of the spectrogram, so
+    the last bits of a mean depend on where the spectrogram starts. Here every
+    mean adds up its own window in a fixed order (blocks of about sqrt(size)
+    frames, then the blocks), so a segment of a recording gets exactly the
+    means, and peaks, that the whole recording would.
+    """
+    freq_size, time_size = size
+
+    # whole columns, these never differ
+    mean = scipy.ndimage.uniform_filter1d(spectrogram, freq_size, axis=0)
+
+    # 'symmetric' is what scipy calls 'reflect'
+    half = time_size // 2
+    padded = np.pad(mean, ((0, 0), (half, time_size - 1 - half)), mode='symmetric')
+    num_frames = spectrogram.shape[1]
+
+    block = max(1, math.isqrt(time_size))
+    num_blocks = time_size // block
+    width = num_frames + (num_blocks - 1) * block
+
+    blocks = padded[:, 0:width].copy()
+    for k in range(1, block):
+        blocks += padded[:, k:k + width]
+
+    total = blocks[:, 0:num_frames].copy()
+    for j in range(1, num_blocks):
+        total += blocks[:, j * block:j * block + num_frames]
+    for k in range(num_blocks * block, time_size):
+        total += padded[:, k:k + num_frames]
+
+    return total / time_size
+
+
+def _generate_fingerprints_segmented(audio: PreprocessedAudio, window_size: int, hop_size: int, hash_scheme: int, map_fn, segment_frames: int):
+    """
+    Each segment owns the anchors of its frames. It computes the spectrogram
+    with enough frames on both sides for the peak filters, and the peaks of
+    the frames after it that its anchors can pair with, so every anchor gets
+    the same peaks and partners as in one pass over the whole signal.
+    """
+    signal = audio.signal
+    num_frames = 1 + (len(signal) - window_size) // hop_size
+
+    filter_margin = NEIGHBORHOOD_SIZE[1] // 2
+    pair_margin = int((MAX_PAIR_DELTA_MS * audio.rate) / (hop_size * 1000)) + 1
+
+    jobs = []
+    for start in range(0, num_frames, segment_frames):
+        end = min(start + segment_frames, num_frames)
+        peaks_end = min(end + pair_margin, num_frames)
+
+        spec_start = max(0, start - filter_margin)
+        spec_end = min(num_frames, peaks_end + filter_margin)
+        samples = signal[spec_start * hop_size:(spec_end - 1) * hop_size + window_size]
+
+        jobs.append((samples, audio.rate, window_size, hop_size, hash_scheme, spec_start, start, end, peaks_end))
+
+    fingerprints = []
+    for segment_fingerprints in map_fn(_fingerprint_segment, jobs):
+        fingerprints.extend(segment_fingerprints)
+    return fingerprints
+
+
+def _fingerprint_segment(job):
+    samples, rate, window_size, hop_size, hash_scheme, spec_start, start, end, peaks_end = job
+
+    audio = PreprocessedAudio(samples, rate, len(samples) / rate)
+    windows = _split_into_windows(audio, window_size, hop_size, apply_hanning=True)
+    spectrogram = 10 * np.log10(_generate_spectrogram(windows) + 1e-10)
+
+    peaks = [(t + spec_start, f, a) for t, f, a in _generate_peaks(spectrogram) if start <= t + spec_start < peaks_end]
+    num_anchors = sum(1 for p in peaks if p[0] < end)
+
+    pairs = _generate_peaks_pairs(peaks, window_size, hop_size, rate, fanout=FANOUT, num_anchors=num_anchors)
+    return hash_fingerprints(pairs, hash_scheme)
+
+
+def _generate_peaks_pairs(peaks, window_size, hop_size, rate, fanout = FANOUT, num_anchors: int = None):
+    """
+    The peaks must be sorted, each one is (time_frame, freq_bin, amplitude).
+    Only the first `num_anchors` peaks are paired with the ones after them (all by default).
     """
     if len(peaks) == 0:
         return list()
     
-    time_idx, freq_idx = zip(*peaks)
-    
     min_time_delta_ms = 0
-    max_time_delta_ms = 1500
+    max_time_delta_ms = MAX_PAIR_DELTA_MS
 
     min_frame_delta = (min_time_delta_ms * rate) / ( hop_size * 1000 )
     max_frame_delta = (max_time_delta_ms * rate) / ( hop_size * 1000 ) 
 
     fingerprints = list()
 
-    for i, p in enumerate(peaks):
+    for i, p in enumerate(peaks[:num_anchors]):
 
-        a_t_frame, a_freq = p
+        a_t_frame, a_freq, a_amp = p
         a_t_msec = int(((a_t_frame * hop_size) / rate) * 1000)
 
         for j in range(1, fanout + 1):
             if i + j >= len(peaks):
                 break
 
-            b_t_frame, b_freq = peaks[i + j]
+            b_t_frame, b_freq, b_amp = peaks[i + j]
             delta_t_frame = b_t_frame - a_t_frame
 
             if delta_t_frame < min_frame_delta or delta_t_frame > max_frame_delta:
                 continue
 
             else:
-                fingerprint = ((a_freq, b_freq, delta_t_frame), a_t_msec)
+                fingerprint = ((a_freq, b_freq, delta_t_frame, b_amp > a_amp), a_t_msec)
                 fingerprints.append(fingerprint)
 
     return fingerprints
@@ -1,16 +1,54 @@
 import hashlib
 
+from config.constants import FINGERPRINT_PARAMS_ID
 
-def hash_fingerprints(fingerprints):
+# Hash layouts, chosen per index (see AppDatabase.get_hash_scheme)
+HASH_SCHEME_V1 = 1      # 31-bit INT: 10-bit frequencies (bin 1024 aliases to 0), 11-bit frame delta
+HASH_SCHEME_WIDE = 2    # BIGINT: 11-bit frequencies, 12-bit frame delta
+HASH_SCHEME_WIDE_AMP = 3  # as WIDE plus a bit telling whether the target peak is louder than the anchor
+
+HASH_SCHEMES = (HASH_SCHEME_V1, HASH_SCHEME_WIDE, HASH_SCHEME_WIDE_AMP)
+
+
+def hash_fingerprints(fingerprints, hash_scheme: int = HASH_SCHEME_V1):
+
+    hash_fn = _hash_functions[hash_scheme]
 
     hashes = []
     for i in range(len(fingerprints)):
-        f1, f2, delta_frame = fingerprints[i][0]
-        h = _simple_hash(int(f1), int(f2), int(delta_frame))
+        f1, f2, delta_frame, target_louder = fingerprints[i][0]
+        h = hash_fn(int(f1), int(f2), int(delta_frame), bool(target_louder))
         hashes.append((h, int(fingerprints[i][1])))
 
     return hashes
 
+
+def is_wide_scheme(hash_scheme: int) -> bool:
+    return hash_scheme != HASH_SCHEME_V1
+
+
+def params_id_for_scheme(hash_scheme: int) -> str:
+    # the original layout keeps the id clients already use
+    if hash_scheme == HASH_SCHEME_V1:
+        return FINGERPRINT_PARAMS_ID
+    return f"{FINGERPRINT_PARAMS_ID}-h{hash_scheme}"
+
+
 # 31-bit hash
-def _simple_hash(f1, f2, delta_t):
-    return ((f1 & 0x3FF) << 21) | ((f2 & 0x3FF) << 11) | (delta_t) & 0x7FF
\ No newline at end of file
+def _simple_hash(f1, f2, delta_t, target_louder=False):
+    return ((f1 & 0x3FF) << 21) | ((f2 & 0x3FF) << 11) | (delta_t) & 0x7FF
+
+# 34-bit hash, a 2048-point rFFT has 1025 bins so frequencies need 11 bits
+def _wide_hash(f1, f2, delta_t, target_louder=False):
+    return ((f1 & 0x7FF) << 23) | ((f2 & 0x7FF) << 12) | (delta_t & 0xFFF)
+
+# 35-bit hash
+def _wide_amplitude_hash(f1, f2, delta_t, target_louder):
+    return (_wide_hash(f1, f2, delta_t) << 1) | int(target_louder)
+
+
+_hash_functions = {
+    HASH_SCHEME_V1: _simple_hash,
+    HASH_SCHEME_WIDE: _wide_hash,
+    HASH_SCHEME_WIDE_AMP: _wide_amplitude_hash,
+}
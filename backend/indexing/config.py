@@ -8,4 +8,9 @@ from dataclasses import dataclass
 class IndexConfig:
     num_workers: int = 1
     max_duration_sec: int = None
-    print_tables: bool = False
\ No newline at end of file
+    print_tables: bool = False
+    detect_duplicates: bool = False
+    max_songs_per_worker: int = None
+    max_worker_rss_mb: int = None
+    memory_budget_mb: int = None
+    trace_allocations: bool = False
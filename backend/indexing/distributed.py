@@ -0,0 +1,149 @@
+import argparse
+from itertools import batched
+import os
+from time import sleep
+
+from prettytable import PrettyTable
+from termcolor import colored
+from tqdm import tqdm
+
+from database.db import AppDatabase
+from fingerprint.hashing import HASH_SCHEMES
+from indexing.index_process import IndexProcessOptions
+from indexing.library import create_db_connection, find_audio_files
+from indexing.ingestion import MAX_SONGS_PER_WORKER, IngestionService
+from indexing.memory import available_memory_bytes
+
+# Indexing a library on shared storage with several machines. The coordinator
+# queues every file in the ingest_jobs table under a run id, and each worker
+# host claims batches of them (SELECT ... FOR UPDATE SKIP LOCKED) and indexes
+# them with local IndexProcess workers:
+#
+#   python -m indexing.distributed enqueue /mnt/music --run library
+#   python -m indexing.distributed work --run library -w 8     (on every host)
+#   python -m indexing.distributed status --run library --watch
+
+
+def enqueue(db: AppDatabase, directory: str, run_id: str, batch_size: int = 10_000):
+    file_paths = [os.path.abspath(p) for p in find_audio_files(directory)]
+
+    queued = 0
+    for batch in tqdm(list(batched(file_paths, batch_size)), desc="Queueing", unit="batch"):
+        queued += len(db.create_ingest_jobs(list(batch), run_id))
+
+    print(f"Queued {queued} of {len(file_paths)} files for run '{run_id}' ({len(file_paths) - queued} were already part of it)")
+
+
+def work(run_id: str, num_workers: int, batch_size: int, options: IndexProcessOptions, memory_budget_mb: int, exit_when_done: bool):
+    service = IngestionService(
+        create_db_connection,
+        num_workers,
+        options,
+        lock_key=None,
+        run_id=run_id,
+        batch_size=batch_size,
+        memory_budget_mb=memory_budget_mb
+    )
+    service.start()
+
+    db = create_db_connection()
+    try:
+        with tqdm(desc=f"Indexing on {service.worker}", unit="song") as pbar:
+            done = 0
+            while True:
+                sleep(2)
+                stats = service.stats()
+                completed = sum(stats['completed'].values())
+                pbar.update(completed - done)
+                pbar.set_postfix(stats['completed'])
+                done = completed
+
+                if exit_when_done and stats['in_flight'] == 0:
+                    # jobs running elsewhere may still come back if their worker dies
+                    progress = db.get_ingest_progress(run_id)
+                    if progress.get('queued', 0) == 0 and progress.get('running', 0) == 0:
+                        break
+    except KeyboardInterrupt:
+        print("Stopping, unfinished jobs go back to the queue")
+    finally:
+        service.stop()
+        db.close()
+
+
+def print_status(db: AppDatabase, run_id: str, window_sec: float):
+    progress = db.get_ingest_progress(run_id)
+    total = sum(progress.values())
+    finished = sum(progress.get(s, 0) for s in ('indexed', 'skipped', 'failed'))
+    remaining = progress.get('queued', 0) + progress.get('running', 0)
+
+    hosts = db.get_ingest_throughput(window_sec, run_id)
+    table = PrettyTable(['Host', 'Services', f'Done (last {int(window_sec)}s)', 'Songs/min', 'Running', 'Last heartbeat (s ago)'])
+    for host, services, done, running, idle in hosts:
+        table.add_row([host, services, done, round(done / window_sec * 60, 1), running, round(idle, 1)])
+
+    rate = sum(h[2] for h in hosts) / window_sec
+    eta = f"{remaining / rate / 3600:.1f}h" if rate > 0 else '-'
+
+    print(colored(f"\nRun '{run_id or 'all'}'", color='blue', attrs=['bold', 'underline']))
+    print(f"Finished {finished} of {total} ({finished / max(1, total) * 100:.1f}%), {remaining} remaining, ETA {eta}")
+    print("  " + ", ".join(f"{status}: {count}" for status, count in sorted(progress.items())))
+    print(f"Throughput: {rate * 60:.1f} songs/min over the last {int(window_sec)}s")
+    print(table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Distributed Songs Indexing')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    enqueue_parser = commands.add_parser('enqueue', help='Queue all audio files of a directory (coordinator)')
+    enqueue_parser.add_argument('dir', type=str, help='Directory on storage every worker host can read at the same path')
+    enqueue_parser.add_argument('--run', type=str, required=True, help='Run id to group the jobs under')
+    enqueue_parser.add_argument('--hash-scheme', type=int, choices=HASH_SCHEMES, help='Hash layout of a new index (default 1)')
+
+    work_parser = commands.add_parser('work', help='Claim and index queued files on this host')
+    work_parser.add_argument('--run', type=str, help='Only take jobs of this run')
+    work_parser.add_argument('--workers', '-w', type=int, default=4, help='Number of parallel workers')
+    work_parser.add_argument('--batch', '-b', type=int, help='Jobs claimed at once (default twice the workers)')
+    work_parser.add_argument('--max_duration', '-m', type=int, help='Max audio file duration in seconds (optional)')
+    work_parser.add_argument('--dedupe', action='store_true', help='Link re-releases of already indexed recordings instead of storing their fingerprints again')
+    work_parser.add_argument('--forever', action='store_true', help='Keep waiting for new jobs instead of exiting when the queue is empty')
+    work_parser.add_argument('--memory-budget-mb', type=int, help='Estimated memory the workers may use at once (default half the available memory, 0 for no limit)')
+    work_parser.add_argument('--max-songs-per-worker', type=int, default=MAX_SONGS_PER_WORKER, help='Replace a worker after this many songs')
+    work_parser.add_argument('--max-worker-rss-mb', type=int, help='Replace a worker once its RSS is above this')
+
+    status_parser = commands.add_parser('status', help='Show progress and throughput per host')
+    status_parser.add_argument('--run', type=str)
+    status_parser.add_argument('--window', type=float, default=300, help='Seconds over which throughput is measured')
+    status_parser.add_argument('--watch', type=float, nargs='?', const=30, help='Repeat every N seconds')
+
+    retry_parser = commands.add_parser('retry-failed', help='Queue failed jobs again')
+    retry_parser.add_argument('--run', type=str)
+
+    args = parser.parse_args()
+
+    db = create_db_connection()
+    db.create_tables(getattr(args, 'hash_scheme', None))
+
+    if args.command == 'enqueue':
+        enqueue(db, args.dir, args.run)
+    elif args.command == 'work':
+        options = IndexProcessOptions(
+            max_duration_sec=args.max_duration,
+            detect_duplicates=args.dedupe,
+            split_workers=args.workers,
+            max_songs_per_worker=args.max_songs_per_worker,
+            max_rss_mb=args.max_worker_rss_mb
+        )
+        memory_budget_mb = args.memory_budget_mb
+        if memory_budget_mb is None and available_memory_bytes() is not None:
+            memory_budget_mb = available_memory_bytes() // (2 * 1024 * 1024)
+        work(args.run, args.workers, args.batch, options, memory_budget_mb, not args.forever)
+    elif args.command == 'status':
+        print_status(db, args.run, args.window)
+        while args.watch:
+            sleep(args.watch)
+            print_status(db, args.run, args.window)
+    elif args.command == 'retry-failed':
+        print(f"Queued {db.requeue_failed_ingest_jobs(args.run)} failed jobs again")
+
+    db.close()
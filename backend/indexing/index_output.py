@@ -1,22 +1,75 @@
+from collections import Counter
 from typing import List
 
+import numpy as np
 from prettytable import PrettyTable
 from termcolor import colored
-from indexing.index_result import SongIndexError, SongIndexSuccess
+from indexing.index_result import SongIndexError, SongIndexSuccess, WorkerRecycled
+
+# a stored fingerprint costs its heap row plus its entries in the hash and song_id indexes
+FINGERPRINT_ROW_BYTES = 64
 
 
 def _print_success_songs(r: List[SongIndexSuccess]):
     
-    cols = ['Database Id', 'Title', 'Artist', 'Index Duration (s)', 'Is Skipped?']
+    cols = ['Database Id', 'Title', 'Artist', 'Index Duration (s)', 'Is Skipped?', 'Linked To']
     table = PrettyTable(cols)
 
     if len(r) > 0:
         print(colored("Indexed Songs", 'green', attrs=['bold', 'underline']))
         for s in r:
-            table.add_row([s.db_id, s.song_name, s.artist, round(s.index_duration_msec / 1000, 2), "Yes" if s.is_skipped else "No"], divider=True)
+            table.add_row([s.db_id, s.song_name, s.artist, round(s.index_duration_msec / 1000, 2), "Yes" if s.is_skipped else "No", s.linked_to or ""], divider=True)
     
     print(table)
 
+def _print_duplicates_summary(r: List[SongIndexSuccess]):
+
+    saved = sum(s.num_fingerprints for s in r if s.linked_to is not None)
+    stored = sum(s.num_fingerprints for s in r if s.linked_to is None)
+    linked = sum(1 for s in r if s.linked_to is not None)
+
+    print(f"🔗 Linked:     {linked} duplicate recordings, {saved} fingerprints not stored "
+          f"(~{saved * FINGERPRINT_ROW_BYTES / (1024 * 1024):.1f} MB, {saved / max(1, saved + stored) * 100:.1f}% of this run)")
+
+
+def _print_memory_summary(r: List[SongIndexSuccess], recycled: List[WorkerRecycled]):
+
+    profiled = [s for s in r if s.memory is not None and s.memory.start_rss is not None]
+    if len(recycled) > 0:
+        reasons = Counter(w.reason for w in recycled)
+        print(f"♻️  Recycled:   {len(recycled)} workers ({reasons['songs']} at the song limit, {reasons['rss']} above the RSS ceiling, "
+              f"largest RSS {max(w.rss_bytes or 0 for w in recycled) / (1024 * 1024):.0f} MB)")
+    if len(profiled) == 0:
+        return
+
+    # growth of the worker's RSS over its size when it started on the song
+    growth = lambda s, stage: s.memory.peak_rss[stage] - s.memory.start_rss
+    mb = lambda b: round(b / (1024 * 1024), 1)
+
+    print(colored("Memory per song (peak RSS above the worker's RSS before the song)", 'blue', attrs=['bold', 'underline']))
+    table = PrettyTable(['Stage', 'Songs', 'p50 (MB)', 'p95 (MB)', 'Max (MB)', 'Traced max (MB)'])
+    for stage in ('decode', 'fingerprint', 'dedupe', 'store'):
+        songs = [s for s in profiled if stage in s.memory.peak_rss]
+        if len(songs) == 0:
+            continue
+        peaks = [growth(s, stage) for s in songs]
+        traced = [s.memory.traced_peak[stage] for s in songs if stage in s.memory.traced_peak]
+        p50, p95 = np.percentile(peaks, [50, 95])
+        table.add_row([stage, len(songs), mb(p50), mb(p95), mb(max(peaks)), mb(max(traced)) if traced else ""])
+    print(table)
+
+    song_peak = lambda s: max(growth(s, stage) for stage in s.memory.peak_rss)
+    largest = max(profiled, key=song_peak)
+    over = sum(1 for s in profiled if song_peak(s) > s.memory.estimate_bytes)
+    long_songs = [s for s in profiled if s.memory.duration_sec >= 60]
+    if long_songs:
+        per_minute = np.median([song_peak(s) / s.memory.duration_sec * 60 for s in long_songs])
+        print(f"Median peak per minute of audio: {mb(per_minute)} MB")
+    print(f"Largest peak: {mb(song_peak(largest))} MB for {largest.song_name} ({int(largest.memory.duration_sec)}s, "
+          f"estimated {mb(largest.memory.estimate_bytes)} MB), {over} songs above their estimate")
+    print(f"Largest worker RSS: {mb(max(max(s.memory.peak_rss.values()) for s in profiled))} MB")
+
+
 def _print_failed_songs(r: List[SongIndexError]):
 
     cols = ['Title', 'Artist', 'Reason']
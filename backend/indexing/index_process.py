@@ -1,26 +1,47 @@
 
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
 from dataclasses import dataclass, field
-from multiprocessing import Process, Queue
+from multiprocessing import Array, Process, Queue
 import os
 import queue
 from time import time, time_ns
 from typing import Callable, List
 
-import audiofile
 from tinytag import TinyTag
 
 from config.constants import HOP_SIZE, WINDOW_SIZE
-from database.db import AppDatabase
+from database.db import AppDatabase, HashSchemeChanged
 from fingerprint.fingerprinting import generate_fingerprints
-from indexing.index_result import Reason, ReasonBadFile, ReasonTooLong, ReasonUnknown, SongIndexError, SongIndexSuccess
+from indexing.index_result import Reason, ReasonBadFile, ReasonTooLong, ReasonUnknown, SongIndexError, SongIndexSuccess, SongMemory, SongStarted, WorkerRecycled
+from indexing.memory import MemoryBudget, StageProfiler, estimate_peak_bytes, rss_bytes
+from matching.duplicates import find_duplicate_recording
 from model.song import Song
 from preprocessing.audio_preprocessing import PreprocessedAudio, preprocess_audio_file
+from preprocessing.decoders import audio_duration
 
 
 
+# Recordings at least this long are fingerprinted on several cores while the
+# other workers are idle (see generate_fingerprints' executor)
+SPLIT_MIN_DURATION_SEC = 600
+
+
 @dataclass
 class IndexProcessOptions:
     max_duration_sec: int
+    # wait for more tasks when the queue is empty, until a None task arrives
+    keep_alive: bool = False
+    # link re-releases of an indexed recording to it instead of storing their fingerprints
+    detect_duplicates: bool = False
+    # processes for splitting a long recording, 1 never splits, needs the busy flags of the WorkerSupervisor
+    split_workers: int = 1
+    split_min_duration_sec: int = SPLIT_MIN_DURATION_SEC
+    # a worker exits after this many songs or once its RSS is above the ceiling, and is replaced
+    max_songs_per_worker: int = None
+    max_rss_mb: int = None
+    # also record the peak of Python and NumPy allocations per stage, slows indexing down about 3x
+    trace_allocations: bool = False
 
 @dataclass
 class Tags:
@@ -35,12 +56,21 @@ class IndexProcess(Process):
                  task_queue: Queue, 
                  progress_queue: Queue,
                  options: IndexProcessOptions, 
-                 db_factory: Callable[[], AppDatabase]
+                 db_factory: Callable[[], AppDatabase],
+                 memory_budget: MemoryBudget = None,
+                 busy: Array = None,
+                 slot: int = 0
                  ):
         super().__init__()
         self.task_queue = task_queue
         self.progress_queue = progress_queue
         self.db_factory = db_factory
+        self.memory_budget = memory_budget
+        # one flag per worker of the pool, set while it indexes a file, this one's is busy[slot]
+        self.busy = busy
+        self.slot = slot
+        # created on the first split and kept for the life of the worker
+        self._split_executor = None
         
         self.options = options
 
@@ -48,15 +78,23 @@ class IndexProcess(Process):
     def run(self):
         
         db = self.db_factory()
+        self.hash_scheme = db.get_hash_scheme()
+        num_songs = 0
 
         while True:
 
             try:
-                file_path = self.task_queue.get(block=False)
+                file_path = self.task_queue.get(block=self.options.keep_alive)
             except queue.Empty: # we finished all tasks
                 db.close()
                 break
+
+            if file_path is None:
+                db.close()
+                break
             
+            self.progress_queue.put(SongStarted(os.getpid(), file_path))
+            self._set_busy(True)
             try:
                 res = self._index_file(file_path, db)
             except Exception as e:
@@ -67,8 +105,34 @@ class IndexProcess(Process):
                     reason=ReasonUnknown(e)
                 )
             finally:
+                self._set_busy(False)
+                res.pid = os.getpid()
                 self.progress_queue.put(res) # signal that a song is finished
-            
+
+            num_songs += 1
+            reason = self._reason_to_recycle(num_songs)
+            if reason is not None:
+                db.close()
+                self.progress_queue.put(WorkerRecycled(os.getpid(), num_songs, rss_bytes(), reason))
+                break
+
+        if self._split_executor is not None:
+            self._split_executor.shutdown()
+
+    def _set_busy(self, busy: bool):
+        if self.busy is not None:
+            self.busy[self.slot] = int(busy)
+
+    def _reason_to_recycle(self, num_songs: int) -> str | None:
+        options = self.options
+        if options.max_songs_per_worker and num_songs >= options.max_songs_per_worker:
+            return 'songs'
+
+        rss = rss_bytes()
+        if options.max_rss_mb and rss is not None and rss > options.max_rss_mb * 1024 * 1024:
+            return 'rss'
+
+        return None
 
     def _index_file(self, file_path: str, db: AppDatabase) -> SongIndexSuccess | SongIndexError:
         
@@ -76,7 +140,8 @@ class IndexProcess(Process):
 
         tags = self._get_tags(file_path)
 
-        reason_to_discard = self._reason_to_discard(file_path)
+        duration = audio_duration(file_path)
+        reason_to_discard = self._reason_to_discard(duration)
         if reason_to_discard is not None:
             return SongIndexError(
                 file_path=file_path,
@@ -100,9 +165,28 @@ class IndexProcess(Process):
             is_skipped=True
         )
 
+        # wait until the song fits in memory next to the ones other workers are indexing
+        estimate = estimate_peak_bytes(duration)
+        with self.memory_budget.reserve(estimate) if self.memory_budget is not None else contextlib.nullcontext():
+            profiler = StageProfiler(self.options.trace_allocations)
+            try:
+                res = self._fingerprint_and_store(file_path, tags, db, profiler, start_time)
+            except HashSchemeChanged as e:
+                # the index was migrated while this song waited to be stored
+                self.hash_scheme = e.hash_scheme
+                res = self._fingerprint_and_store(file_path, tags, db, profiler, start_time)
+
+        if isinstance(res, SongIndexSuccess):
+            res.memory = SongMemory(duration, estimate, profiler.start_rss, profiler.peak_rss, profiler.traced_peak)
+        return res
+
+    def _fingerprint_and_store(self, file_path: str, tags: Tags, db: AppDatabase, profiler: StageProfiler, start_time: int) -> SongIndexSuccess | SongIndexError:
+
         try:
-            preprocessed_audio = preprocess_audio_file(file_path)
-            fingerprints = self._get_fingerprints(preprocessed_audio)
+            with profiler.stage('decode'):
+                preprocessed_audio = preprocess_audio_file(file_path)
+            with profiler.stage('fingerprint'):
+                fingerprints = self._get_fingerprints(preprocessed_audio)
         except Exception as e:
             return SongIndexError(
                 file_path=file_path,
@@ -112,6 +196,11 @@ class IndexProcess(Process):
             )
             
 
+        duplicate = None
+        if self.options.detect_duplicates:
+            with profiler.stage('dedupe'):
+                duplicate = find_duplicate_recording(db, fingerprints, preprocessed_audio.duration_seconds)
+
         song = Song(
             id=None,
             title=tags.title,
@@ -119,11 +208,15 @@ class IndexProcess(Process):
             album_name=tags.album,
             file_path=file_path,
             duration_sec=preprocessed_audio.duration_seconds,
-            sample_rate=preprocessed_audio.rate
+            sample_rate=preprocessed_audio.rate,
+            canonical_id=duplicate.song_id if duplicate is not None else None
         )
 
-        song_id = db.insert_song(song)
-        db.insert_fingerprints(song_id=song_id, fingerprints=fingerprints)
+        with profiler.stage('store'):
+            if duplicate is not None:
+                song_id = db.insert_song(song)
+            else:
+                song_id = db.insert_song_with_fingerprints(song, fingerprints, self.hash_scheme)
 
         end_time = time_ns()
         total_time_ms = (end_time - start_time) / 1_000_000 
@@ -134,14 +227,30 @@ class IndexProcess(Process):
             artist=song.artist_name,
             index_duration_msec=total_time_ms,
             db_id=song_id,
-            is_skipped=False
+            is_skipped=False,
+            linked_to=song.canonical_id,
+            num_fingerprints=len(fingerprints)
         )
 
 
     def _get_fingerprints(self, preprocessed_audio: PreprocessedAudio):
-        fingerprints = generate_fingerprints(preprocessed_audio, window_size=WINDOW_SIZE, hop_size=HOP_SIZE)
+        options = self.options
+
+        # no other worker is busy, use their cores
+        if options.split_workers > 1 and preprocessed_audio.duration_seconds >= options.split_min_duration_sec and self._others_idle():
+            if self._split_executor is None:
+                self._split_executor = ProcessPoolExecutor(options.split_workers)
+            return generate_fingerprints(preprocessed_audio, window_size=WINDOW_SIZE, hop_size=HOP_SIZE, hash_scheme=self.hash_scheme, executor=self._split_executor)
+
+        fingerprints = generate_fingerprints(preprocessed_audio, window_size=WINDOW_SIZE, hop_size=HOP_SIZE, hash_scheme=self.hash_scheme)
         return fingerprints
 
+    def _others_idle(self) -> bool:
+        # the queue is not checked, it holds the None tasks that stop the idle workers
+        if self.busy is None:
+            return False
+        return sum(self.busy[:]) == 1
+
     def _get_tags(self, file_path: str) -> Tags:
         tags = TinyTag.get(file_path, ignore_errors=True)
         title = tags.title or os.path.splitext(os.path.basename(file_path))[0]
@@ -151,9 +260,8 @@ class IndexProcess(Process):
         return Tags(title, artist, album)
 
 
-    def _reason_to_discard(self, file_path: str) -> Reason:
+    def _reason_to_discard(self, duration: float) -> Reason:
 
-        duration = audiofile.duration(file_path, sloppy=True)
         options = self.options
 
         if options.max_duration_sec and duration > options.max_duration_sec:
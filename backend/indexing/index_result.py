@@ -4,6 +4,15 @@ from abc import ABC, abstractmethod
 
 
 
+@dataclass
+class SongMemory:
+    duration_sec: float
+    estimate_bytes: int     # what the worker reserved from the memory budget
+    start_rss: int          # RSS of the worker when it started on the song
+    peak_rss: dict          # stage -> peak RSS of the worker during the stage
+    traced_peak: dict       # stage -> peak of the allocations traced by tracemalloc, when enabled
+
+
 @dataclass
 class SongIndexSuccess:
     file_path: str
@@ -12,6 +21,10 @@ class SongIndexSuccess:
     index_duration_msec: int
     db_id: int
     is_skipped: bool
+    linked_to: int = None       # canonical song of a duplicate recording, whose fingerprints are then not stored
+    num_fingerprints: int = 0
+    memory: SongMemory = None
+    pid: int = None     # worker that indexed it
 
 
 class Reason(ABC):
@@ -40,6 +53,24 @@ class ReasonBadFile(Reason):
     def human_readable(self):
         return "Bad file format"
 
+@dataclass
+class ReasonTimedOut(Reason):
+    timeout_sec: int
+
+    def human_readable(self):
+        return f"Timed out after {int(self.timeout_sec)}s"
+
+@dataclass
+class ReasonWorkerDied(Reason):
+    exitcode: int
+
+    def human_readable(self):
+        if self.exitcode is None:
+            return "Worker died"
+        if self.exitcode == -9:
+            return "Worker killed (out of memory?)"
+        return f"Worker died (exit code {self.exitcode})"
+
 
 @dataclass
 class SongIndexError:
@@ -47,3 +78,33 @@ class SongIndexError:
     song_name: str
     artist: str 
     reason: Reason
+    pid: int = None
+
+
+@dataclass
+class WorkerRecycled:
+    """
+    Sent by a worker that exits to give its memory back, the WorkerSupervisor starts a new one.
+    """
+    pid: int
+    songs: int
+    rss_bytes: int
+    reason: str     # 'songs' (max_songs_per_worker) or 'rss' (max_rss_mb)
+
+
+@dataclass
+class SongStarted:
+    """
+    Sent by a worker before it starts on a file, so the parent knows which file a worker that dies was on.
+    """
+    pid: int
+    file_path: str
+
+
+@dataclass
+class WorkerDied:
+    """
+    Sent by the WorkerSupervisor when a worker exits without retiring: killed, out of memory, or crashed.
+    """
+    pid: int
+    exitcode: int
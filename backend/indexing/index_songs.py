@@ -1,5 +1,4 @@
 from multiprocessing import Queue
-import audiofile
 import argparse
 import os
 from prettytable import PrettyTable
@@ -7,26 +6,27 @@ from termcolor import colored
 from tinytag import TinyTag
 from database.config import DB_NAME, DB_PASS, DB_USER
 from indexing.config import IndexConfig
-from indexing.index_output import _print_failed_songs, _print_success_songs
-from indexing.index_process import IndexProcessOptions, IndexProcess
-from indexing.index_result import SongIndexError, SongIndexSuccess
+from indexing.index_output import _print_duplicates_summary, _print_failed_songs, _print_memory_summary, _print_success_songs
+from indexing.index_process import IndexProcessOptions
+from indexing.index_result import ReasonWorkerDied, SongIndexError, SongIndexSuccess, SongStarted, WorkerDied, WorkerRecycled
+from indexing.library import create_db_connection, find_audio_files
+from indexing.memory import MemoryBudget, available_memory_bytes
+from indexing.supervisor import WorkerSupervisor
 from model.song import Song
 from preprocessing.audio_preprocessing import preprocess_audio_file, PreprocessedAudio
+from preprocessing.decoders import audio_duration
 from fingerprint.fingerprinting import generate_fingerprints 
+from fingerprint.hashing import HASH_SCHEMES
 from database.db import AppDatabase
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import List, Optional
 from tqdm import tqdm
 from pprint import pprint
 
-audio_file_extensions = ('mp3', 'm4a', 'flac', 'ogg', 'wav')
-
-def create_db_connection():
-    return AppDatabase(DB_NAME, DB_USER, DB_PASS)
-
 def index_songs_in_directory(directory: str, config: IndexConfig):
 
-    file_paths = _get_all_candidate_files(directory)
+    # longest first, so the run does not end with one worker busy on a long recording
+    file_paths = _sort_longest_first(find_audio_files(directory))
     
 
     total_files = len(file_paths)
@@ -35,32 +35,54 @@ def index_songs_in_directory(directory: str, config: IndexConfig):
     results_queue = Queue()
     
 
-    # Feed all tasks to queue
+    # Feed all tasks to queue. Workers wait for tasks instead of stopping at an
+    # empty queue, which a worker started before the queue is flushed would see,
+    # the supervisor stops them once every file is done.
     for path in file_paths:
         task_queue.put(path)
 
     
     success_result = []
     error_results = []
+    recycled = []
+    died = []
 
     # Create and start workers
-    workers = []
-    options = IndexProcessOptions(max_duration_sec=config.max_duration_sec)
-    for _ in range(config.num_workers):
-        worker = IndexProcess(
-            task_queue=task_queue,
-            progress_queue=results_queue,
-            options=options,
-            db_factory=create_db_connection
-        )
-        worker.start()
-        workers.append(worker)
+    options = IndexProcessOptions(
+        max_duration_sec=config.max_duration_sec,
+        keep_alive=True,
+        detect_duplicates=config.detect_duplicates,
+        split_workers=config.num_workers,
+        max_songs_per_worker=config.max_songs_per_worker,
+        max_rss_mb=config.max_worker_rss_mb,
+        trace_allocations=config.trace_allocations
+    )
+    memory_budget = MemoryBudget(config.memory_budget_mb * 1024 * 1024) if config.memory_budget_mb else None
+
+    supervisor = WorkerSupervisor(config.num_workers, task_queue, results_queue, options, create_db_connection, memory_budget)
+    supervisor.start()
 
     # Progress loop
+    in_progress = dict()  # worker pid -> file it is indexing
     with tqdm(total=total_files, desc="Indexing Songs", unit="song") as pbar:
         completed = 0
         while completed < total_files:
             result = results_queue.get()  # waits for signal from any worker
+            if isinstance(result, SongStarted):
+                in_progress[result.pid] = result.file_path
+                continue
+            if isinstance(result, WorkerRecycled):
+                recycled.append(result)
+                continue
+            if isinstance(result, WorkerDied):
+                died.append(result)
+                # a result sent before it died comes first and cleared its file
+                file_path = in_progress.pop(result.pid, None)
+                if file_path is None:
+                    continue
+                result = SongIndexError(file_path, os.path.basename(file_path), "", ReasonWorkerDied(result.exitcode), result.pid)
+            in_progress.pop(result.pid, None)
+
             if isinstance(result, SongIndexSuccess):
                 success_result.append(result)
             elif isinstance(result, SongIndexError):
@@ -69,13 +91,17 @@ def index_songs_in_directory(directory: str, config: IndexConfig):
             completed += 1
             pbar.update(1)
 
-    for worker in workers:
-        worker.join()
+    supervisor.stop()
 
 
     print(colored("\nIndexing complete", color='blue', attrs=['bold','underline']))
     print(f"✅ Successful: {len(success_result)} songs")
     print(f"❌ Failed:     {len(error_results)} songs")
+    if died:
+        print(f"⚠️  Workers that died: {len(died)}")
+    if config.detect_duplicates:
+        _print_duplicates_summary(success_result)
+    _print_memory_summary(success_result, recycled)
     print()
 
     if config.print_tables:
@@ -85,13 +111,15 @@ def index_songs_in_directory(directory: str, config: IndexConfig):
     
 
 
-def _get_all_candidate_files(directory):
-    file_paths = []
-    for root, _, file_names in os.walk(directory):
-        for f in file_names:
-            if f.lower().endswith(audio_file_extensions):
-                file_paths.append(os.path.join(root, f))
-    return file_paths
+def _sort_longest_first(file_paths: List[str]) -> List[str]:
+    durations = dict()
+    for path in tqdm(file_paths, desc="Reading durations", unit="file"):
+        try:
+            durations[path] = audio_duration(path)
+        except Exception:
+            durations[path] = 0  # the worker reports the bad file
+    return sorted(file_paths, key=lambda p: durations[p], reverse=True)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Songs Database Indexing')
@@ -99,12 +127,36 @@ if __name__ == '__main__':
     parser.add_argument('--max_duration', '-m', type=int, help='Max audio file duration in seconds (optional)', required=False)
     parser.add_argument('--workers', '-w', type=int, default=4, help='Number of parallel workers')
     parser.add_argument('--print-table', '-pt', action='store_true', help='Prints tables containing the results')
+    parser.add_argument('--dedupe', action='store_true', help='Link re-releases of already indexed recordings instead of storing their fingerprints again')
+    parser.add_argument('--hash-scheme', type=int, choices=HASH_SCHEMES, help='Hash layout of a new index (default 1), an existing index keeps its own')
+    parser.add_argument('--memory-budget-mb', type=int, help='Estimated memory the workers may use at once (default half the available memory, 0 for no limit)')
+    parser.add_argument('--max-songs-per-worker', type=int, help='Replace a worker after this many songs')
+    parser.add_argument('--max-worker-rss-mb', type=int, help='Replace a worker once its RSS is above this')
+    parser.add_argument('--trace-allocations', action='store_true', help='Also measure Python and NumPy allocations per stage (about 3x slower)')
     args = parser.parse_args()
 
     db = AppDatabase(DB_NAME, DB_USER, DB_PASS)
-    db.create_tables()
-
-    config = IndexConfig(num_workers=args.workers, max_duration_sec=args.max_duration, print_tables=args.print_table)
+    db.create_tables(args.hash_scheme)
+
+    if args.hash_scheme is not None and db.get_hash_scheme() != args.hash_scheme:
+        print(f"The index uses hash scheme {db.get_hash_scheme()}, convert it first with: python -m database.maintenance migrate-hash {args.hash_scheme}")
+        db.close()
+        exit(1)
+
+    memory_budget_mb = args.memory_budget_mb
+    if memory_budget_mb is None and available_memory_bytes() is not None:
+        memory_budget_mb = available_memory_bytes() // (2 * 1024 * 1024)
+
+    config = IndexConfig(
+        num_workers=args.workers,
+        max_duration_sec=args.max_duration,
+        print_tables=args.print_table,
+        detect_duplicates=args.dedupe,
+        max_songs_per_worker=args.max_songs_per_worker,
+        max_worker_rss_mb=args.max_worker_rss_mb,
+        memory_budget_mb=memory_budget_mb,
+        trace_allocations=args.trace_allocations
+    )
     index_songs_in_directory(args.dir, config)
 
     db.close()
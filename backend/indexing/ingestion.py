@@ -0,0 +1,339 @@
+from collections import deque
+import contextlib
+from dataclasses import replace
+from multiprocessing import Queue
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+from time import monotonic, perf_counter
+from typing import Callable, List
+
+from database.db import AppDatabase
+from database.delta_index import DeltaIndex
+from indexing.index_process import IndexProcessOptions
+from indexing.index_result import ReasonTimedOut, ReasonUnknown, ReasonWorkerDied, SongIndexError, SongIndexSuccess, SongStarted, WorkerDied, WorkerRecycled
+from indexing.memory import MemoryBudget
+from indexing.supervisor import WorkerSupervisor
+
+# pg_try_advisory_lock key, the server process holding it runs the workers
+INGESTION_LOCK_KEY = 0x464D5349
+
+# running jobs without a heartbeat for STALE_AFTER_SEC are taken back from their worker
+HEARTBEAT_SEC = 15
+STALE_AFTER_SEC = 120
+
+# unexpected errors (unreachable storage, lost connections) are retried, bad files are not
+MAX_ATTEMPTS = 3
+
+# a worker still on the same file after this long is hung, it is killed and the job retried
+JOB_TIMEOUT_SEC = 1800
+
+# long-running workers are replaced now and then, giving back what the allocator kept
+MAX_SONGS_PER_WORKER = 200
+
+# after a merge, give every server worker time to switch to the new index
+# and drop the merged songs from its delta before counting them again
+MERGE_COOLDOWN_SEC = 30
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def worker_name() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class IngestionService:
+    """
+    Indexes songs from the ingest_jobs table with IndexProcess workers, next
+    to the server or on any number of other hosts (indexing/distributed.py).
+    Any server process can queue jobs and report their status, but only the
+    one holding `lock_key` runs workers.
+
+    Claimed jobs get a heartbeat while they wait in this process's task queue
+    and while the worker indexing them is alive. Jobs of a service that died
+    are queued again by whichever service notices first.
+
+    With a memory-mapped index, new songs are served from the DeltaIndex until
+    they are merged: the index is rebuilt in a separate process once the delta
+    holds `merge_max_songs` songs or is `merge_interval_sec` old.
+
+    Workers share `memory_budget_mb` of estimated song memory and are replaced
+    by a WorkerSupervisor when they retire (see IndexProcessOptions.max_songs_per_worker)
+    or die. The job of a worker that died, or that was killed after
+    JOB_TIMEOUT_SEC on it, is retried like an unexpected error.
+    """
+
+    def __init__(self,
+                 db_factory: Callable[[], AppDatabase],
+                 num_workers: int,
+                 options: IndexProcessOptions,
+                 delta: DeltaIndex = None,
+                 merge_max_songs: int = 200,
+                 merge_interval_sec: float = 600,
+                 lock_key: int = INGESTION_LOCK_KEY,
+                 run_id: str = None,
+                 batch_size: int = None,
+                 memory_budget_mb: int = None
+                 ):
+        self.db_factory = db_factory
+        self.num_workers = num_workers
+        self.options = replace(options, keep_alive=True)
+        self.delta = delta
+        self.merge_max_songs = merge_max_songs
+        self.merge_interval_sec = merge_interval_sec
+        self.lock_key = lock_key
+        self.run_id = run_id
+        # jobs claimed at once, by default every worker has one song and one more waiting
+        self.batch_size = batch_size or 2 * num_workers
+        self.worker = worker_name()
+        self.memory_budget = MemoryBudget(memory_budget_mb * 1024 * 1024) if memory_budget_mb else None
+
+        self.task_queue = Queue()
+        self.progress_queue = Queue()
+        self._jobs_by_path = dict()  # file path -> deque of job ids waiting in the task queue
+        self._worker_jobs = dict()   # worker pid -> (job id, file path, started at) of the file it is indexing
+        self._timed_out = set()      # pids of the workers killed for taking longer than JOB_TIMEOUT_SEC
+        self._gone = set()           # pids of the workers found gone by the last heartbeat
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self._supervisor = None
+        self._threads = []
+        self._lock_db = None
+
+        self._counts = {'indexed': 0, 'skipped': 0, 'failed': 0, 'retried': 0}
+        self._merges = 0
+        self._last_merge_sec = None
+        self._recycled = 0
+        self._died = 0
+
+    @property
+    def is_running(self) -> bool:
+        return self._lock_db is not None
+
+    def start(self) -> bool:
+        """
+        Starts the workers, unless another process holds the lock.
+        Call before starting other threads, the worker supervisor is forked from this process.
+        """
+        db = self.db_factory()
+        if self.lock_key is not None and not db.try_advisory_lock(self.lock_key):
+            db.close()
+            return False
+
+        self._lock_db = db
+        db.create_tables()
+        print(f"[Ingestion] {self.worker} running {self.num_workers} workers")
+
+        self._supervisor = WorkerSupervisor(self.num_workers, self.task_queue, self.progress_queue, self.options, self.db_factory, self.memory_budget)
+        self._supervisor.start()
+
+        targets = [self._feed_loop, self._collect_loop, self._heartbeat_loop]
+        if self.delta is not None:
+            targets.append(self._merge_loop)
+        for target in targets:
+            thread = threading.Thread(target=target, name=f"ingestion{target.__name__}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        return True
+
+    def stop(self):
+        if not self.is_running:
+            return
+
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+        self._supervisor.stop()
+        self._supervisor = None
+
+        # songs still being indexed are picked up again by the next service
+        self._lock_db.release_ingest_jobs(self.worker)
+        self._lock_db.close()
+        self._lock_db = None
+
+    def stats(self) -> dict:
+        return {
+            'running': self.is_running,
+            'worker': self.worker,
+            'workers': self.num_workers if self.is_running else 0,
+            'recycled_workers': self._recycled,
+            'died_workers': self._died,
+            'in_flight': self._in_flight,
+            'completed': dict(self._counts),
+            'merges': self._merges,
+            'last_merge_sec': self._last_merge_sec,
+        }
+
+    def _feed_loop(self):
+        db = self.db_factory()
+        try:
+            while not self._stop.is_set():
+                # claim a new batch once the last one is mostly taken by the workers
+                free = self.batch_size + self.num_workers - self._in_flight
+                jobs = db.claim_ingest_jobs(self.batch_size, self.worker, self.run_id) if free >= self.batch_size else []
+
+                for job_id, file_path in jobs:
+                    with self._lock:
+                        self._jobs_by_path.setdefault(file_path, deque()).append(job_id)
+                        self._in_flight += 1
+                    self.task_queue.put(file_path)
+
+                if len(jobs) == 0:
+                    self._stop.wait(1)
+        finally:
+            db.close()
+
+    def _collect_loop(self):
+        db = self.db_factory()
+        try:
+            while not self._stop.is_set():
+                try:
+                    result = self.progress_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+                if isinstance(result, SongStarted):
+                    with self._lock:
+                        job_id = self._jobs_by_path[result.file_path].popleft()
+                        if len(self._jobs_by_path[result.file_path]) == 0:
+                            del self._jobs_by_path[result.file_path]
+                        self._worker_jobs[result.pid] = (job_id, result.file_path, monotonic())
+                    continue
+                if isinstance(result, WorkerRecycled):
+                    self._recycled += 1
+                    continue
+
+                with self._lock:
+                    # a result sent before the worker died comes first and took its job,
+                    # and the heartbeat takes the job of a worker that is gone
+                    job = self._worker_jobs.pop(result.pid, None)
+                    timed_out = result.pid in self._timed_out
+                    self._timed_out.discard(result.pid)
+                if isinstance(result, WorkerDied):
+                    self._died += 1
+                if job is None:
+                    continue
+
+                job_id, file_path, _ = job
+                if isinstance(result, WorkerDied):
+                    reason = ReasonTimedOut(JOB_TIMEOUT_SEC) if timed_out else ReasonWorkerDied(result.exitcode)
+                    result = SongIndexError(file_path, os.path.basename(file_path), "", reason, result.pid)
+                self._finish_job(db, job_id, result)
+        finally:
+            db.close()
+
+    def _finish_job(self, db: AppDatabase, job_id: int, result: SongIndexSuccess | SongIndexError):
+        if isinstance(result, SongIndexSuccess):
+            status = 'skipped' if result.is_skipped else 'indexed'
+            db.finish_ingest_job(job_id, self.worker, status, song_id=result.db_id)
+        elif isinstance(result.reason, (ReasonUnknown, ReasonWorkerDied, ReasonTimedOut)):
+            status = 'retried'
+            db.retry_ingest_job(job_id, self.worker, result.reason.human_readable(), MAX_ATTEMPTS)
+        else:
+            status = 'failed'
+            db.finish_ingest_job(job_id, self.worker, status, error=result.reason.human_readable())
+
+        with self._lock:
+            self._in_flight -= 1
+            self._counts[status] += 1
+
+    def _heartbeat_loop(self):
+        db = self.db_factory()
+        try:
+            while not self._stop.wait(HEARTBEAT_SEC):
+                try:
+                    job_ids = self._check_workers(db)
+                    if job_ids:
+                        db.heartbeat_ingest_jobs(job_ids, self.worker)
+                    requeued, failed = db.requeue_abandoned_ingest_jobs(STALE_AFTER_SEC, MAX_ATTEMPTS)
+                    if requeued or failed:
+                        print(f"[Ingestion] Took back {requeued + failed} jobs of unresponsive workers ({failed} out of attempts)")
+                except Exception as e:
+                    print(f"[Ingestion] Heartbeat failed: {e}")
+        finally:
+            db.close()
+
+    def _check_workers(self, db: AppDatabase) -> List[int]:
+        """
+        Jobs that still get a heartbeat: those waiting for a worker and those
+        of live workers. A worker on the same file for JOB_TIMEOUT_SEC is
+        killed, the supervisor replaces it and its job is retried. The job of
+        a worker still gone at the next heartbeat without its result or a
+        WorkerDied, as when the supervisor died too, is retried here.
+        """
+        now = monotonic()
+        gone = []
+        with self._lock:
+            job_ids = [job_id for ids in self._jobs_by_path.values() for job_id in ids]
+            for pid, (job_id, file_path, started_at) in list(self._worker_jobs.items()):
+                if not _process_exists(pid):
+                    # its last messages may still be on the way to the collector
+                    if pid in self._gone:
+                        gone.append((pid, self._worker_jobs.pop(pid)))
+                        self._timed_out.discard(pid)
+                    self._gone.add(pid)
+                elif pid in self._timed_out:
+                    continue
+                elif now - started_at > JOB_TIMEOUT_SEC:
+                    print(f"[Ingestion] Worker {pid} has been on {file_path} for {now - started_at:.0f}s, killing it")
+                    self._timed_out.add(pid)
+                    with contextlib.suppress(ProcessLookupError):
+                        os.kill(pid, signal.SIGKILL)
+                else:
+                    job_ids.append(job_id)
+            self._gone.intersection_update(self._worker_jobs)
+
+        for pid, (job_id, file_path, _) in gone:
+            self._finish_job(db, job_id, SongIndexError(file_path, os.path.basename(file_path), "", ReasonWorkerDied(None), pid))
+        return job_ids
+
+    def _merge_loop(self):
+        last_merge = monotonic()
+        while not self._stop.wait(5):
+            delta_stats = self.delta.stats()
+            # new and replaced songs are in the delta, deleted ones are only gone from the index once it is rebuilt
+            pending = delta_stats['songs'] + delta_stats['deleted']
+            stale = self.delta.is_stale  # hash scheme migrated, every song has to be exported again
+            since_merge = monotonic() - last_merge
+            if (pending == 0 and not stale) or since_merge < MERGE_COOLDOWN_SEC:
+                continue
+            if not stale and pending < self.merge_max_songs and since_merge < self.merge_interval_sec:
+                continue
+
+            # a separate process, so the export never competes with recognition for this one's GIL
+            if stale:
+                print(f"[Ingestion] Rebuilding the main index with hash scheme {self.delta.hash_scheme}")
+            else:
+                print(f"[Ingestion] Merging {delta_stats['songs'] - delta_stats['replaced']} new, {delta_stats['replaced']} replaced "
+                      f"and {delta_stats['deleted']} deleted songs into the main index")
+            start = perf_counter()
+            build = subprocess.run(
+                [sys.executable, '-m', 'database.mapped_index', 'build', self.delta.main.root],
+                cwd=BACKEND_DIR, capture_output=True, text=True
+            )
+            last_merge = monotonic()
+
+            if build.returncode != 0:
+                print(f"[Ingestion] Index build failed: {build.stderr.strip()}")
+                continue
+            self._merges += 1
+            self._last_merge_sec = perf_counter() - start
+            print(f"[Ingestion] Merged in {self._last_merge_sec:.1f}s")
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
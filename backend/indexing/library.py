@@ -0,0 +1,23 @@
+import os
+from typing import List
+
+from database.config import DB_NAME, DB_PASS, DB_USER
+from database.db import AppDatabase
+
+audio_file_extensions = ('mp3', 'm4a', 'flac', 'ogg', 'wav')
+
+
+def create_db_connection() -> AppDatabase:
+    return AppDatabase(DB_NAME, DB_USER, DB_PASS)
+
+
+def find_audio_files(directory: str) -> List[str]:
+    """
+    Audio files anywhere under `directory`, by extension.
+    """
+    file_paths = []
+    for root, _, file_names in os.walk(directory):
+        for f in file_names:
+            if f.lower().endswith(audio_file_extensions):
+                file_paths.append(os.path.join(root, f))
+    return file_paths
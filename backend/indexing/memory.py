@@ -0,0 +1,194 @@
+import contextlib
+from multiprocessing import Array, Lock, Value
+import os
+import time
+import tracemalloc
+
+# Peak memory of indexing a song grows with its duration: the decoded signal
+# at its native rate and its resampled copy, the windowed frames, the
+# spectrogram and the fingerprint tuples. Stereo 44.1 kHz files peak while
+# fingerprinting at about 1.4 MB per second of audio, the memory profile
+# printed after a run shows the rate of the actual library.
+ESTIMATE_BASE_BYTES = 64 * 1024 * 1024
+ESTIMATE_BYTES_PER_SEC = 1536 * 1024
+
+# workers that can be in line for the memory budget or hold a reservation at once
+MAX_BUDGET_SLOTS = 256
+# pid of a slot whose worker was killed while in line, its ticket is skipped
+LEFT_LINE = -1
+# songs in line check their turn this often. Polled rather than waited on a
+# Condition, whose notify blocks for good once a waiting worker was killed.
+RESERVE_POLL_SEC = 0.05
+
+
+def estimate_peak_bytes(duration_sec: float) -> int:
+    """
+    Memory a worker needs above its idle size to index a song of this duration.
+    """
+    return int(ESTIMATE_BASE_BYTES + ESTIMATE_BYTES_PER_SEC * duration_sec)
+
+
+def rss_bytes() -> int | None:
+    return _read_status('VmRSS')
+
+
+def peak_rss_bytes() -> int | None:
+    return _read_status('VmHWM')
+
+
+def reset_peak_rss():
+    # Linux only: makes VmHWM start again from the current RSS
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _read_status(key: str) -> int | None:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class StageProfiler:
+    """
+    Records the peak memory of each indexing stage of a song: the peak RSS of
+    the process and, with `trace_allocations`, the peak of the memory
+    allocated through Python and NumPy (tracemalloc, about three times slower).
+    """
+
+    def __init__(self, trace_allocations: bool = False):
+        self.trace_allocations = trace_allocations
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self.start_rss = rss_bytes()
+        self.peak_rss = dict()      # stage -> bytes
+        self.traced_peak = dict()   # stage -> bytes
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        reset_peak_rss()
+        if self.trace_allocations:
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            peak = peak_rss_bytes()
+            if peak is not None:
+                self.peak_rss[name] = peak
+            if self.trace_allocations:
+                self.traced_peak[name] = tracemalloc.get_traced_memory()[1]
+
+
+class MemoryBudget:
+    """
+    Estimated peak memory shared by the workers of one host. A song waits
+    until its estimate fits next to the songs being indexed, and a song
+    larger than the whole budget runs alone. Songs are admitted in the order
+    they asked, so a long recording is not starved by a stream of short ones.
+
+    Created before the workers are started and inherited by them. Every
+    worker in line or holding a reservation has a slot with its pid, so the
+    reservation of a worker that was killed can be given back (release_worker).
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._lock = Lock()
+        self._reserved = Value('q', 0, lock=False)
+        self._active = Value('i', 0, lock=False)
+        self._next_ticket = Value('q', 0, lock=False)
+        self._head = Value('q', 0, lock=False)
+        self._slot_pids = Array('q', MAX_BUDGET_SLOTS, lock=False)    # 0 for a free slot
+        self._slot_tickets = Array('q', MAX_BUDGET_SLOTS, lock=False)
+        self._slot_bytes = Array('q', MAX_BUDGET_SLOTS, lock=False)   # 0 while in line
+
+    @contextlib.contextmanager
+    def reserve(self, num_bytes: int):
+        with self._lock:
+            ticket = self._next_ticket.value
+            self._next_ticket.value += 1
+            slot = self._take_slot(os.getpid(), ticket)
+
+        while not self._try_admit(slot, ticket, num_bytes):
+            time.sleep(RESERVE_POLL_SEC)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._reserved.value -= num_bytes
+                self._active.value -= 1
+                self._slot_pids[slot] = 0
+
+    def release_worker(self, pid: int):
+        """
+        Gives back the reservation of a worker that was killed, or its place in line.
+        Only for a worker that is gone, a live one releases its own.
+        """
+        with self._lock:
+            for slot in range(MAX_BUDGET_SLOTS):
+                if self._slot_pids[slot] != pid:
+                    continue
+                if self._slot_bytes[slot] > 0:
+                    self._reserved.value -= self._slot_bytes[slot]
+                    self._active.value -= 1
+                    self._slot_pids[slot] = 0
+                elif self._slot_tickets[slot] == self._head.value:
+                    self._slot_pids[slot] = 0
+                    self._advance_head()
+                else:
+                    self._slot_pids[slot] = LEFT_LINE
+
+    def _try_admit(self, slot: int, ticket: int, num_bytes: int) -> bool:
+        with self._lock:
+            if self._head.value != ticket:
+                return False
+            if self._active.value > 0 and self._reserved.value + num_bytes > self.budget_bytes:
+                return False
+            self._slot_bytes[slot] = num_bytes
+            self._reserved.value += num_bytes
+            self._active.value += 1
+            self._advance_head()
+            return True
+
+    def _take_slot(self, pid: int, ticket: int) -> int:
+        for slot in range(MAX_BUDGET_SLOTS):
+            if self._slot_pids[slot] == 0:
+                self._slot_pids[slot] = pid
+                self._slot_tickets[slot] = ticket
+                self._slot_bytes[slot] = 0
+                return slot
+        raise RuntimeError(f"More than {MAX_BUDGET_SLOTS} workers share the memory budget")
+
+    def _advance_head(self):
+        # the next ticket, skipping those of workers killed while in line
+        self._head.value += 1
+        slot = 0
+        while slot < MAX_BUDGET_SLOTS:
+            if self._slot_pids[slot] == LEFT_LINE and self._slot_tickets[slot] == self._head.value:
+                self._slot_pids[slot] = 0
+                self._head.value += 1
+                slot = 0
+            else:
+                slot += 1
+
+
+def available_memory_bytes() -> int | None:
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
@@ -0,0 +1,94 @@
+from multiprocessing import Array, Event, Process, Queue, parent_process
+from multiprocessing.connection import wait
+from typing import Callable
+
+from database.db import AppDatabase
+from indexing.index_process import IndexProcess, IndexProcessOptions
+from indexing.index_result import WorkerDied
+from indexing.memory import MemoryBudget
+
+# on stop, workers get this long to finish their file before they are terminated
+WORKER_STOP_TIMEOUT_SEC = 30
+
+
+class WorkerSupervisor(Process):
+    """
+    Keeps `num_workers` IndexProcess workers running until stop(), starting
+    a new one whenever one exits: after retiring (WorkerRecycled) or dying,
+    killed when out of memory or crashed. A dead worker's memory reservation
+    is given back and WorkerDied is sent on the progress queue, the parent
+    knows the file it was on from its SongStarted messages.
+
+    Workers are forked from this process and not from the parent, whose
+    threads may hold locks at that moment and whose memory would count toward
+    the new worker's RSS. Start it before the parent starts other threads.
+    """
+
+    def __init__(self,
+                 num_workers: int,
+                 task_queue: Queue,
+                 progress_queue: Queue,
+                 options: IndexProcessOptions,
+                 db_factory: Callable[[], AppDatabase],
+                 memory_budget: MemoryBudget = None
+                 ):
+        super().__init__(name='index-supervisor')
+        self.num_workers = num_workers
+        self.task_queue = task_queue
+        self.progress_queue = progress_queue
+        self.options = options
+        self.db_factory = db_factory
+        self.memory_budget = memory_budget
+
+        self.busy = Array('b', num_workers)
+        self._stop = Event()
+
+    def stop(self):
+        """
+        Stops the workers once they finish their current file and waits for them.
+        """
+        self._stop.set()
+        self.join()
+
+    def run(self):
+        workers = dict()  # sentinel -> worker
+        for slot in range(self.num_workers):
+            self._start_worker(workers, slot)
+
+        parent = parent_process()
+        while not self._stop.is_set() and parent.is_alive():
+            for sentinel in wait(list(workers), timeout=1):
+                worker = workers.pop(sentinel)
+                worker.join()
+                if worker.exitcode != 0:
+                    self._worker_died(worker)
+                if not self._stop.is_set():
+                    self._start_worker(workers, worker.slot)
+
+        # workers wait for tasks, a None stops one
+        for _ in workers:
+            self.task_queue.put(None)
+        for worker in workers.values():
+            worker.join(timeout=WORKER_STOP_TIMEOUT_SEC)
+            if worker.is_alive():
+                worker.terminate()
+
+    def _start_worker(self, workers: dict, slot: int):
+        worker = IndexProcess(
+            task_queue=self.task_queue,
+            progress_queue=self.progress_queue,
+            options=self.options,
+            db_factory=self.db_factory,
+            memory_budget=self.memory_budget,
+            busy=self.busy,
+            slot=slot
+        )
+        worker.start()
+        workers[worker.sentinel] = worker
+
+    def _worker_died(self, worker: IndexProcess):
+        print(f"[Supervisor] Worker {worker.pid} died with exit code {worker.exitcode}")
+        self.busy[worker.slot] = 0
+        if self.memory_budget is not None:
+            self.memory_budget.release_worker(worker.pid)
+        self.progress_queue.put(WorkerDied(worker.pid, worker.exitcode))
@@ -0,0 +1,78 @@
+from collections import Counter
+from dataclasses import dataclass
+import random
+from typing import List, Tuple
+
+from database.db import AppDatabase
+
+# A new song is linked to an indexed one when, in every quarter of it, this
+# share of a sample of its hashes lines up at a single offset in the indexed
+# song. Re-encodes and remasters of the same recording land well above it,
+# unrelated songs around 0.001, and a medley or a song sharing a chorus fails
+# in the quarters that differ.
+DUPLICATE_SAMPLE_SIZE = 2000
+DUPLICATE_MIN_MATCH_RATIO = 0.1
+DUPLICATE_SEGMENTS = 4
+
+# Coarser than matching.BIN_SIZE: a different amount of leading silence moves
+# peaks by a fraction of a frame and splits the votes between two 3 ms bins
+DUPLICATE_BIN_MSEC = 50
+
+# Edits and extended mixes contain the original but are different recordings
+DUPLICATE_MAX_DURATION_DIFF_SEC = 3
+DUPLICATE_MAX_OFFSET_MSEC = 3000
+
+
+@dataclass
+class DuplicateMatch:
+    song_id: int
+    match_ratio: float      # aligned share of the sampled hashes in the weakest segment
+    offset_msec: int
+
+
+def find_duplicate_recording(db: AppDatabase, fingerprints: List[Tuple[int, int]], duration_sec: float) -> DuplicateMatch | None:
+    """
+    Looks up a sample of a new song's fingerprints and returns the indexed
+    song that is the same recording, if any.
+    """
+    if len(fingerprints) == 0:
+        return None
+
+    # seeded so re-indexing a file makes the same decision
+    sample = random.Random(len(fingerprints)).sample(fingerprints, min(len(fingerprints), DUPLICATE_SAMPLE_SIZE))
+    query_times = dict((h, t) for h, t in sample)  # one query time per hash, as in matching
+    rows = db.find_matches(list(query_times))
+
+    votes = dict()  # song_id -> Counter of offset bins
+    for h, db_time, song_id in rows:
+        votes.setdefault(song_id, Counter())[(db_time - query_times[h]) // DUPLICATE_BIN_MSEC] += 1
+
+    # the best pair of adjacent bins
+    best = max(((v[b] + v[b + 1], song_id, b) for song_id, v in votes.items() for b in list(v)), default=None)
+    if best is None:
+        return None
+    _, song_id, offset_bin = best
+
+    offset_msec = int(offset_bin * DUPLICATE_BIN_MSEC)
+    if abs(offset_msec) > DUPLICATE_MAX_OFFSET_MSEC:
+        return None
+
+    segment_msec = max(1.0, duration_sec * 1000 / DUPLICATE_SEGMENTS)
+    segment = lambda t: min(DUPLICATE_SEGMENTS - 1, int(t // segment_msec))
+
+    totals = Counter(segment(t) for t in query_times.values())
+    aligned = set()
+    for h, db_time, s in rows:
+        if s == song_id and (db_time - query_times[h]) // DUPLICATE_BIN_MSEC in (offset_bin, offset_bin + 1):
+            aligned.add(h)
+    aligned_per_segment = Counter(segment(query_times[h]) for h in aligned)
+
+    match_ratio = min(aligned_per_segment[i] / n for i, n in totals.items())
+    if match_ratio < DUPLICATE_MIN_MATCH_RATIO:
+        return None
+
+    song = db.get_song(song_id)
+    if song is None or abs(song.duration_sec - duration_sec) > DUPLICATE_MAX_DURATION_DIFF_SEC:
+        return None
+
+    return DuplicateMatch(song_id, match_ratio, offset_msec)
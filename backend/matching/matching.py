@@ -3,21 +3,35 @@ import numpy as np
 from config.constants import HOP_SIZE, WINDOW_SIZE
 from database.db import AppDatabase
 from fingerprint.fingerprinting import generate_fingerprints
+from fingerprint.hashing import HASH_SCHEME_V1
 from preprocessing.audio_preprocessing import preprocess_audio_file, PreprocessedAudio
 
 
 from collections import defaultdict, Counter
 
+# Width of the offset histogram bins used for voting (milliseconds)
+BIN_SIZE = 3
+
 
 def find_matches_of_file(db: AppDatabase, audio_file_path: str, top_n: int = 5):
     preprocessed_audio = preprocess_audio_file(audio_file_path)
     return get_audio_matches(db, preprocessed_audio)
 
 
-def get_audio_matches(db: AppDatabase, audio: PreprocessedAudio, top_n: int = 5):
+def get_audio_matches(db: AppDatabase, audio: PreprocessedAudio, top_n: int = 5, aggregate_in_db: bool = False, hash_scheme: int = HASH_SCHEME_V1):
+
+    fingerprints = generate_fingerprints(audio, WINDOW_SIZE, HOP_SIZE, hash_scheme)
+    return get_fingerprint_matches(db, fingerprints, top_n, aggregate_in_db)
+
+
+def get_fingerprint_matches(db: AppDatabase, fingerprints, top_n: int = 5, aggregate_in_db: bool = False):
+
+    if aggregate_in_db:
+        return _get_fingerprint_matches_in_db(db, fingerprints, top_n)
 
-    fingerprints = generate_fingerprints(audio, WINDOW_SIZE, HOP_SIZE)
     hash_time_pairs = [(f[0], f[1]) for f in fingerprints]  # (hash, time_offset)
+    if len(hash_time_pairs) == 0:
+        return []
 
     # Find all matches in the database for the query hashes
     matches = db.find_matches([h for h, _ in hash_time_pairs])  # returns (hash, db_time, song_id)
@@ -27,8 +41,6 @@ def get_audio_matches(db: AppDatabase, audio: PreprocessedAudio, top_n: int = 5)
     # Build a map from hash to query time
     query_hash_time_map = dict(hash_time_pairs)
 
-    BIN_SIZE = 3 # milliseconds
-
     for h, db_time, song_id in matches:
         query_time = query_hash_time_map.get(h)
         if query_time is None:
@@ -43,12 +55,29 @@ def get_audio_matches(db: AppDatabase, audio: PreprocessedAudio, top_n: int = 5)
 
 
     # Score by the most common delta_t (i.e., peak of the voting histogram)
-    scores = {
-        song_id: max(votes.values())
-        for song_id, votes in offset_votes.items()
-    }
+    # the peak's delta is where the query starts within the song (msec)
+    scores = []
+    for song_id, votes in offset_votes.items():
+        offset, score = votes.most_common(1)[0]
+        scores.append((song_id, score, offset))
 
     # Sort by score descending
-    sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    sorted_scores = sorted(scores, key=lambda x: x[1], reverse=True)
 
     return sorted_scores[:top_n]
+
+
+def _get_fingerprint_matches_in_db(db: AppDatabase, fingerprints, top_n: int):
+    """
+    Same voting as above, but the histogram is built by Postgres and only the
+    top songs come back instead of every matching fingerprint row.
+    """
+
+    # one query time per hash, like the map above
+    query_hash_time_map = dict((f[0], f[1]) for f in fingerprints)
+    if len(query_hash_time_map) == 0:
+        return []
+
+    hashes = list(query_hash_time_map.keys())
+    query_times = list(query_hash_time_map.values())
+    return db.find_top_matches(hashes, query_times, top_n, BIN_SIZE)
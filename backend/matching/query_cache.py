@@ -0,0 +1,208 @@
+from collections import OrderedDict, defaultdict, deque
+import threading
+import time
+from typing import List, Tuple
+
+from database.db import AppDatabase
+
+
+class QueryCache:
+    """
+    Short-lived, size-bounded cache of hash -> postings shared by all sessions.
+
+    Exposes the same `find_matches` as `AppDatabase`, so it can be passed
+    wherever the database is used for lookups. Hashes without any postings
+    are cached too, since most query hashes of an unknown recording miss.
+
+    A hash missed by several matching threads at once is fetched once, the
+    later threads wait for the first one's result instead of querying too.
+    """
+
+    def __init__(self, db: AppDatabase, ttl_sec: float, max_postings: int):
+        self.db = db
+        self.ttl_sec = ttl_sec
+        self.max_postings = max_postings
+
+        self._entries = OrderedDict()  # hash -> (expires_at, rows), least recently used first
+        self._expiry = deque()         # (expires_at, hash) in the order entries were added
+        self._num_postings = 0
+        self._fetching = dict()        # hash -> _Fetch of the thread querying it
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.shared_misses = 0  # misses served by another thread's query
+        self.evictions = 0
+        self.expirations = 0
+
+    def find_matches(self, hashes: List[int]) -> List[Tuple[int, int, int]]:
+        now = time.monotonic()
+        rows = []
+        missing = []
+        waiting = []  # (hash, _Fetch) fetched by other threads
+
+        unique_hashes = set(hashes)
+
+        with self._lock:
+            for h in unique_hashes:
+                entry = self._entries.get(h)
+                if entry is not None and entry[0] >= now:
+                    self._entries.move_to_end(h)
+                    rows.extend(entry[1])
+                elif h in self._fetching:
+                    waiting.append((h, self._fetching[h]))
+                else:
+                    missing.append(h)
+
+            fetch = _Fetch()
+            for h in missing:
+                self._fetching[h] = fetch
+
+            self.hits += len(unique_hashes) - len(missing) - len(waiting)
+            self.misses += len(missing)
+            self.shared_misses += len(waiting)
+
+        # this thread's own hashes first, so two threads waiting on each other both finish
+        if len(missing) > 0:
+            self._fetch(missing, fetch, now)
+            rows.extend(row for h in missing for row in fetch.postings.get(h, ()))
+
+        for h, other in waiting:
+            other.done.wait()
+            if other.error is not None:
+                raise other.error
+            rows.extend(other.postings.get(h, ()))
+
+        return rows
+
+    def _fetch(self, hashes: List[int], fetch: '_Fetch', now: float):
+        try:
+            for row in self.db.find_matches(hashes):
+                fetch.postings[row[0]].append(row)
+        except Exception as e:
+            fetch.error = e
+            raise
+        finally:
+            expires_at = now + self.ttl_sec
+            with self._lock:
+                for h in hashes:
+                    del self._fetching[h]
+                    if fetch.error is None:
+                        self._put(h, expires_at, fetch.postings.get(h, []))
+                self._evict(time.monotonic())
+            fetch.done.set()
+
+    def invalidate(self, hashes: List[int]):
+        with self._lock:
+            for h in hashes:
+                entry = self._entries.pop(h, None)
+                if entry is not None:
+                    self._num_postings -= _cost(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._expiry.clear()
+            self._num_postings = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'shared_misses': self.shared_misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'cached_hashes': len(self._entries),
+                'cached_postings': self._num_postings,
+            }
+
+    def _put(self, h: int, expires_at: float, rows: list):
+        old = self._entries.pop(h, None)
+        if old is not None:
+            self._num_postings -= _cost(old[1])
+        self._entries[h] = (expires_at, rows)
+        self._expiry.append((expires_at, h))
+        self._num_postings += _cost(rows)
+
+    def _evict(self, now: float):
+        # every entry lives ttl_sec, so the ones added first expire first
+        while self._expiry and self._expiry[0][0] < now:
+            expires_at, h = self._expiry.popleft()
+            entry = self._entries.get(h)
+            if entry is not None and entry[0] == expires_at:  # not replaced or dropped since
+                del self._entries[h]
+                self._num_postings -= _cost(entry[1])
+                self.expirations += 1
+
+        while self._num_postings > self.max_postings:
+            _, (_, rows) = self._entries.popitem(last=False)
+            self._num_postings -= _cost(rows)
+            self.evictions += 1
+
+
+class _Fetch:
+    """
+    One thread's database query for the hashes it missed.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.postings = defaultdict(list)  # hash -> rows
+        self.error = None
+
+
+def _cost(rows: list) -> int:
+    # empty (negative) entries still take memory, count them as one posting
+    return max(1, len(rows))
+
+
+class RecentHits:
+    """
+    Songs recently identified by any session, with the wall-clock time the
+    song started playing (derived from the matched offset).
+
+    In a venue every phone hears the same playback, so a new session whose
+    leading candidate is a recent hit at the same playback position can be
+    accepted with fewer votes.
+    """
+
+    def __init__(self, ttl_sec: float, tolerance_sec: float):
+        self.ttl_sec = ttl_sec
+        self.tolerance_sec = tolerance_sec
+
+        self._hits = dict()  # song_id -> (recorded_at, song_started_at)
+        self._lock = threading.Lock()
+
+        self.lookups = 0
+        self.prior_hits = 0
+
+    def record(self, song_id: int, song_started_at: float):
+        with self._lock:
+            self._hits[song_id] = (time.time(), song_started_at)
+
+    def is_recent(self, song_id: int, song_started_at: float) -> bool:
+        now = time.time()
+        with self._lock:
+            self.lookups += 1
+            hit = self._hits.get(song_id)
+            if hit is None:
+                return False
+            if now - hit[0] > self.ttl_sec:
+                del self._hits[song_id]
+                return False
+            if abs(hit[1] - song_started_at) > self.tolerance_sec:
+                return False
+            self.prior_hits += 1
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'prior_hits': self.prior_hits,
+                'hit_rate': self.prior_hits / self.lookups if self.lookups > 0 else 0.0,
+                'tracked_songs': len(self._hits),
+            }
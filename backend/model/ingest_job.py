@@ -0,0 +1,15 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class IngestJob:
+    id: int
+    file_path: str
+    status: str         # 'queued', 'running', 'indexed', 'skipped' (already in the index) or 'failed'
+    song_id: int
+    error: str
+    created_at: float
+    updated_at: float
+    run_id: str
+    worker: str         # host:pid of the last worker that claimed it
+    attempts: int
@@ -9,4 +9,5 @@ class Song:
     album_name: str
     file_path: str
     duration_sec: int
-    sample_rate: int
\ No newline at end of file
+    sample_rate: int
+    canonical_id: int = None    # indexed song with the same recording, this one then has no fingerprints
\ No newline at end of file
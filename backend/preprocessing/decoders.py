@@ -0,0 +1,214 @@
+from abc import ABC, abstractmethod
+import contextlib
+import math
+import os
+import shutil
+import subprocess
+
+import numpy as np
+from scipy.signal import resample_poly
+
+# both are optional, ffmpeg alone can decode every format
+try:
+    import audiofile
+except ImportError:
+    audiofile = None
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+# Decoders tried for each file extension, best first as measured with
+# benchmarks/decoders.py, unavailable ones are skipped. audiofile reads
+# wav, flac and mp3 through libsndfile as well, so both decode at the same
+# speed (about 400x realtime for wav, 250x for flac and 280x for mp3), but
+# the soundfile decoder peaks at a third of the memory (134 MB instead of
+# 303 MB for 10 minutes of stereo 44.1 kHz). ffmpeg reads every other
+# format, audiofile is the last resort.
+DECODER_PREFERENCE = {
+    'wav': ('soundfile', 'ffmpeg', 'audiofile'),
+    'flac': ('soundfile', 'ffmpeg', 'audiofile'),
+    'ogg': ('soundfile', 'ffmpeg', 'audiofile'),
+    'mp3': ('soundfile', 'ffmpeg', 'audiofile'),
+}
+DEFAULT_PREFERENCE = ('ffmpeg', 'audiofile')
+
+# frames read at a time by the soundfile decoder, 4 MB of stereo float32
+SOUNDFILE_BLOCK_FRAMES = 1 << 19
+
+
+class AudioDecoder(ABC):
+    """
+    Reads an audio file into a mono float32 signal at the requested rate.
+    """
+
+    name: str
+
+    def is_available(self) -> bool:
+        return True
+
+    def can_decode(self, extension: str) -> bool:
+        return True
+
+    @abstractmethod
+    def decode(self, path: str, target_rate: int) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def duration(self, path: str) -> float:
+        """
+        Duration in seconds from the file's header, without decoding it.
+        """
+        pass
+
+
+class AudiofileDecoder(AudioDecoder):
+    """
+    Reads the whole file at its native rate and channels, then downmixes and resamples.
+    """
+
+    name = 'audiofile'
+
+    def is_available(self):
+        return audiofile is not None
+
+    def decode(self, path, target_rate):
+        with suppress_output():
+            signal, rate = audiofile.read(path)
+
+        if signal.ndim > 1:
+            signal = signal.mean(axis=0)
+
+        return resample_signal(signal, rate, target_rate)
+
+    def duration(self, path):
+        with suppress_output():
+            return audiofile.duration(path, sloppy=True)
+
+
+class SoundfileDecoder(AudioDecoder):
+    """
+    Downmixes block by block while reading, so the native rate signal is only held in mono.
+    """
+
+    name = 'soundfile'
+
+    def is_available(self):
+        return soundfile is not None
+
+    def can_decode(self, extension):
+        return extension.upper() in soundfile.available_formats()
+
+    def decode(self, path, target_rate):
+        with soundfile.SoundFile(path) as f:
+            rate = f.samplerate
+            mono = np.empty(f.frames, dtype=np.float32)
+            num_frames = 0
+            for block in f.blocks(SOUNDFILE_BLOCK_FRAMES, dtype='float32', always_2d=True):
+                if num_frames + len(block) > len(mono):
+                    # the frame count of compressed formats can be an estimate
+                    mono = np.concatenate((mono[:num_frames], np.empty(len(block) + len(mono) // 4, dtype=np.float32)))
+                mono[num_frames:num_frames + len(block)] = block.mean(axis=1)
+                num_frames += len(block)
+
+        return resample_signal(mono[:num_frames], rate, target_rate)
+
+    def duration(self, path):
+        return soundfile.info(path).duration
+
+
+class FfmpegDecoder(AudioDecoder):
+    """
+    Pipes the file through ffmpeg, which decodes, downmixes and resamples it
+    to mono float32 at the target rate, so only that signal reaches Python.
+    """
+
+    name = 'ffmpeg'
+
+    def is_available(self):
+        return shutil.which('ffmpeg') is not None
+
+    def decode(self, path, target_rate):
+        command = [
+            'ffmpeg', '-nostdin', '-v', 'error', '-i', path,
+            '-map', '0:a:0', '-ac', '1', '-ar', str(target_rate), '-f', 'f32le', 'pipe:1'
+        ]
+        result = subprocess.run(command, capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg could not decode {path}: {result.stderr.decode(errors='replace').strip()}")
+        return np.frombuffer(result.stdout, dtype=np.float32)
+
+    def duration(self, path):
+        # ffprobe comes with ffmpeg
+        command = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', path]
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"ffprobe could not read {path}: {result.stderr.strip()}")
+        return float(result.stdout.strip())
+
+
+DECODERS = dict((d.name, d) for d in (SoundfileDecoder(), FfmpegDecoder(), AudiofileDecoder()))
+
+
+def decoders_for(path: str) -> list[AudioDecoder]:
+    """
+    The available decoders that can read this file, in the order they are tried.
+    """
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    names = DECODER_PREFERENCE.get(extension, DEFAULT_PREFERENCE)
+    return [DECODERS[n] for n in names if DECODERS[n].is_available() and DECODERS[n].can_decode(extension)]
+
+
+def decode_audio(path: str, target_rate: int, decoder: str = None) -> np.ndarray:
+    """
+    Decodes with the first decoder that reads the file, or only with `decoder` when given.
+    """
+    if decoder is not None and not DECODERS[decoder].is_available():
+        raise RuntimeError(f"The {decoder} decoder is not available")
+
+    decoders = [DECODERS[decoder]] if decoder is not None else decoders_for(path)
+    if len(decoders) == 0:
+        raise RuntimeError(f"No decoder available for {path}")
+
+    error = None
+    for d in decoders:
+        try:
+            return d.decode(path, target_rate)
+        except Exception as e:
+            error = e
+    raise error
+
+
+def audio_duration(path: str) -> float:
+    """
+    Duration in seconds read by the first decoder that can read the file.
+    """
+    decoders = decoders_for(path)
+    if len(decoders) == 0:
+        raise RuntimeError(f"No decoder available for {path}")
+
+    error = None
+    for d in decoders:
+        try:
+            return d.duration(path)
+        except Exception as e:
+            error = e
+    raise error
+
+
+def resample_signal(signal: np.ndarray, rate: int, target_rate: int) -> np.ndarray:
+    """
+    Polyphase resampling with the filter of preprocessing.streaming.StreamingResampler.
+    Unlike FFT resampling its cost does not depend on the factors of the signal length.
+    """
+    if rate == target_rate:
+        return signal
+    g = math.gcd(rate, target_rate)
+    return resample_poly(signal, target_rate // g, rate // g)
+
+
+@contextlib.contextmanager
+def suppress_output():
+    with open(os.devnull, 'w') as fnull:
+        with contextlib.redirect_stdout(fnull), contextlib.redirect_stderr(fnull):
+            yield
@@ -0,0 +1,135 @@
+import math
+import numpy as np
+from scipy.signal import firwin
+
+
+class SampleRingBuffer:
+    """
+    Fixed-capacity ring buffer of decoded samples.
+
+    Every sample is written twice (at i and i + capacity) so that any run of
+    up to `capacity` unread samples is contiguous in memory and can be handed
+    out as a zero-copy view, no matter where the read position currently is.
+    """
+
+    def __init__(self, capacity: int, dtype=np.float32):
+        self._capacity = capacity
+        self._data = np.zeros(2 * capacity, dtype=dtype)
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def write(self, samples: np.ndarray):
+        n = len(samples)
+        if n == 0:
+            return
+
+        if self._size + n > self._capacity:
+            self._grow(self._size + n)
+
+        cap = self._capacity
+        end = (self._start + self._size) % cap
+
+        first = min(n, cap - end)
+        self._data[end:end + first] = samples[:first]
+        self._data[end + cap:end + cap + first] = samples[:first]
+
+        rest = n - first
+        if rest > 0:
+            self._data[:rest] = samples[first:]
+            self._data[cap:cap + rest] = samples[first:]
+
+        self._size += n
+
+    def view(self, n: int) -> np.ndarray:
+        """
+        Returns the oldest `n` unread samples without copying them.
+        The view stays valid until those samples are consumed.
+        """
+        if n > self._size:
+            raise ValueError(f"Requested {n} samples but only {self._size} are buffered")
+        view = self._data[self._start:self._start + n]
+        view.flags.writeable = False
+        return view
+
+    def consume(self, n: int):
+        n = min(n, self._size)
+        self._start = (self._start + n) % self._capacity
+        self._size -= n
+
+    def _grow(self, min_capacity: int):
+        # Only happens when a single push is larger than the free space,
+        # e.g. a client sending a whole clip in one frame.
+        pending = self.view(self._size).copy()
+        self._capacity = max(min_capacity, 2 * self._capacity)
+        self._data = np.zeros(2 * self._capacity, dtype=self._data.dtype)
+        self._start = 0
+        self._size = 0
+        self.write(pending)
+
+
+class StreamingResampler:
+    """
+    Polyphase resampler that can be fed audio in arbitrarily sized chunks.
+
+    Uses the same anti-aliasing filter as `scipy.signal.resample_poly` and keeps
+    the tail of the input as filter state, so the concatenation of all outputs
+    is what resampling the whole stream at once would give (minus the last few
+    samples that still wait for their look-ahead).
+    """
+
+    _BLOCK_SIZE = 4096  # output samples computed per vectorized step
+
+    def __init__(self, in_rate: int, out_rate: int):
+        g = math.gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+
+        if self.up == self.down:
+            return
+
+        max_rate = max(self.up, self.down)
+        self._half_len = 10 * max_rate
+        h = firwin(2 * self._half_len + 1, 1.0 / max_rate, window=('kaiser', 5.0)) * self.up
+
+        self._taps = math.ceil(len(h) / self.up)
+        h = np.pad(h, (0, self._taps * self.up - len(h)))
+
+        # phase p of the filter uses h[p], h[p + up], h[p + 2*up], ...
+        self._phases = h.reshape(self._taps, self.up).T.astype(np.float32)
+        self._tap_range = np.arange(self._taps)
+
+        self._history = np.zeros(self._taps - 1, dtype=np.float32)
+        self._total_in = 0
+        self._total_out = 0
+
+    def process(self, chunk: np.ndarray) -> np.ndarray:
+        chunk = chunk.astype(np.float32, copy=False)
+
+        if self.up == self.down:
+            return chunk
+
+        # buffer[0] corresponds to global input index `offset`
+        buffer = np.concatenate((self._history, chunk))
+        offset = self._total_in - len(self._history)
+        self._total_in += len(chunk)
+
+        # output n needs input samples up to (n * down + half_len) // up
+        n_end = (self._total_in * self.up - 1 - self._half_len) // self.down + 1
+        n_end = max(n_end, self._total_out)
+
+        out = np.empty(n_end - self._total_out, dtype=np.float32)
+        for block_start in range(self._total_out, n_end, self._BLOCK_SIZE):
+            n = np.arange(block_start, min(block_start + self._BLOCK_SIZE, n_end))
+            j = n * self.down + self._half_len
+            base = j // self.up - offset
+            samples = buffer[base[:, None] - self._tap_range[None, :]]
+            out[block_start - self._total_out:n[-1] + 1 - self._total_out] = \
+                np.einsum('nt,nt->n', self._phases[j % self.up], samples)
+
+        self._total_out = n_end
+        self._history = buffer[len(buffer) - len(self._history):].copy()
+
+        return out